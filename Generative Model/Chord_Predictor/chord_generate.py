@@ -2,11 +2,14 @@ import sys
 sys.path.append("../")
 
 import argparse
+from autotune import load_tuned_model
+import profiling
 from utils import *
 
 
 def generate_chords(model, primer, cuda, priming_length, max_length=1000, temperature=1.0, n_primes=1):
-    model = torch.load(model)
+    # the model is either a path to the checkpoint or an already loaded network
+    if isinstance(model, str): model = load_model(model, cuda)
     loader = Loader("../Primers/" + primer)
 
     input_tensor = loader.create_chord_tensor()
@@ -31,22 +34,26 @@ def generate_chords(model, primer, cuda, priming_length, max_length=1000, temper
 
     # feed forward the whole network with primer and then generate new music of maximal length args.max_length
     for i in range(n_primes*input_size + max_length):
+        profiling.step('chord_step')
         model.repackage_hidden()
 
         # don't generate anything, just feed the network to set its hidden states
         if i < n_primes*input_size + priming_length:
-            _ = model(input)
+            with profiling.phase('forward'):
+                _ = model(input)
             output = input_tensor[(i+1) % input_size]
 
         # else generate new events
         else:
             # generate probability distribution over all chords
-            output = model(input)
-            output = torch.squeeze(output.data.double().div_(temperature).exp_())
+            with profiling.phase('forward'):
+                output = model(input)
 
             # select a random event from the distribution
-            output = output.div_(torch.sum(output))
-            output = torch.multinomial(output, 1)[0]
+            with profiling.phase('sampling'):
+                output = torch.squeeze(output.data.double().div_(temperature).exp_())
+                output = output.div_(torch.sum(output))
+                output = torch.multinomial(output, 1)[0]
 
         # last chord is the new input
         input[0,0] = output
@@ -58,6 +65,7 @@ def generate_chords(model, primer, cuda, priming_length, max_length=1000, temper
         # else append the generated event to result
         result.append(output)
 
+    profiling.end_step('chord_step')
     result.append(24)
     return result
 
@@ -72,6 +80,10 @@ if __name__ == "__main__":
     parser.add_argument('--n_primes', type=int, default=1, help="how many times do we feed forward the whole primer (default: 1)")
     parser.add_argument('--length', type=int, default=500, help='max length of the generated sequence')
     parser.add_argument('--temperature', type=float, default=1.0, help='certainty of the prediction')
+    parser.add_argument('--lookup_tables', type=bool, default=False, help='replace the first recurrent layer input projection by precomputed lookup tables (default: False)')
+    parser.add_argument('--profile', type=str, default='', help='autotuning profile applied to the tuned models (see autotune.py), empty uses the profile of this machine, "none" disables it')
+    parser.add_argument('--quantize', type=bool, default=False, help='use int8 dynamic quantization for faster CPU inference (default: False)')
+    parser.add_argument('--trace', type=str, default='', help='time the phases of the generating loop and save their Chrome trace (JSON) into this file, the statistics are saved next to it, see profiling.py')
     args = parser.parse_args()
 
     # Set the random seed manually for reproducibility.
@@ -81,6 +93,10 @@ if __name__ == "__main__":
         else:
             torch.cuda.manual_seed(args.seed)
 
-    output = generate_chords(args.model, args.primer, args.cuda, args.priming_length, args.length, args.temperature, args.n_primes)
+    if args.trace != '': profiling.enable()
+
+    model = load_tuned_model(args.model, args.cuda, args.lookup_tables, args.quantize, set_threads=True, profile=args.profile)
+    output = generate_chords(model, args.primer, args.cuda, args.priming_length, args.length, args.temperature, args.n_primes)
     print(output)
+    profiling.finish(args.trace)
 
@@ -7,6 +7,10 @@ import datetime
 import torch.optim as optim
 
 from Chord_Predictor.lstm_model import *
+import data_parallel as dp
+import profiling
+import training_state as ts
+import validation
 from utils import *
 
 
@@ -31,8 +35,23 @@ parser.add_argument('--seq_len', type=int, default=100, help='total sequence len
 parser.add_argument('--tie', type=bool, default=False, help='tie the encoder-decoder weights (default: False)')
 parser.add_argument('--cell', type=str, default='bnlstm', help='type of rnn cell, supported values are "bnlstm" for LSTM with batch norm and "lstm" for standard LSTM cell (default: bnlstm)')
 parser.add_argument('--seed', type=int, default=42, help='random seed (default: 42)')
+parser.add_argument('--resume', type=str, default='', help='path to a full-state checkpoint (chord-resume.pt) to continue an interrupted training from')
+parser.add_argument('--checkpoint_interval', type=int, default=1000, help='how many steps it takes before writing the full-state checkpoint (default: 1000)')
+parser.add_argument('--val_worker', type=bool, default=False, help='validate snapshots of the weights in a separate process while the training continues, only on CPU (default: False)')
+parser.add_argument('--val_batch_size', type=int, default=0, help='batch size of the validation worker, 0 uses --batch_size (default: 0)')
+parser.add_argument('--val_threads', type=int, default=0, help='torch threads of the validation worker, 0 keeps the default (default: 0)')
+parser.add_argument('--distributed', type=bool, default=False, help='data-parallel CPU training in processes started by torchrun, see data_parallel.py (default: False)')
+parser.add_argument('--threads', type=int, default=0, help='torch threads of every process when training distributed, 0 splits the cores of the node between its processes (default: 0)')
+parser.add_argument('--bf16', type=bool, default=False, help='bfloat16 mixed precision of the forward passes (autocast), the weights, batch norm statistics and optimizer state stay in float32 (default: False)')
+parser.add_argument('--trace', type=str, default='', help='time the phases of the training loop and save their Chrome trace (JSON) into this file, the statistics are saved next to it, see profiling.py')
 args = parser.parse_args()
 
+# join the other processes, when training distributed
+dp.init_distributed(args)
+
+# time the phases of the training loop
+if args.trace != '': profiling.enable()
+
 
 # Set the random seed manually for reproducibility.
 torch.manual_seed(args.seed)
@@ -54,13 +73,21 @@ n_chords = Loader.number_of_chords()
 train_data = train_loader.create_chord_tensor()
 val_data = val_loader.create_chord_tensor()
 
+# the validation worker batchifies the validation set with its own batch size
+val_sources = (val_data,)
+
 # divide the tensors into batches
-train_data = batchify(train_data, args.batch_size)
-val_data = batchify(val_data, args.batch_size)
+train_data = dp.shard(batchify(train_data, args.batch_size))
+val_data = dp.shard(batchify(val_data, args.batch_size))
+
+# every process trains on its own slice of the batches, from now on batch_size is the size of the slice
+args.batch_size //= dp.world_size()
 
 
 # initialize the network graph
 model = lstm_model(args.emsize, args.nhid, args.layers, n_chords, args.dropout, args.tie, args.cell, args.seq_len)
+dp.broadcast_model(model)
+profiling.time_recurrence(model)
 
 if args.cuda:
     model.cuda()
@@ -73,8 +100,20 @@ criterion = nn.CrossEntropyLoss()
 lr = args.lr
 optimizer = getattr(optim, args.optim)(model.parameters(), lr=lr)
 
+# continue an interrupted training from its full-state checkpoint
+resume_state = None
+if args.resume != '':
+    resume_state = ts.load_training_state(args.resume, model, optimizer)
+    lr = resume_state['lr']
+
+# checkpoints and models are written in the background
+writer = ts.CheckpointWriter()
 
+
+@profiling.timed('validation')
 def evaluate(event_source):
+    # the running statistics of batch norm differ between processes
+    dp.synchronize_buffers(model)
     model.eval()
     model.init_hidden(args.batch_size)
     total_loss = 0
@@ -86,41 +125,57 @@ def evaluate(event_source):
         output_flat = output.view(-1, n_chords)
         total_loss += len(input) * criterion(output_flat, targets).data
         model.repackage_hidden()
-    return total_loss[0] / len(event_source)
+    return dp.average(float(total_loss) / len(event_source))
 
 
-def train(epoch, train_log, test_log):
+def train(epoch, train_log, test_log, start_batch=0):
     model.train()
     model.init_hidden(args.batch_size)
     total_loss = 0
     start_time = time.time()
 
+    # when resuming in the middle of the epoch, continue with the hidden states of the interrupted training
+    if start_batch > 0: ts.restore_position(model, resume_state, args.cuda)
+
     #for each batch
     for batch, i in enumerate(range(0, train_data.size(0) - 1, args.seq_len)):
-        input, targets = get_batch(train_data, i, args, evaluation=False)
+        # skip the batches trained before resuming
+        if batch < start_batch: continue
+        profiling.step('batch')
+
+        with profiling.phase('get_batch'):
+            input, targets = get_batch(train_data, i, args, evaluation=False)
 
         # repackage hidden states to not backpropagate into the old ones
         model.repackage_hidden()
         optimizer.zero_grad()
 
         # forward and backward pass
-        output = model(input)
-        loss = criterion(output.view(-1, n_chords), targets)
-        loss.backward()
+        with profiling.phase('forward'), autocast(args):
+            output = model(input)
+            loss = criterion(output.view(-1, n_chords), targets)
+        with profiling.phase('backward'):
+            loss.backward()
+
+        # average the gradients of all processes
+        with profiling.phase('all_reduce'):
+            dp.all_reduce_gradients(model)
 
         # clip gradient and update weights according to it
-        torch.nn.utils.clip_grad_norm(model.parameters(), args.clip)
-        optimizer.step()
+        with profiling.phase('clip'):
+            torch.nn.utils.clip_grad_norm(model.parameters(), args.clip)
+        with profiling.phase('optimizer'):
+            optimizer.step()
 
         total_loss += loss.data
 
         # log train progress if we are at the right step
         if batch % args.log_interval == 0 and batch > 0:
-            cur_loss = total_loss[0] / args.log_interval
+            cur_loss = dp.average(float(total_loss) / args.log_interval)
             elapsed = time.time() - start_time
-            print('| epoch {:3d} | {:5d}/{:5d} batches | lr {:02.5f} | ms/batch {:5.5f} | loss {:5.2f}'.format(
+            print('| epoch {:3d} | {:5d}/{:5d} batches | lr {:02.5f} | ms/batch {:5.5f} | events/s {:8.0f} | loss {:5.2f}'.format(
                 epoch, batch, train_data.size(0) // args.seq_len, lr,
-                elapsed * 1000 / args.log_interval, cur_loss))
+                elapsed * 1000 / args.log_interval, args.log_interval * args.seq_len * args.batch_size * dp.world_size() / elapsed, cur_loss))
 
             total_loss = 0
             start_time = time.time()
@@ -129,25 +184,46 @@ def train(epoch, train_log, test_log):
 
         # evaluate the progress on validation set if we are at the right step
         if batch % args.val_interval == 0 and batch > 0:
-            val_loss = evaluate(val_data)
-            print(val_loss, file=test_log, flush=True)
+            if args.val_worker:
+                validation.validate_in_background(validator, model)
+            else:
+                val_loss = evaluate(val_data)
+                print(val_loss, file=test_log, flush=True)
+
+                model.train()
+                model.init_hidden(args.batch_size)
+
+        # log the validations finished by the worker
+        if validator is not None: validator.log_results(test_log)
+
+        # write the full training state in the background
+        if (batch + 1) % args.checkpoint_interval == 0:
+            ts.save_training_state(writer, ts.snapshot(model, optimizer, lr, epoch, batch + 1, best_val_loss), ts.resume_filename('chord'))
 
-            model.train()
-            model.init_hidden(args.batch_size)
+    profiling.end_step('batch')
 
 
 # at any point you can hit Ctrl + C to break out of training early.
 if __name__ == "__main__":
-    best_val_loss = None
+    best_val_loss = None if resume_state is None else resume_state['best_val_loss']
 
-    with open("chord_train_log_{}".format(datetime.datetime.now().strftime("%Y-%m-%d_%H.%M.%S")), "w") as train_log:
-        with open("chord_test_log_{}".format(datetime.datetime.now().strftime("%Y-%m-%d_%H.%M.%S")), "w") as test_log:
+    # validation in a separate process on snapshots of the weights, the first rank validates for all of them
+    validator = None
+    if args.val_worker and dp.rank() == 0:
+        validator = validation.ValidationWorker(model, evaluate, val_sources, args.val_batch_size or args.batch_size * dp.world_size(), args, args.val_threads)
+
+    with open(dp.log_filename("chord_train_log_{}".format(datetime.datetime.now().strftime("%Y-%m-%d_%H.%M.%S"))), "w") as train_log:
+        with open(dp.log_filename("chord_test_log_{}".format(datetime.datetime.now().strftime("%Y-%m-%d_%H.%M.%S"))), "w") as test_log:
 
             try:
-                for epoch in range(1, args.epochs+1):
+                start_epoch = 1 if resume_state is None else resume_state['epoch']
+                for epoch in range(start_epoch, args.epochs+1):
                     epoch_start_time = time.time()
-                    train(epoch, train_log, test_log)
-                    val_loss = evaluate(val_data)
+                    start_batch = resume_state['batch'] if resume_state is not None and epoch == start_epoch else 0
+                    train(epoch, train_log, test_log, start_batch)
+                    val_loss = validation.validate_and_wait(validator, model, test_log) if args.val_worker else evaluate(val_data)
+                    # the worker logs only the validations in the middle of the epoch, the loss at its end is logged here in both modes
+                    print(val_loss, file=test_log, flush=True)
 
                     print('-' * 89)
                     print('| end of epoch {:3d} | time: {:5.2f}s | valid loss {:5.2f}'.format(epoch, (time.time() - epoch_start_time), val_loss))
@@ -155,7 +231,7 @@ if __name__ == "__main__":
 
                     # save the model if the validation loss is the best we've seen so far.
                     if not best_val_loss or val_loss < best_val_loss:
-                        save(model, 'chord', val_loss, args)
+                        if dp.rank() == 0: ts.save_model(writer, model, 'chord', val_loss, args)
                         best_val_loss = val_loss
 
                     # or if the validation got worse, decay the learning rate
@@ -164,7 +240,18 @@ if __name__ == "__main__":
                         for param_group in optimizer.param_groups:
                             param_group['lr'] = lr
 
+                    # the next epoch starts from its first batch
+                    ts.save_training_state(writer, ts.snapshot(model, optimizer, lr, epoch + 1, 0, best_val_loss), ts.resume_filename('chord'))
 
             except KeyboardInterrupt:
                 print('-' * 89)
-                print('Exiting from training early')
\ No newline at end of file
+                print('Exiting from training early')
+
+            if validator is not None: validator.close(test_log)
+
+    # wait for the checkpoints still being written
+    writer.close()
+
+    # statistics and the timeline of the phases
+    if args.trace != '': profiling.finish(ts.rank_filename(args.trace))
+    dp.cleanup_distributed()
@@ -0,0 +1,245 @@
+import sys
+sys.path.append("../")
+
+import argparse
+import datetime
+import os
+import time
+import torch.optim as optim
+
+import adapters
+import data_parallel as dp
+import profiling
+import training_state as ts
+from utils import *
+from Note_Predictor.lstm_model import *
+
+parser = argparse.ArgumentParser(description='Generative Model -- Note Predictor Adapter Training')
+
+parser.add_argument('--base_model', type=str, default='music-model.loss_0.880.pt', help='path to the trained Note Predictor, which stays frozen')
+parser.add_argument('--name', type=str, default='style', help='name of the style, the adapters are saved as <name>-adapter.loss_*.pt (default: style)')
+parser.add_argument('--rank', type=int, default=8, help='rank of the low-rank updates (default: 8)')
+parser.add_argument('--alpha', type=float, default=8.0, help='scale of the low-rank updates, they are multiplied by alpha / rank (default: 8.0)')
+parser.add_argument('--train_file', type=str, default='', help='names of the files with training data in data folder, separated by commas')
+parser.add_argument('--val_file', type=str, default='', help='names of the files with validation data in data folder, separated by commas')
+parser.add_argument('--batch_size', type=int, default=16, help='batch size (default: 16)')
+parser.add_argument('--cuda', type=bool, default=True, help='use CUDA (default: True)')
+parser.add_argument('--clip', type=float, default=0.25, help='gradient clip, -1 means no clip (default: 0.25)')
+parser.add_argument('--epochs', type=int, default=10, help='upper epoch limit (default: 10)')
+parser.add_argument('--log_interval', type=int, default=10, help='report interval -- how many steps it takes before logging training progress (default: 10)')
+parser.add_argument('--val_interval', type=int, default=100, help='validation interval -- how many steps it takes before evaluation on the validation set (default: 100)')
+parser.add_argument('--lr', type=float, default=0.003, help='initial learning rate (default: 0.003)')
+parser.add_argument('--lr_decay', type=float, default=1.25, help='learning rate decay after each epoch (default: 1.25)')
+parser.add_argument('--seed', type=int, default=42, help='random seed (default: 42)')
+parser.add_argument('--optim', type=str, default='Adam', help='optimizer type (default: Adam)')
+parser.add_argument('--seq_len', type=int, default=120, help='total sequence length; how many time steps are unrolled (default: 120)')
+parser.add_argument('--resume', type=str, default='', help='path to a full-state checkpoint (<name>-resume.pt) to continue an interrupted training from')
+parser.add_argument('--checkpoint_interval', type=int, default=1000, help='how many steps it takes before writing the full-state checkpoint (default: 1000)')
+parser.add_argument('--distributed', type=bool, default=False, help='data-parallel CPU training in processes started by torchrun, see data_parallel.py (default: False)')
+parser.add_argument('--threads', type=int, default=0, help='torch threads of every process when training distributed, 0 splits the cores of the node between its processes (default: 0)')
+parser.add_argument('--bf16', type=bool, default=False, help='bfloat16 mixed precision of the forward passes (autocast), the weights, batch norm statistics and optimizer state stay in float32 (default: False)')
+parser.add_argument('--trace', type=str, default='', help='time the phases of the training loop and save their Chrome trace (JSON) into this file, the statistics are saved next to it, see profiling.py')
+args = parser.parse_args()
+
+# join the other processes, when training distributed
+dp.init_distributed(args)
+
+# time the phases of the training loop
+if args.trace != '': profiling.enable()
+
+
+# Set the random seed manually for reproducibility.
+torch.manual_seed(args.seed)
+if torch.cuda.is_available():
+    if not args.cuda:
+        print("WARNING: You have a CUDA device, so you should probably run with --cuda True")
+    else:
+        torch.cuda.manual_seed(args.seed)
+
+print(args)
+
+
+# a style is usually a few songs, the tensors of all files are concatenated
+def load_files(filenames):
+    tensors = [Loader('../Data/' + filename).create_event_tensor() for filename in filenames.split(',')]
+    return torch.cat([event for event, _ in tensors]), torch.cat([chord for _, chord in tensors])
+
+
+# load training and validation datasets and create tensors from them as the direct I/O of the networks
+train_event_data, train_chord_data = load_files(args.train_file)
+val_event_data, val_chord_data = load_files(args.val_file)
+
+# divide the tensors into batches
+train_event_data = dp.shard(batchify(train_event_data, args.batch_size))
+train_chord_data = dp.shard(batchify(train_chord_data, args.batch_size))
+val_event_data = dp.shard(batchify(val_event_data, args.batch_size))
+val_chord_data = dp.shard(batchify(val_chord_data, args.batch_size))
+
+# every process trains on its own slice of the batches, from now on batch_size is the size of the slice
+args.batch_size //= dp.world_size()
+
+# the base network is frozen, only the low-rank updates of its weights are trained
+model = load_model(args.base_model, args.cuda)
+model.cuda() if args.cuda else model.cpu()
+trained_parameters = adapters.add_adapters(model, args.rank, args.alpha)
+dp.broadcast_model(model)
+profiling.time_recurrence(model)
+
+print('| training {} adapter parameters, the base network has {}'.format(
+    sum(parameter.numel() for parameter in trained_parameters),
+    sum(parameter.numel() for parameter in model.parameters() if not parameter.requires_grad)))
+
+# define the loss function
+criterion = nn.CrossEntropyLoss()
+
+# initialize the optimizer
+lr = args.lr
+optimizer = getattr(optim, args.optim)(trained_parameters, lr=lr)
+
+# continue an interrupted training from its full-state checkpoint
+resume_state = None
+if args.resume != '':
+    resume_state = ts.load_training_state(args.resume, model, optimizer)
+    lr = resume_state['lr']
+
+# checkpoints and adapters are written in the background
+writer = ts.CheckpointWriter()
+
+
+# only the adapter is saved, together with the name of its base network
+def save_adapter(loss):
+    writer.submit(adapters.save_adapter, adapters.adapter_state(model), model.adapter_config, os.path.basename(args.base_model), args.name, loss)
+
+
+@profiling.timed('validation')
+def evaluate(event_source, chord_source):
+    # the running statistics of batch norm differ between processes
+    dp.synchronize_buffers(model)
+    model.eval()
+    model.init_hidden(args.batch_size)
+    total_loss = 0
+
+    for i in range(0, event_source.size(0) - 1, args.seq_len):
+        event_data, targets = get_batch(event_source, i, args, evaluation=True)
+        chord_data = get_batch_without_target(chord_source, i, args, evaluation=True)
+        loss = model.loss(event_data, chord_data, targets, criterion)
+
+        total_loss += len(event_data) * loss.data
+        model.repackage_hidden()
+    return dp.average(float(total_loss) / len(event_source))
+
+
+def train(train_log, test_log, start_batch=0):
+    adapters.train_mode(model)
+    model.init_hidden(args.batch_size)
+    total_loss = 0
+    start_time = time.time()
+
+    # when resuming in the middle of the epoch, continue with the hidden states of the interrupted training
+    if start_batch > 0: ts.restore_position(model, resume_state, args.cuda)
+
+    #for each batch
+    for batch, i in enumerate(range(0, train_event_data.size(0) - 1, args.seq_len)):
+        # skip the batches trained before resuming
+        if batch < start_batch: continue
+        profiling.step('batch')
+
+        with profiling.phase('get_batch'):
+            event_data, targets = get_batch(train_event_data, i, args, evaluation=False)
+            chord_data = get_batch_without_target(train_chord_data, i, args, evaluation=False)
+
+        # repackage hidden states to not backpropagate into the old ones
+        model.repackage_hidden()
+        optimizer.zero_grad()
+
+        # forward and backward pass
+        with profiling.phase('forward'), autocast(args):
+            loss = model.loss(event_data, chord_data, targets, criterion)
+        with profiling.phase('backward'):
+            loss.backward()
+
+        # average the gradients of all processes
+        with profiling.phase('all_reduce'):
+            dp.all_reduce_gradients(model)
+
+        # clip gradient and update weights according to it
+        with profiling.phase('clip'):
+            torch.nn.utils.clip_grad_norm(trained_parameters, args.clip)
+        with profiling.phase('optimizer'):
+            optimizer.step()
+
+        total_loss += loss.data
+
+        # log train progress if we are at the right step
+        if batch % args.log_interval == 0 and batch > 0:
+            cur_loss = dp.average(float(total_loss) / args.log_interval)
+            elapsed = time.time() - start_time
+            print('| epoch {:3d} | {:5d}/{:5d} batches | lr {:02.5f} | ms/batch {:5.5f} | events/s {:8.0f} | loss {:5.2f}'.format(
+                epoch, batch, train_event_data.size(0) // args.seq_len, lr,
+                elapsed * 1000 / args.log_interval, args.log_interval * args.seq_len * args.batch_size * dp.world_size() / elapsed, cur_loss))
+
+            total_loss = 0
+            start_time = time.time()
+
+            print(cur_loss, file=train_log, flush=True)
+
+        # evaluate the progress on validation set if we are at the right step
+        if batch % args.val_interval == 0 and batch > 0:
+            val_loss = evaluate(val_event_data, val_chord_data)
+            print(val_loss, file=test_log, flush=True)
+            if dp.rank() == 0: save_adapter(val_loss)
+
+            adapters.train_mode(model)
+            model.init_hidden(args.batch_size)
+
+        # write the full training state in the background
+        if (batch + 1) % args.checkpoint_interval == 0:
+            ts.save_training_state(writer, ts.snapshot(model, optimizer, lr, epoch, batch + 1, best_val_loss), ts.resume_filename(args.name))
+
+    profiling.end_step('batch')
+
+
+# at any point you can hit Ctrl + C to break out of training early.
+if __name__ == "__main__":
+    best_val_loss = None if resume_state is None else resume_state['best_val_loss']
+
+    # the loss of the base network on the style, before any training
+    if resume_state is None:
+        print('| base valid loss {:5.2f}'.format(evaluate(val_event_data, val_chord_data)))
+
+    with open(dp.log_filename("{}_adapter_train_log_{}".format(args.name, datetime.datetime.now().strftime("%Y-%m-%d_%H.%M.%S"))), "w") as train_log:
+        with open(dp.log_filename("{}_adapter_test_log_{}".format(args.name, datetime.datetime.now().strftime("%Y-%m-%d_%H.%M.%S"))), "w") as test_log:
+
+            try:
+                start_epoch = 1 if resume_state is None else resume_state['epoch']
+                for epoch in range(start_epoch, args.epochs+1):
+                    epoch_start_time = time.time()
+                    start_batch = resume_state['batch'] if resume_state is not None and epoch == start_epoch else 0
+                    train(train_log, test_log, start_batch)
+                    val_loss = evaluate(val_event_data, val_chord_data)
+                    print(val_loss, file=test_log, flush=True)
+
+                    print('-' * 89)
+                    print('| end of epoch {:3d} | time: {:5.2f}s | valid loss {:5.2f}'.format(epoch, (time.time() - epoch_start_time), val_loss))
+                    print('-' * 89)
+
+                    if dp.rank() == 0: save_adapter(val_loss)
+
+                    # decay learning rate
+                    lr /= args.lr_decay
+                    for param_group in optimizer.param_groups:
+                        param_group['lr'] = lr
+
+                    # the next epoch starts from its first batch
+                    ts.save_training_state(writer, ts.snapshot(model, optimizer, lr, epoch + 1, 0, best_val_loss), ts.resume_filename(args.name))
+
+            except KeyboardInterrupt:
+                print('-' * 89)
+                print('Exiting from training early')
+
+    # wait for the checkpoints still being written
+    writer.close()
+
+    # statistics and the timeline of the phases
+    if args.trace != '': profiling.finish(ts.rank_filename(args.trace))
+    dp.cleanup_distributed()
@@ -0,0 +1,337 @@
+import sys
+sys.path.append("../")
+
+import argparse
+import datetime
+import time
+import torch.nn.functional as F
+import torch.optim as optim
+
+import data_parallel as dp
+import profiling
+import training_state as ts
+import validation
+from utils import *
+from Note_Predictor.lstm_model import *
+
+parser = argparse.ArgumentParser(description='Generative Model -- Distilled Note Predictor Training')
+
+parser.add_argument('--teacher', type=str, default='music-model.loss_0.880.pt', help='path to the trained Note Predictor used as the teacher')
+parser.add_argument('--distill_temperature', type=float, default=2.0, help='temperature of the soft targets of the teacher (default: 2.0)')
+parser.add_argument('--alpha', type=float, default=0.9, help='weight of the loss on the soft targets, the rest is the loss on the real next events (default: 0.9)')
+parser.add_argument('--train_file', type=str, default='', help='name of the file with training data in data folder')
+parser.add_argument('--val_file', type=str, default='', help='name of the file with validation data in data folder')
+parser.add_argument('--batch_size', type=int, default=256, help='batch size (default: 256)')
+parser.add_argument('--cuda', type=bool, default=True, help='use CUDA (default: True)')
+parser.add_argument('--dropout', type=float, default=0.1, help='dropout applied to embedding layers (default: 0.1)')
+parser.add_argument('--clip', type=float, default=0.25, help='gradient clip, -1 means no clip (default: 0.25)')
+parser.add_argument('--epochs', type=int, default=5, help='upper epoch limit (default: 5)')
+parser.add_argument('--event_emsize', type=int, default=256, help='size of event embeddings of the student (default: 256)')
+parser.add_argument('--chord_emsize', type=int, default=8, help='size of chord embeddings of the student (default: 8)')
+parser.add_argument('--layers', type=int, default=2, help='# of layers of the student (default: 2)')
+parser.add_argument('--log_interval', type=int, default=100, help='report interval -- how many steps it takes before logging training progress (default: 100)')
+parser.add_argument('--val_interval', type=int, default=5000, help='validation interval -- how many steps it takes before evaluation on the validation set (default: 5000)')
+parser.add_argument('--lr', type=float, default=0.003, help='initial learning rate (default: 0.003)')
+parser.add_argument('--lr_decay', type=float, default=4, help='learning rate decay after each epoch (default: 4)')
+parser.add_argument('--nhid', type=int, default=256, help='number of hidden units per layer of the student (default: 256)')
+parser.add_argument('--seed', type=int, default=42, help='random seed (default: 42)')
+parser.add_argument('--tied', type=bool, default=True, help='tie the encoder-decoder weights (default: True)')
+parser.add_argument('--optim', type=str, default='Adam', help='optimizer type (default: Adam)')
+parser.add_argument('--seq_len', type=int, default=120, help='total sequence length; how many time steps are unrolled (default: 120)')
+parser.add_argument('--cell', type=str, default='lstm', help='type of rnn cell of the student, supported values are "bnlstm" for LSTM with batch norm and "lstm" for standard LSTM cell, which is faster at generating (default: lstm)')
+parser.add_argument('--softmax', type=str, default='full', help='output layer, supported values are "full" for softmax over all events and "cluster" for softmax over event groups (note-ons or note-offs of an instrument cluster) followed by a softmax over their pitches (default: full)')
+parser.add_argument('--resume', type=str, default='', help='path to a full-state checkpoint (distilled-resume.pt) to continue an interrupted training from')
+parser.add_argument('--checkpoint_interval', type=int, default=1000, help='how many steps it takes before writing the full-state checkpoint (default: 1000)')
+parser.add_argument('--val_worker', type=bool, default=False, help='validate snapshots of the weights in a separate process while the training continues, only on CPU (default: False)')
+parser.add_argument('--val_batch_size', type=int, default=0, help='batch size of the validation worker, 0 uses --batch_size (default: 0)')
+parser.add_argument('--val_threads', type=int, default=0, help='torch threads of the validation worker, 0 keeps the default (default: 0)')
+parser.add_argument('--distributed', type=bool, default=False, help='data-parallel CPU training in processes started by torchrun, see data_parallel.py (default: False)')
+parser.add_argument('--threads', type=int, default=0, help='torch threads of every process when training distributed, 0 splits the cores of the node between its processes (default: 0)')
+parser.add_argument('--bf16', type=bool, default=False, help='bfloat16 mixed precision of the forward passes (autocast), the weights, batch norm statistics and optimizer state stay in float32 (default: False)')
+parser.add_argument('--trace', type=str, default='', help='time the phases of the training loop and save their Chrome trace (JSON) into this file, the statistics are saved next to it, see profiling.py')
+args = parser.parse_args()
+
+# join the other processes, when training distributed
+dp.init_distributed(args)
+
+# time the phases of the training loop
+if args.trace != '': profiling.enable()
+
+
+# Set the random seed manually for reproducibility.
+torch.manual_seed(args.seed)
+if torch.cuda.is_available():
+    if not args.cuda:
+        print("WARNING: You have a CUDA device, so you should probably run with --cuda True")
+    else:
+        torch.cuda.manual_seed(args.seed)
+
+print(args)
+
+# load training and validation datasets
+train_loader = Loader('../Data/' + args.train_file)
+val_loader = Loader('../Data/' + args.val_file)
+
+# create tensors from the datasets as the direct I/O of the networks
+train_event_data, train_chord_data = train_loader.create_event_tensor()
+val_event_data, val_chord_data = val_loader.create_event_tensor()
+
+# the validation worker batchifies the validation set with its own batch size
+val_sources = (val_event_data, val_chord_data)
+
+# divide the tensors into batches
+train_event_data = dp.shard(batchify(train_event_data, args.batch_size))
+train_chord_data = dp.shard(batchify(train_chord_data, args.batch_size))
+val_event_data = dp.shard(batchify(val_event_data, args.batch_size))
+val_chord_data = dp.shard(batchify(val_chord_data, args.batch_size))
+
+# every process trains on its own slice of the batches, from now on batch_size is the size of the slice
+args.batch_size //= dp.world_size()
+
+n_event = Loader.number_of_events()
+n_chords = Loader.number_of_chords()
+
+# the trained teacher only provides the soft targets, it isn't trained any further
+teacher = load_model(args.teacher, args.cuda)
+teacher.cuda() if args.cuda else teacher.cpu()
+teacher.eval()
+for parameter in teacher.parameters():
+    parameter.requires_grad = False
+
+# initialize the network graph of the student
+model = lstm_model(args.event_emsize, args.chord_emsize, n_event, args.nhid, args.layers, n_chords, args.dropout, args.tied, args.cell, args.seq_len, args.softmax)
+dp.broadcast_model(model)
+profiling.time_recurrence(model)
+
+if args.cuda:
+    model.cuda()
+
+# define the loss function
+criterion = nn.CrossEntropyLoss()
+
+
+# Hinton's distillation loss: cross entropy with the softened distribution of the teacher (scaled by T^2, so its
+# gradients don't shrink with the temperature) mixed with the cross entropy of the real next events
+def distillation_loss(output, teacher_output, targets):
+    output = output.view(-1, output.size(2)).float()
+    teacher_output = teacher_output.view(-1, teacher_output.size(2)).float()
+    T = args.distill_temperature
+
+    soft_targets = F.softmax(teacher_output / T, dim=1)
+    soft_loss = -(soft_targets * F.log_softmax(output / T, dim=1)).sum(1).mean() * T * T
+    return args.alpha * soft_loss + (1 - args.alpha) * criterion(output, targets)
+
+# initialize the optimizer
+lr = args.lr
+optimizer = getattr(optim, args.optim)(model.parameters(), lr=lr)
+
+# continue an interrupted training from its full-state checkpoint
+resume_state = None
+if args.resume != '':
+    resume_state = ts.load_training_state(args.resume, model, optimizer)
+    lr = resume_state['lr']
+
+# checkpoints and models are written in the background
+writer = ts.CheckpointWriter()
+
+
+# the loss on the real next events, so the losses of the student and the teacher are comparable
+@profiling.timed('validation')
+def evaluate(event_source, chord_source, net=model):
+    # the running statistics of batch norm differ between processes
+    dp.synchronize_buffers(net)
+    net.eval()
+    net.init_hidden(args.batch_size)
+    total_loss = 0
+
+    for i in range(0, event_source.size(0) - 1, args.seq_len):
+        event_data, targets = get_batch(event_source, i, args, evaluation=True)
+        chord_data = get_batch_without_target(chord_source, i, args, evaluation=True)
+        loss = net.loss(event_data, chord_data, targets, criterion)
+
+        total_loss += len(event_data) * loss.data
+        net.repackage_hidden()
+    return dp.average(float(total_loss) / len(event_source))
+
+
+# milliseconds per generated event, the network is fed one event at a time like in music_generate.py
+def generation_time(net, steps=200):
+    input_event = torch.zeros(1, 1).long()
+    input_chord = torch.zeros(1, 1).long()
+    if args.cuda:
+        input_event = input_event.cuda()
+        input_chord = input_chord.cuda()
+
+    net.eval()
+    net.init_hidden(1)
+    with torch.no_grad():
+        for step in range(steps + 10):
+            # the first steps warm up the allocator
+            if step == 10: start_time = time.time()
+            net.repackage_hidden()
+            net(input_event, input_chord)
+    return (time.time() - start_time) * 1000 / steps
+
+
+def parameters(net):
+    return sum(parameter.numel() for parameter in net.parameters())
+
+
+# the speed and quality trade-off of the student against its teacher
+def report(val_loss, teacher_loss):
+    teacher_time = generation_time(teacher)
+    student_time = generation_time(model)
+
+    print('-' * 89)
+    print('| {:8s} | {:>12s} | {:>10s} | {:>15s} |'.format('model', 'parameters', 'valid loss', 'ms/event (gen)'))
+    print('| {:8s} | {:12d} | {:10.5f} | {:15.3f} |'.format('teacher', parameters(teacher), teacher_loss, teacher_time))
+    print('| {:8s} | {:12d} | {:10.5f} | {:15.3f} |'.format('student', parameters(model), val_loss, student_time))
+    print('| the student generates {:.1f}x faster, its validation loss differs by {:+.5f}'.format(teacher_time / student_time, val_loss - teacher_loss))
+    print('-' * 89)
+
+
+# the training state also keeps the hidden states of the teacher, which continue from the interrupted batch too
+def snapshot(epoch, batch, best_val_loss):
+    state = ts.snapshot(model, optimizer, lr, epoch, batch, best_val_loss)
+    state['teacher_hidden'] = ts.clone_state(teacher.hidden)
+    return state
+
+
+def train(train_log, test_log, start_batch=0):
+    model.train()
+    model.init_hidden(args.batch_size)
+    teacher.init_hidden(args.batch_size)
+    total_loss = 0
+    start_time = time.time()
+
+    # when resuming in the middle of the epoch, continue with the hidden states of the interrupted training
+    if start_batch > 0:
+        teacher.hidden = tuple(h.cuda() if args.cuda else h for h in resume_state['teacher_hidden'])
+        ts.restore_position(model, resume_state, args.cuda)
+
+    #for each batch
+    for batch, i in enumerate(range(0, train_event_data.size(0) - 1, args.seq_len)):
+        # skip the batches trained before resuming
+        if batch < start_batch: continue
+        profiling.step('batch')
+
+        with profiling.phase('get_batch'):
+            event_data, targets = get_batch(train_event_data, i, args, evaluation=False)
+            chord_data = get_batch_without_target(train_chord_data, i, args, evaluation=False)
+
+        # repackage hidden states to not backpropagate into the old ones
+        model.repackage_hidden()
+        teacher.repackage_hidden()
+        optimizer.zero_grad()
+
+        # soft targets of the teacher for the same batch
+        with profiling.phase('teacher'), torch.no_grad(), autocast(args):
+            teacher_output = teacher(event_data, chord_data)
+
+        # forward and backward pass
+        with profiling.phase('forward'), autocast(args):
+            loss = distillation_loss(model(event_data, chord_data), teacher_output, targets)
+        with profiling.phase('backward'):
+            loss.backward()
+
+        # average the gradients of all processes
+        with profiling.phase('all_reduce'):
+            dp.all_reduce_gradients(model)
+
+        # clip gradient and update weights according to it
+        with profiling.phase('clip'):
+            torch.nn.utils.clip_grad_norm(model.parameters(), args.clip)
+        with profiling.phase('optimizer'):
+            optimizer.step()
+
+        total_loss += loss.data
+
+        # log train progress if we are at the right step
+        if batch % args.log_interval == 0 and batch > 0:
+            cur_loss = dp.average(float(total_loss) / args.log_interval)
+            elapsed = time.time() - start_time
+            print('| epoch {:3d} | {:5d}/{:5d} batches | lr {:02.5f} | ms/batch {:5.5f} | events/s {:8.0f} | loss {:5.2f}'.format(
+                epoch, batch, train_event_data.size(0) // args.seq_len, lr,
+                elapsed * 1000 / args.log_interval, args.log_interval * args.seq_len * args.batch_size * dp.world_size() / elapsed, cur_loss))
+
+            total_loss = 0
+            start_time = time.time()
+
+            print(cur_loss, file=train_log, flush=True)
+
+        # evaluate the progress on validation set if we are at the right step
+        if batch % args.val_interval == 0 and batch > 0:
+            if args.val_worker:
+                validation.validate_in_background(validator, model, 'distilled')
+            else:
+                val_loss = evaluate(val_event_data, val_chord_data)
+                print(val_loss, file=test_log, flush=True)
+                if dp.rank() == 0: ts.save_model(writer, model, 'distilled', val_loss, args)
+
+                model.train()
+                model.init_hidden(args.batch_size)
+                teacher.init_hidden(args.batch_size)
+
+        # log the validations finished by the worker
+        if validator is not None: validator.log_results(test_log)
+
+        # write the full training state in the background
+        if (batch + 1) % args.checkpoint_interval == 0:
+            ts.save_training_state(writer, snapshot(epoch, batch + 1, best_val_loss), ts.resume_filename('distilled'))
+
+    profiling.end_step('batch')
+
+
+# at any point you can hit Ctrl + C to break out of training early.
+if __name__ == "__main__":
+    val_loss = None
+    best_val_loss = None if resume_state is None else resume_state['best_val_loss']
+
+    # validation in a separate process on snapshots of the weights, the first rank validates for all of them
+    validator = None
+    if args.val_worker and dp.rank() == 0:
+        validator = validation.ValidationWorker(model, evaluate, val_sources, args.val_batch_size or args.batch_size * dp.world_size(), args, args.val_threads)
+
+    # the teacher is evaluated once, on the same validation set
+    teacher_loss = evaluate(val_event_data, val_chord_data, teacher)
+    print('| teacher valid loss {:5.2f}'.format(teacher_loss))
+
+    with open(dp.log_filename("distilled_train_log_{}".format(datetime.datetime.now().strftime("%Y-%m-%d_%H.%M.%S"))), "w") as train_log:
+        with open(dp.log_filename("distilled_test_log_{}".format(datetime.datetime.now().strftime("%Y-%m-%d_%H.%M.%S"))), "w") as test_log:
+
+            try:
+                start_epoch = 1 if resume_state is None else resume_state['epoch']
+                for epoch in range(start_epoch, args.epochs+1):
+                    epoch_start_time = time.time()
+                    start_batch = resume_state['batch'] if resume_state is not None and epoch == start_epoch else 0
+                    train(train_log, test_log, start_batch)
+                    val_loss = validation.validate_and_wait(validator, model, test_log) if args.val_worker else evaluate(val_event_data, val_chord_data)
+
+                    print('-' * 89)
+                    print('| end of epoch {:3d} | time: {:5.2f}s | valid loss {:5.2f}'.format(epoch, (time.time() - epoch_start_time), val_loss))
+                    print('-' * 89)
+
+                    if dp.rank() == 0: ts.save_model(writer, model, 'distilled', val_loss, args)
+
+                    # decay learning rate
+                    lr /= args.lr_decay
+                    for param_group in optimizer.param_groups:
+                        param_group['lr'] = lr
+
+                    # the next epoch starts from its first batch
+                    ts.save_training_state(writer, snapshot(epoch + 1, 0, best_val_loss), ts.resume_filename('distilled'))
+
+            except KeyboardInterrupt:
+                print('-' * 89)
+                print('Exiting from training early')
+
+            if validator is not None: validator.close(test_log)
+
+    if dp.rank() == 0 and val_loss is not None: report(val_loss, teacher_loss)
+
+    # wait for the checkpoints still being written
+    writer.close()
+
+    # statistics and the timeline of the phases
+    if args.trace != '': profiling.finish(ts.rank_filename(args.trace))
+    dp.cleanup_distributed()
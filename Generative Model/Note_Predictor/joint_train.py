@@ -0,0 +1,277 @@
+import sys
+sys.path.append("../")
+
+import argparse
+import datetime
+import time
+import torch.optim as optim
+
+import data_parallel as dp
+import profiling
+import training_state as ts
+import validation
+from utils import *
+from Note_Predictor.lstm_model import *
+
+parser = argparse.ArgumentParser(description='Generative Model -- Joint Note and Volume Predictor Training')
+
+parser.add_argument('--train_file', type=str, default='', help='name of the file with training data in data folder')
+parser.add_argument('--val_file', type=str, default='', help='name of the file with validation data in data folder')
+parser.add_argument('--batch_size', type=int, default=256, help='batch size (default: 256)')
+parser.add_argument('--cuda', type=bool, default=True, help='use CUDA (default: True)')
+parser.add_argument('--dropout', type=float, default=0.1, help='dropout applied to embedding layers (default: 0.1)')
+parser.add_argument('--clip', type=float, default=0.25, help='gradient clip, -1 means no clip (default: 0.25)')
+parser.add_argument('--epochs', type=int, default=5, help='upper epoch limit (default: 5)')
+parser.add_argument('--event_emsize', type=int, default=800, help='size of event embeddings (default: 800)')
+parser.add_argument('--chord_emsize', type=int, default=12, help='size of chord embeddings (default: 12)')
+parser.add_argument('--layers', type=int, default=3, help='# of layers (default: 3)')
+parser.add_argument('--log_interval', type=int, default=100, help='report interval -- how many steps it takes before logging training progress (default: 100)')
+parser.add_argument('--val_interval', type=int, default=5000, help='validation interval -- how many steps it takes before evaluation on the validation set (default: 5000)')
+parser.add_argument('--lr', type=float, default=0.003, help='initial learning rate (default: 0.003)')
+parser.add_argument('--lr_decay', type=float, default=4, help='learning rate decay after each epoch (default: 4)')
+parser.add_argument('--nhid', type=int, default=800, help='number of hidden units per layer (default: 800)')
+parser.add_argument('--seed', type=int, default=42, help='random seed (default: 42)')
+parser.add_argument('--tied', type=bool, default=True, help='tie the encoder-decoder weights (default: True)')
+parser.add_argument('--optim', type=str, default='Adam', help='optimizer type (default: Adam)')
+parser.add_argument('--seq_len', type=int, default=120, help='total sequence length; how many time steps are unrolled (default: 120)')
+parser.add_argument('--cell', type=str, default='bnlstm', help='type of rnn cell, supported values are "bnlstm" for LSTM with batch norm and "lstm" for standard LSTM cell (default: bnlstm)')
+parser.add_argument('--volume_weight', type=float, default=1.0, help='weight of the volume loss in the sum with the event loss (default: 1.0)')
+parser.add_argument('--softmax', type=str, default='full', help='output layer, supported values are "full" for softmax over all events and "cluster" for softmax over event groups (note-ons or note-offs of an instrument cluster) followed by a softmax over their pitches (default: full)')
+parser.add_argument('--resume', type=str, default='', help='path to a full-state checkpoint (joint-resume.pt) to continue an interrupted training from')
+parser.add_argument('--checkpoint_interval', type=int, default=1000, help='how many steps it takes before writing the full-state checkpoint (default: 1000)')
+parser.add_argument('--val_worker', type=bool, default=False, help='validate snapshots of the weights in a separate process while the training continues, only on CPU (default: False)')
+parser.add_argument('--val_batch_size', type=int, default=0, help='batch size of the validation worker, 0 uses --batch_size (default: 0)')
+parser.add_argument('--val_threads', type=int, default=0, help='torch threads of the validation worker, 0 keeps the default (default: 0)')
+parser.add_argument('--distributed', type=bool, default=False, help='data-parallel CPU training in processes started by torchrun, see data_parallel.py (default: False)')
+parser.add_argument('--threads', type=int, default=0, help='torch threads of every process when training distributed, 0 splits the cores of the node between its processes (default: 0)')
+parser.add_argument('--bf16', type=bool, default=False, help='bfloat16 mixed precision of the forward passes (autocast), the weights, batch norm statistics and optimizer state stay in float32 (default: False)')
+parser.add_argument('--trace', type=str, default='', help='time the phases of the training loop and save their Chrome trace (JSON) into this file, the statistics are saved next to it, see profiling.py')
+args = parser.parse_args()
+
+# join the other processes, when training distributed
+dp.init_distributed(args)
+
+# time the phases of the training loop
+if args.trace != '': profiling.enable()
+
+
+# Set the random seed manually for reproducibility.
+torch.manual_seed(args.seed)
+if torch.cuda.is_available():
+    if not args.cuda:
+        print("WARNING: You have a CUDA device, so you should probably run with --cuda True")
+    else:
+        torch.cuda.manual_seed(args.seed)
+
+print(args)
+
+# load training and validation datasets
+train_loader = Loader('../Data/' + args.train_file)
+val_loader = Loader('../Data/' + args.val_file)
+
+# create tensors from the datasets as the direct I/O of the networks, both heads train on the same streams
+train_event_data, train_chord_data, train_volume_data = train_loader.create_joint_tensor()
+val_event_data, val_chord_data, val_volume_data = val_loader.create_joint_tensor()
+
+# the validation worker batchifies the validation set with its own batch size
+val_sources = (val_event_data, val_chord_data, val_volume_data)
+
+# divide the tensors into batches
+train_event_data = dp.shard(batchify(train_event_data, args.batch_size))
+train_chord_data = dp.shard(batchify(train_chord_data, args.batch_size))
+val_event_data = dp.shard(batchify(val_event_data, args.batch_size))
+val_chord_data = dp.shard(batchify(val_chord_data, args.batch_size))
+train_volume_data = dp.shard(batchify(train_volume_data, args.batch_size))
+val_volume_data = dp.shard(batchify(val_volume_data, args.batch_size))
+
+# every process trains on its own slice of the batches, from now on batch_size is the size of the slice
+args.batch_size //= dp.world_size()
+
+n_event = Loader.number_of_events()
+n_chords = Loader.number_of_chords()
+
+# initialize the network graph
+model = joint_model(args.event_emsize, args.chord_emsize, n_event, args.nhid, args.layers, n_chords, args.dropout, args.tied, args.cell, args.seq_len, args.softmax)
+dp.broadcast_model(model)
+profiling.time_recurrence(model)
+
+if args.cuda:
+    model.cuda()
+
+# define the loss functions
+criterion = nn.CrossEntropyLoss()
+volume_criterion = nn.MSELoss(reduce=False)
+
+# initialize the optimizer
+lr = args.lr
+optimizer = getattr(optim, args.optim)(model.parameters(), lr=lr)
+
+# continue an interrupted training from its full-state checkpoint
+resume_state = None
+if args.resume != '':
+    resume_state = ts.load_training_state(args.resume, model, optimizer)
+    lr = resume_state['lr']
+
+# checkpoints and models are written in the background
+writer = ts.CheckpointWriter()
+
+
+@profiling.timed('validation')
+# the weighted sum of both losses, the losses of the events and the volumes are kept in evaluate.losses
+def evaluate(event_source, chord_source, volume_source):
+    # the running statistics of batch norm differ between processes
+    dp.synchronize_buffers(model)
+    model.eval()
+    model.init_hidden(args.batch_size)
+    total_event_loss = 0
+    total_volume_loss = 0
+    count = 0
+
+    for i in range(0, event_source.size(0) - 1, args.seq_len):
+        event_data, targets = get_batch(event_source, i, args, evaluation=True)
+        chord_data = get_batch_without_target(chord_source, i, args, evaluation=True)
+        volume_targets = get_target_float_batch(volume_source, i, args)
+        event_loss, volume_loss = model.joint_loss(event_data, chord_data, targets, volume_targets, criterion, volume_criterion)
+
+        # the volume loss is averaged over the events with a volume only
+        mask_sum = float((volume_targets.data != -1).sum())
+        total_event_loss += len(event_data) * event_loss.data
+        total_volume_loss += mask_sum * volume_loss.data
+        count += mask_sum
+        model.repackage_hidden()
+
+    evaluate.losses = (dp.average(float(total_event_loss) / len(event_source)), dp.average(float(total_volume_loss) / max(count, 1)))
+    return evaluate.losses[0] + args.volume_weight * evaluate.losses[1]
+
+
+def train(train_log, test_log, start_batch=0):
+    model.train()
+    model.init_hidden(args.batch_size)
+    total_loss = 0
+    total_volume_loss = 0
+    start_time = time.time()
+
+    # when resuming in the middle of the epoch, continue with the hidden states of the interrupted training
+    if start_batch > 0: ts.restore_position(model, resume_state, args.cuda)
+
+    #for each batch
+    for batch, i in enumerate(range(0, train_event_data.size(0) - 1, args.seq_len)):
+        # skip the batches trained before resuming
+        if batch < start_batch: continue
+        profiling.step('batch')
+
+        with profiling.phase('get_batch'):
+            event_data, targets = get_batch(train_event_data, i, args, evaluation=False)
+            chord_data = get_batch_without_target(train_chord_data, i, args, evaluation=False)
+            volume_targets = get_target_float_batch(train_volume_data, i, args)
+
+        # repackage hidden states to not backpropagate into the old ones
+        model.repackage_hidden()
+        optimizer.zero_grad()
+
+        # forward and backward pass
+        with profiling.phase('forward'), autocast(args):
+            event_loss, volume_loss = model.joint_loss(event_data, chord_data, targets, volume_targets, criterion, volume_criterion)
+            loss = event_loss + args.volume_weight * volume_loss
+        with profiling.phase('backward'):
+            loss.backward()
+
+        # average the gradients of all processes
+        with profiling.phase('all_reduce'):
+            dp.all_reduce_gradients(model)
+
+        # clip gradient and update weights according to it
+        with profiling.phase('clip'):
+            torch.nn.utils.clip_grad_norm(model.parameters(), args.clip)
+        with profiling.phase('optimizer'):
+            optimizer.step()
+
+        total_loss += event_loss.data
+        total_volume_loss += volume_loss.data
+
+        # log train progress if we are at the right step
+        if batch % args.log_interval == 0 and batch > 0:
+            cur_loss = dp.average(float(total_loss) / args.log_interval)
+            cur_volume_loss = dp.average(float(total_volume_loss) / args.log_interval)
+            elapsed = time.time() - start_time
+            print('| epoch {:3d} | {:5d}/{:5d} batches | lr {:02.5f} | ms/batch {:5.5f} | events/s {:8.0f} | loss {:5.2f} | volume loss {:5.5f}'.format(
+                epoch, batch, train_event_data.size(0) // args.seq_len, lr,
+                elapsed * 1000 / args.log_interval, args.log_interval * args.seq_len * args.batch_size * dp.world_size() / elapsed, cur_loss, cur_volume_loss))
+
+            total_loss = 0
+            total_volume_loss = 0
+            start_time = time.time()
+
+            print(cur_loss, cur_volume_loss, file=train_log, flush=True)
+
+        # evaluate the progress on validation set if we are at the right step
+        if batch % args.val_interval == 0 and batch > 0:
+            if args.val_worker:
+                validation.validate_in_background(validator, model, 'joint')
+            else:
+                val_loss = evaluate(val_event_data, val_chord_data, val_volume_data)
+                print(val_loss, file=test_log, flush=True)
+                if dp.rank() == 0: ts.save_model(writer, model, 'joint', val_loss, args)
+
+                model.train()
+                model.init_hidden(args.batch_size)
+
+        # log the validations finished by the worker
+        if validator is not None: validator.log_results(test_log)
+
+        # write the full training state in the background
+        if (batch + 1) % args.checkpoint_interval == 0:
+            ts.save_training_state(writer, ts.snapshot(model, optimizer, lr, epoch, batch + 1, best_val_loss), ts.resume_filename('joint'))
+
+    profiling.end_step('batch')
+
+
+# at any point you can hit Ctrl + C to break out of training early.
+if __name__ == "__main__":
+    best_val_loss = None if resume_state is None else resume_state['best_val_loss']
+
+    # validation in a separate process on snapshots of the weights, the first rank validates for all of them
+    validator = None
+    if args.val_worker and dp.rank() == 0:
+        validator = validation.ValidationWorker(model, evaluate, val_sources, args.val_batch_size or args.batch_size * dp.world_size(), args, args.val_threads)
+
+    with open(dp.log_filename("joint_train_log_{}".format(datetime.datetime.now().strftime("%Y-%m-%d_%H.%M.%S"))), "w") as train_log:
+        with open(dp.log_filename("joint_test_log_{}".format(datetime.datetime.now().strftime("%Y-%m-%d_%H.%M.%S"))), "w") as test_log:
+
+            try:
+                start_epoch = 1 if resume_state is None else resume_state['epoch']
+                for epoch in range(start_epoch, args.epochs+1):
+                    epoch_start_time = time.time()
+                    start_batch = resume_state['batch'] if resume_state is not None and epoch == start_epoch else 0
+                    train(train_log, test_log, start_batch)
+                    val_loss = validation.validate_and_wait(validator, model, test_log) if args.val_worker else evaluate(val_event_data, val_chord_data, val_volume_data)
+
+                    print('-' * 89)
+                    print('| end of epoch {:3d} | time: {:5.2f}s | valid loss {:5.2f}'.format(epoch, (time.time() - epoch_start_time), val_loss))
+                    # the losses of the single heads are known only when evaluated in this process
+                    if not args.val_worker:
+                        print('| event loss {:5.2f} | volume loss {:5.5f}'.format(*evaluate.losses))
+                    print('-' * 89)
+
+                    if dp.rank() == 0: ts.save_model(writer, model, 'joint', val_loss, args)
+
+                    # decay learning rate
+                    lr /= args.lr_decay
+                    for param_group in optimizer.param_groups:
+                        param_group['lr'] = lr
+
+                    # the next epoch starts from its first batch
+                    ts.save_training_state(writer, ts.snapshot(model, optimizer, lr, epoch + 1, 0, best_val_loss), ts.resume_filename('joint'))
+
+            except KeyboardInterrupt:
+                print('-' * 89)
+                print('Exiting from training early')
+
+            if validator is not None: validator.close(test_log)
+
+    # wait for the checkpoints still being written
+    writer.close()
+
+    # statistics and the timeline of the phases
+    if args.trace != '': profiling.finish(ts.rank_filename(args.trace))
+    dp.cleanup_distributed()
@@ -4,13 +4,82 @@ sys.path.append("../")
 import torch
 from torch import nn
 from torch.autograd import Variable
+import torch.nn.functional as F
 import bnlstm as bn
+from utils import Loader
+
+
+# output layer factorized along the structure of the events: the head predicts the group of the next event (note-ons
+# or note-offs of one instrument cluster, or one of the three remaining events) and the group predicts the pitch,
+# log p(event) = log p(group) + log p(pitch | group); training needs only the pitches of the target groups, not
+# the whole vocabulary; the pitch weights have one row per event like the full decoder, so they can be tied with
+# the event embedding
+class ClusterSoftmax(nn.Module):
+
+    def __init__(self, hidden_size, events_size):
+        super(ClusterSoftmax, self).__init__()
+        if len(Loader.base_index) == 0: Loader.compute_base_indices()
+
+        # (first event, number of events) of the groups with pitches, the remaining events are classes of the head
+        self.groups = [(Loader.base_index[g], Loader.base_index[g + 1] - Loader.base_index[g]) for g in range(2 * Loader.num_clusters)]
+        self.n_classes = len(self.groups) + events_size - Loader.base_index_space()
+
+        self.head = nn.Linear(hidden_size, self.n_classes)
+        self.weight = nn.Parameter(torch.Tensor(events_size, hidden_size))
+        self.bias = nn.Parameter(torch.Tensor(events_size))
+
+        # class of the head and the pitch inside the group of every event
+        event_class = torch.LongTensor(events_size)
+        event_pitch = torch.zeros(events_size).long()
+        for g, (start, size) in enumerate(self.groups):
+            event_class[start:start + size] = g
+            event_pitch[start:start + size] = torch.arange(size).long()
+        for k, event in enumerate(range(Loader.base_index_space(), events_size)):
+            event_class[event] = len(self.groups) + k
+        self.register_buffer('event_class', event_class)
+        self.register_buffer('event_pitch', event_pitch)
+
+    # exact log-probabilities of all events, (N, hidden_size) -> (N, events_size)
+    def log_prob(self, hidden):
+        head = F.log_softmax(self.head(hidden), 1)
+        logits = F.linear(hidden, self.weight, self.bias)
+
+        parts = [F.log_softmax(logits[:, start:start + size], 1) + head[:, g:g + 1] for g, (start, size) in enumerate(self.groups)]
+        parts.append(head[:, len(self.groups):])
+        return torch.cat(parts, 1)
+
+    # mean negative log-likelihood of the targets, the pitches are computed only for the group of each target
+    def loss(self, hidden, targets):
+        # rows sorted by their class, so the rows of every group are one split (slicing or indexing per group
+        # would create gradients of the size of the whole input and weight for every group)
+        classes = self.event_class[targets]
+        order = torch.sort(classes)[1]
+        classes = classes.index_select(0, order)
+        hidden = hidden.index_select(0, order)
+        counts = torch.bincount(classes, minlength=self.n_classes).tolist()
+
+        head = F.log_softmax(self.head(hidden), 1)
+        nll = -head.gather(1, classes.unsqueeze(1)).sum()
+
+        sizes = [size for _, size in self.groups]
+        sizes.append(self.weight.size(0) - sum(sizes))
+        weights = self.weight.split(sizes)
+        biases = self.bias.split(sizes)
+        hiddens = hidden.split(counts)
+        pitches = self.event_pitch[targets.index_select(0, order)].split(counts)
+
+        for g in range(len(self.groups)):
+            if counts[g] == 0: continue
+            logits = F.linear(hiddens[g], weights[g], biases[g])
+            nll = nll - F.log_softmax(logits, 1).gather(1, pitches[g].unsqueeze(1)).sum()
+
+        return nll / len(targets)
 
 
 # definition of the network graph
 class lstm_model(nn.Module):
 
-    def __init__(self, event_emsize, chord_emsize, events_size, hidden_size, layers, chords_size, dropout, tie_weights, cell, seq_len):
+    def __init__(self, event_emsize, chord_emsize, events_size, hidden_size, layers, chords_size, dropout, tie_weights, cell, seq_len, softmax='full'):
         super(lstm_model, self).__init__()
 
         # dropout applied to embedding layers
@@ -33,8 +102,14 @@ class lstm_model(nn.Module):
         else:
             raise Exception("unknown cell type, please see help for supported cell types")
 
-        # output fully-connected layer
-        self.decoder = nn.Linear(hidden_size, events_size)
+        # output fully-connected layer, or the output layer factorized into groups of events
+        self.softmax = softmax
+        if softmax == 'full':
+            self.decoder = nn.Linear(hidden_size, events_size)
+        elif softmax == 'cluster':
+            self.decoder = ClusterSoftmax(hidden_size, events_size)
+        else:
+            raise Exception("unknown softmax type, please see help for supported softmax types")
 
         # tie weights between event embedding layer and output layer
         if tie_weights:
@@ -60,22 +135,25 @@ class lstm_model(nn.Module):
         self.chord_encoder.weight.data.normal_(0, 0.01)
         self.decoder.bias.data.fill_(0)
         self.decoder.weight.data.normal_(0, 0.01)
+        if self.softmax == 'cluster':
+            self.decoder.head.bias.data.fill_(0)
+            self.decoder.head.weight.data.normal_(0, 0.01)
 
 
     # repackage hidden states to not backpropagate into the old ones
     def __repackage_hidden(self, h):
         """Wraps hidden states in new Variables, to detach them from their history."""
-        if type(h) == Variable:
-            h.detach_()
-        else:
+        if isinstance(h, tuple):
             return tuple(self.__repackage_hidden(v) for v in h)
+        else:
+            h.detach_()
 
     def repackage_hidden(self):
         self.__repackage_hidden(self.hidden)
 
 
-    # forward pass
-    def forward(self, input_event, input_chord):
+    # outputs of the recurrent layers
+    def features(self, input_event, input_chord):
         event_emb = self.drop(self.event_encoder(input_event))
         chord_emb = self.drop(self.chord_encoder(input_chord))
 
@@ -87,7 +165,73 @@ class lstm_model(nn.Module):
         else:
             lstm_out, self.hidden = self.lstm(concated, hx=self.hidden)
 
+        return lstm_out
+
 
-        y = self.decoder(lstm_out.view(lstm_out.size(0) * lstm_out.size(1), lstm_out.size(2)))
+    # outputs of the decoder for the outputs of the recurrent layers, the cluster softmax returns exact
+    # log-probabilities (which work as logits as well)
+    def decode(self, lstm_out):
+        lstm_flat = lstm_out.view(lstm_out.size(0) * lstm_out.size(1), lstm_out.size(2))
+
+        # models saved before the cluster softmax have no softmax attribute
+        if getattr(self, 'softmax', 'full') == 'cluster':
+            y = self.decoder.log_prob(lstm_flat)
+        else:
+            y = self.decoder(lstm_flat)
         return y.view(lstm_out.size(0), lstm_out.size(1), y.size(1))
 
+
+    # forward pass
+    def forward(self, input_event, input_chord):
+        return self.decode(self.features(input_event, input_chord))
+
+
+    # loss of the next events predicted from the outputs of the recurrent layers
+    def event_loss(self, lstm_out, targets, criterion):
+        # the cluster softmax skips the pitches of all groups but the target ones
+        if getattr(self, 'softmax', 'full') == 'cluster':
+            return self.decoder.loss(lstm_out.view(lstm_out.size(0) * lstm_out.size(1), lstm_out.size(2)), targets)
+
+        output = self.decode(lstm_out)
+        return criterion(output.view(-1, output.size(2)), targets)
+
+
+    def loss(self, input_event, input_chord, targets, criterion):
+        return self.event_loss(self.features(input_event, input_chord), targets, criterion)
+
+
+# Note Predictor with a second head, which regresses the volume of the next event from the same recurrent layers,
+# so one network (and one pass over the corpus) replaces the Note and the Volume Predictor
+class joint_model(lstm_model):
+
+    def __init__(self, event_emsize, chord_emsize, events_size, hidden_size, layers, chords_size, dropout, tie_weights, cell, seq_len, softmax='full'):
+        super(joint_model, self).__init__(event_emsize, chord_emsize, events_size, hidden_size, layers, chords_size, dropout, tie_weights, cell, seq_len, softmax)
+
+        # output fully-connected layer of the volumes
+        self.volume_decoder = nn.Linear(hidden_size, 1)
+        self.volume_decoder.bias.data.fill_(0)
+        self.volume_decoder.weight.data.normal_(0, 0.01)
+
+
+    def decode_volume(self, lstm_out):
+        volume = self.volume_decoder(lstm_out.view(lstm_out.size(0) * lstm_out.size(1), lstm_out.size(2)))
+        return volume.view(lstm_out.size(0), lstm_out.size(1))
+
+
+    # outputs of the next event and its volume (meaningful only for note-ons) from one forward pass
+    def forward_with_volume(self, input_event, input_chord):
+        lstm_out = self.features(input_event, input_chord)
+        return self.decode(lstm_out), self.decode_volume(lstm_out)
+
+
+    # loss of the next events and the masked loss of their volumes (events without volume have target -1)
+    def joint_loss(self, input_event, input_chord, targets, volume_targets, criterion, volume_criterion):
+        lstm_out = self.features(input_event, input_chord)
+        event_loss = self.event_loss(lstm_out, targets, criterion)
+
+        volume_loss = volume_criterion(self.decode_volume(lstm_out).view(-1), volume_targets)
+        mask = (volume_targets != -1).float()
+        volume_loss = (volume_loss*mask).sum() / mask.sum().clamp(min=1)
+
+        return event_loss, volume_loss
+
@@ -0,0 +1,192 @@
+import sys
+sys.path.append("../")
+
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import time
+import traceback
+
+from Note_Predictor.music_generate import *
+
+
+# parameters that a single job of the manifest may override, with their types
+JOB_PARAMETERS = {
+    'priming_length': int,
+    'chord_priming_length': int,
+    'max_length': int,
+    'length_beats': float,
+    'length_bars': float,
+    'beats_per_bar': int,
+    'n_primes': int,
+    'temperature': float,
+    'chord_temperature': float,
+    'single_instrument': bool,
+    'seed': int
+}
+
+# predictors loaded by the main process, the forked workers inherit them and share their (read-only) memory pages
+MODELS = {}
+
+
+# a single song to generate: the primer, arguments of the generation and the name of the output file
+class BatchJob:
+
+    def __init__(self, index, primer, args, output):
+        self.index = index
+        self.primer = primer
+        self.args = args
+        self.output = output
+
+
+# a directory is turned into one job per .mus file, a manifest has one JSON object per line,
+# e.g. {"primer": "piano.mus", "temperature": 0.9, "seed": 7, "output": "piano-hot.mus"},
+# paths of primers in a manifest are relative to the manifest
+def read_jobs(path, args):
+    if os.path.isdir(path):
+        entries = [{'primer': os.path.join(path, name)} for name in sorted(os.listdir(path)) if name.endswith('.mus')]
+    else:
+        entries = []
+        with open(path) as f:
+            for line in f:
+                if line.strip() == '' or line.lstrip().startswith('#'): continue
+                entry = json.loads(line)
+                if 'primer' not in entry: raise ValueError("every line of {} needs a 'primer'".format(path))
+                entry['primer'] = os.path.join(os.path.dirname(path), entry['primer'])
+                entries.append(entry)
+
+    jobs = []
+    used_names = set()
+    for index, entry in enumerate(entries):
+        job_args = argparse.Namespace(**vars(args))
+        # every job gets its own seed, so the songs don't depend on the worker which generated them
+        job_args.seed = args.seed + index
+        for key, value in entry.items():
+            if key in JOB_PARAMETERS: setattr(job_args, key, JOB_PARAMETERS[key](value))
+            elif key not in ('primer', 'output'): raise ValueError("unknown job parameter '{}'".format(key))
+
+        name = entry.get('output', os.path.basename(entry['primer']))
+        if name in used_names: name = '{}.{}.mus'.format(os.path.splitext(name)[0], index)
+        used_names.add(name)
+
+        jobs.append(BatchJob(index, entry['primer'], job_args, os.path.join(args.output_folder, name)))
+
+    return jobs
+
+
+def init_worker(threads):
+    torch.set_num_threads(threads)
+
+
+# generate a single song in a worker, failures are reported instead of raised so that the other jobs continue
+def run_job(job):
+    start_time = time.time()
+    report = {'index': job.index, 'primer': job.primer, 'output': job.output, 'worker': os.getpid(), 'events': 0, 'error': None}
+
+    try:
+        torch.manual_seed(job.args.seed)
+        # the generating functions print their progress, which would only interleave between the workers
+        with torch.no_grad(), contextlib.redirect_stdout(io.StringIO()):
+            result = generate_music(job.args, job.primer, MODELS['note'], MODELS['chord'], MODELS['volume'])
+
+        with open(job.output, 'wb') as f:
+            f.write(result_to_bytes(result))
+        report['events'] = len(result)
+    except Exception as e:
+        report['error'] = '{}: {}'.format(type(e).__name__, e)
+        report['traceback'] = traceback.format_exc()
+
+    report['time'] = time.time() - start_time
+    return report
+
+
+# generate all jobs with a pool of forked workers, yields the report of every job as soon as it is finished
+def generate_batch(args, jobs):
+    MODELS['note'] = load_predictor(args.note_model, args)
+    MODELS['chord'] = load_predictor(args.chord_model, args) if args.chord_model != '' else ''
+    MODELS['volume'] = load_predictor(args.volume_model, args) if args.volume_model != '' else ''
+    for model in MODELS.values():
+        if not isinstance(model, str): model.eval()
+
+    # start with the longest primers, so that no long job is left alone at the end of the batch
+    jobs = sorted(jobs, key=lambda job: -os.path.getsize(job.primer) if os.path.isfile(job.primer) else 0)
+
+    context = multiprocessing.get_context('fork')
+    with context.Pool(args.workers, initializer=init_worker, initargs=(args.threads,)) as pool:
+        for report in pool.imap_unordered(run_job, jobs, chunksize=1):
+            yield report
+
+
+def summarize(reports, workers, elapsed):
+    succeeded = [report for report in reports if report['error'] is None]
+    busy = sum(report['time'] for report in reports)
+    events = sum(report['events'] for report in succeeded)
+
+    return {
+        'jobs': len(reports),
+        'succeeded': len(succeeded),
+        'failed': len(reports) - len(succeeded),
+        'workers': workers,
+        'wall_time_s': elapsed,
+        'busy_time_s': busy,
+        'events': events,
+        'events_per_second': events / max(elapsed, 1e-9),
+        # how much of the time of all workers was spent generating
+        'worker_utilization': busy / max(elapsed * workers, 1e-9),
+        'reports': sorted(reports, key=lambda report: report['index'])
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generative Model -- Note Predictor Batch Generating')
+    parser.add_argument('--primers', type=str, default='../Primers/', help='directory of primers (every .mus file is one job) or a manifest with one JSON job per line')
+    parser.add_argument('--note_model', type=str, default='music-model.loss_0.880.pt', help='path to trained model')
+    parser.add_argument('--chord_model', type=str, default='../Chord_Predictor/chord-model.loss_0.54380.pt', help='path to the chord model, when left empty, chords in the original song are used')
+    parser.add_argument('--volume_model', type=str, default='../Volume_Predictor/volume-model.loss_0.02557.pt', help='path to the volume model, when left empty, no volume dynamics is used')
+    parser.add_argument('--workers', type=int, default=0, help='number of worker processes, 0 uses all cores divided by --threads (default: 0)')
+    parser.add_argument('--threads', type=int, default=1, help='number of torch threads of every worker (default: 1)')
+    parser.add_argument('--priming_length', type=int, default=400, help='default number of events primed from the input (default: 400)')
+    parser.add_argument('--chord_priming_length', type=int, default=20, help='default number of events primed from the input for Chord Predictor (default: 20)')
+    parser.add_argument('--max_length', type=int, default=10000, help='default maximal length of the generated sequence (default: 10000)')
+    parser.add_argument('--length_beats', type=float, default=0, help='default musical length of the song in beats, the generating stops as soon as it is reached, 0 uses only max_length (default: 0)')
+    parser.add_argument('--length_bars', type=float, default=0, help='default musical length of the song in bars, used when --length_beats is 0 (default: 0)')
+    parser.add_argument('--beats_per_bar', type=int, default=4, help='default beats in a bar of --length_bars (default: 4)')
+    parser.add_argument('--temperature', type=float, default=0.95, help='default temperature of the Note Predictor (default: 0.95)')
+    parser.add_argument('--chord_temperature', type=float, default=1.00, help='default temperature of the Chord Predictor (default: 1.00)')
+    parser.add_argument('--n_primes', type=int, default=2, help="default number of times we feed forward the whole primer (default: 2)")
+    parser.add_argument('--single_instrument', type=bool, default=False, help="default for generating only single-instrumental music (default: False)")
+    parser.add_argument('--output_folder', type=str, default="../Samples/")
+    parser.add_argument('--seed', type=int, default=42, help='random seed of the first job, the following jobs use the next seeds (default: 42)')
+    parser.add_argument('--lookup_tables', type=bool, default=False, help='replace the first recurrent layer input projection by precomputed lookup tables (default: False)')
+    parser.add_argument('--profile', type=str, default='', help='autotuning profile applied to the tuned models (except for the threads) (see autotune.py), empty uses the profile of this machine, "none" disables it')
+    parser.add_argument('--quantize', type=bool, default=False, help='use int8 dynamic quantization of the predictors for faster CPU inference (default: False)')
+    args = parser.parse_args()
+
+    # the batch is spread over CPU cores, a GPU is better used by the batched music_server.py
+    args.cuda = False
+    if args.workers <= 0: args.workers = max(1, (os.cpu_count() or 1) // args.threads)
+
+    jobs = read_jobs(args.primers, args)
+    if not os.path.isdir(args.output_folder): os.makedirs(args.output_folder)
+    print('generating {} songs with {} workers, {} threads each'.format(len(jobs), args.workers, args.threads))
+
+    start_time = time.time()
+    reports = []
+    for report in generate_batch(args, jobs):
+        reports.append(report)
+        status = 'failed: ' + report['error'] if report['error'] is not None else 'saved as ' + report['output']
+        print('| {:4d}/{:4d} | {:40s} | {:6d} events | {:8.2f} s | {}'.format(
+            len(reports), len(jobs), os.path.basename(report['primer'])[:40], report['events'], report['time'], status))
+
+    summary = summarize(reports, args.workers, time.time() - start_time)
+    with open(os.path.join(args.output_folder, 'batch_summary.json'), 'w') as f:
+        json.dump(summary, f, indent=1)
+
+    print('-' * 89)
+    print('| {} succeeded | {} failed | wall time {:8.2f} s | {:8.1f} events/s | worker utilization {:5.1%}'.format(
+        summary['succeeded'], summary['failed'], summary['wall_time_s'], summary['events_per_second'], summary['worker_utilization']))
+    print('-' * 89)
+
+    if summary['failed'] > 0: sys.exit(1)
@@ -1,165 +1,356 @@
 import sys
 sys.path.append("../")
 
+import copy
+import os
+
 from Chord_Predictor.chord_generate import *
 from Volume_Predictor.volume_generate import *
+from autotune import load_tuned_model
+import profiling
 from utils import *
 
 
+# load a predictor and apply the requested inference transforms together with the ones found by autotune.py,
+# the threads are set only by the predictor which runs the most steps
+def load_predictor(filename, args, batch_size=1, set_threads=False, adapter=''):
+    return load_tuned_model(filename, args.cuda, args.lookup_tables, args.quantize, batch_size, set_threads, getattr(args, 'profile', ''), adapter)
 
-parser = argparse.ArgumentParser(description='Generative Model -- Note Predictor Generating')
-parser.add_argument('--note_model', type=str, default='music-model.loss_0.880.pt', help='path to trained model')
-parser.add_argument('--primer', type=str, default="Nirvana - Lithium.mus", help='name of the priming song')
-parser.add_argument('--priming_length', type=int, default=400, help='number of events primed from the input (default: 400)')
-parser.add_argument('--chord_priming_length', type=int, default=20, help='number of events primed from the input for Chord Predictor (default: 20)')
-parser.add_argument('--cuda', type=bool, default=False, help='use CUDA (default: False)')
-parser.add_argument('--max_length', type=int, default=10000, help='maximal length of the generated sequence (default: 10000)')
-parser.add_argument('--temperature', type=float, default=0.95, help='temperature -- certainty of the prediction (default: 0.95)')
-parser.add_argument('--chord_temperature', type=float, default=1.00, help='temperature -- certainty of the prediction for Chord Predictor (default: 1.00)')
-parser.add_argument('--chord_model', type=str, default='../Chord_Predictor/chord-model.loss_0.54380.pt', help='path to the chord model, when left empty, chords in the original song are used')
-parser.add_argument('--volume_model', type=str, default='../Volume_Predictor/volume-model.loss_0.02557.pt', help='path to the volume model, when left empty, no volume dynamics is used')
-parser.add_argument('--n_primes', type=int, default=2, help="how many times do we feed forward the whole primer (default: 1)")
-parser.add_argument('--single_instrument', type=bool, default=False, help="filter output to generate only single-instrumental music? (default: False)")
-parser.add_argument('--output_folder', type=str, default="../Samples/")
-parser.add_argument('--seed', type=int, default=42, help='random seed (default: 42)')
-args = parser.parse_args()
-
-
-# Set the random seed manually for reproducibility.
-if torch.cuda.is_available():
-    if not args.cuda:
-        print("WARNING: You have a CUDA device, so you should probably run with --cuda True")
-    else:
-        torch.cuda.manual_seed(args.seed)
 
+# musical length of the requested song in twelfths of a beat (the unit of the time shifts), None when only
+# max_length limits the song
+def target_ticks(args):
+    beats = getattr(args, 'length_beats', 0) or getattr(args, 'length_bars', 0) * getattr(args, 'beats_per_bar', 4)
+    return int(round(beats * 12)) if beats > 0 else None
 
-def generate_music(args, primer):
-    model = torch.load(args.note_model)
 
-    loader = Loader(primer)
-    event_tensor, _ = loader.create_event_tensor()
-    chord_tensor = loader.create_chord_tensor()
+# song time of the events in twelfths of a beat, only the time shifts move it
+def event_ticks(event_tensor):
+    return int((event_tensor == Loader.base_index_space()).sum()) + 6 * int((event_tensor == Loader.base_index_space() + 1).sum())
 
-    # use chord predictor to generate chords if specified
-    if args.chord_model != '':
-        print("Generating chords")
-        generated_chords = generate_chords(args.chord_model, primer, args.cuda, priming_length=args.chord_priming_length, n_primes=args.n_primes, temperature=args.chord_temperature)
 
-    # original chords used for priming
-    chords = chord_tensor
-    input_size = len(event_tensor)
+# the generated events in preallocated tensors instead of a list of tuples, 7 bytes per event; indexing and
+# iterating give the (event, chord, volume) tuples of the former list, so the song is used the same way
+class SongBuffer:
 
-    print("Generating notes")
+    def __init__(self, capacity):
+        capacity = max(capacity, 1)
+        self.events = torch.ShortTensor(capacity)
+        self.chords = torch.ByteTensor(capacity)
+        self.volumes = torch.FloatTensor(capacity)
+        self.length = 0
 
-    output = event_tensor[0]
-    # contains [event, chord, volume]
-    result = [(output, 0, 0.5)]
+    def __len__(self):
+        return self.length
 
-    # wrapping scalars into tensors, so they can be put into the network
-    input_event = Variable(torch.LongTensor(1, 1))
-    input_chord = Variable(torch.LongTensor(1, 1))
-    input_event[0, 0] = output
-    input_chord[0, 0] = 0
+    def __getitem__(self, i):
+        if isinstance(i, slice): return [self[j] for j in range(*i.indices(self.length))]
+        if i < 0: i += self.length
+        if i < 0 or i >= self.length: raise IndexError('song index out of range')
+        return int(self.events[i]), int(self.chords[i]), float(self.volumes[i])
 
-    if args.cuda:
-        input_event = input_event.cuda()
-        input_chord = input_chord.cuda()
-        model.cuda()
-    else:
-        model.cpu()
+    def __iter__(self):
+        for i in range(self.length):
+            yield self[i]
+
+    def append(self, item):
+        # a song longer than its estimate doubles the capacity
+        if self.length == len(self.events): self.resize(2 * len(self.events))
 
-    # set state of the model to evaluation and initialize hidden states
-    model.eval()
-    model.init_hidden(1)
+        event, chord, volume = item
+        self.events[self.length] = int(event)
+        self.chords[self.length] = int(chord)
+        self.volumes[self.length] = float(volume)
+        self.length += 1
 
-    time = 0
+    def resize(self, capacity):
+        for name in ('events', 'chords', 'volumes'):
+            old = getattr(self, name)
+            new = old.new(capacity)
+            new[:self.length] = old[:self.length]
+            setattr(self, name, new)
 
-    # capture the right instrument when generating single-instrument music
-    instrument_cluster = None
+    def copy(self):
+        song = SongBuffer(len(self.events))
+        for name in ('events', 'chords', 'volumes'):
+            getattr(song, name)[:self.length] = getattr(self, name)[:self.length]
+        song.length = self.length
+        return song
 
-    # feed forward the whole network with primer and then generate new music of maximal length args.max_length
-    for i in range(args.n_primes*input_size + args.max_length):
-        model.repackage_hidden()
+
+# state of a single generated song, the network is fed one event at a time and the stream decides what comes next
+class MusicStream:
+
+    def __init__(self, event_tensor, chord_tensor, generated_chords, args):
+        self.event_tensor = event_tensor
+        self.generated_chords = generated_chords
+        self.input_size = len(event_tensor)
+
+        self.n_primes = args.n_primes
+        self.priming_length = args.priming_length
+        self.max_length = args.max_length
+        self.temperature = args.temperature
+        self.single_instrument = args.single_instrument
+
+        # the song ends as soon as the generated music (after the replayed primer events) reaches its length
+        self.target_ticks = target_ticks(args)
+        self.replay_end_time = None
+
+        # original chords used for priming
+        self.chords = chord_tensor
+
+        # current input of the network
+        self.event = event_tensor[0]
+        self.chord = 0
+
+        # contains [event, chord, volume], preallocated for the events expected in the requested length (at the
+        # rate of events per time of the primer), at most for max_length events
+        self.result = SongBuffer(self.expected_length())
+        self.result.append((self.event, 0, 0.5))
+
+        self.step = 0
+        self.time = 0
+        self.finished = self.n_primes*self.input_size + self.max_length <= 0
+
+        # capture the right instrument when generating single-instrument music
+        self.instrument_cluster = None
+
+        # random generator used for sampling, the global one when None
+        self.generator = None
+
+    # number of events of the replayed primer events and the generated music of the requested length
+    def expected_length(self):
+        if self.target_ticks is None: return min(self.max_length + 1, 4096)
+
+        events_per_tick = self.input_size / max(event_ticks(self.event_tensor), 1)
+        return min(self.max_length + 1, self.priming_length + int(1.25 * events_per_tick * self.target_ticks) + 16)
+
+    # an independent copy of the stream that continues from the same point
+    def fork(self, generator=None):
+        stream = copy.copy(self)
+        stream.result = self.result.copy()
+        stream.generator = generator
+        return stream
+
+    # don't generate anything while priming, just feed the network to set its hidden states
+    def is_priming(self):
+        return self.step < self.n_primes*self.input_size + self.priming_length
+
+    # select a random event from the (unnormalized) network output
+    def sample(self, output):
+        output = output.double().div(self.temperature).exp_()
+
+        # mask the output if we want to generate single-instrumental music
+        if self.single_instrument:
+            output[:Loader.base_index_on(self.instrument_cluster)] = 0
+            output[Loader.base_index_on(self.instrument_cluster + 1):Loader.base_index_off(0)] = 0
+
+        output = output.div_(torch.sum(output))
+        return torch.multinomial(output, 1, generator=self.generator)[0]
+
+    # consume the network output for the current input and prepare the next input, the volume is the predicted
+    # volume of the generated event (the joint model predicts it together with the event)
+    def advance(self, output, volume=0.5):
+        i = self.step
+        self.step += 1
 
         # when we get the first note, assign its instrument to the instrument_cluster variable
-        if instrument_cluster == None and input_event.data[0,0] < Loader.base_index_off(0):
+        if self.instrument_cluster == None and self.event < Loader.base_index_off(0):
             for cluster in range(Loader.num_clusters):
-                if input_event.data[0,0] < Loader.base_index_on(cluster + 1):
-                    instrument_cluster = cluster
+                if self.event < Loader.base_index_on(cluster + 1):
+                    self.instrument_cluster = cluster
                     break
 
-        # don't generate anything, just feed the network to set its hidden states
-        if i < args.n_primes*input_size + args.priming_length:
-            _ = model(input_event, input_chord)
-            output = event_tensor[(i + 1) % input_size]
-
-        # else generate new events
+        if i < self.n_primes*self.input_size + self.priming_length:
+            output = self.event_tensor[(i + 1) % self.input_size]
         else:
-            # generate probability distribution over all events
-            output = model(input_event, input_chord)
-            output = torch.squeeze(output.data.double().div_(args.temperature).exp_())
-
-            # mask the output if we want to generate single-instrumental music
-            if args.single_instrument:
-                for j in range(len(output)):
-                    if j < Loader.base_index_on(instrument_cluster) or (j >= Loader.base_index_on(instrument_cluster + 1) and j < Loader.base_index_off(0)):
-                        output[j] = 0
-
-            # select a random event from the distribution
-            output = output.div_(torch.sum(output))
-            output = torch.multinomial(output, 1)[0]
+            output = self.sample(output)
 
         # if we are at the start of the song
-        if i > 0 and (i % input_size) == 0 and i <= args.n_primes*input_size:
-            time = 0
+        if i > 0 and (i % self.input_size) == 0 and i <= self.n_primes*self.input_size:
+            self.time = 0
 
-            # if we want to generate chords and the priming hac just ended, use the generated chords
-            if args.chord_model != '' and i == args.n_primes*input_size:
-                chords = generated_chords
+            # if we want to generate chords and the priming has just ended, use the generated chords
+            if self.generated_chords is not None and i == self.n_primes*self.input_size:
+                self.chords = self.generated_chords
+
+        # the replayed primer events end here, the requested length counts only the generated music
+        if i == self.n_primes*self.input_size + self.priming_length:
+            self.replay_end_time = self.time
 
         # shift the time if time-shift event was generated
-        if output == Loader.base_index_space(): time += 1
-        elif output == Loader.base_index_space() + 1: time += 6
+        if output == Loader.base_index_space(): self.time += 1
+        elif output == Loader.base_index_space() + 1: self.time += 6
 
         # for safety, end the generating if we don't have any remaining chords
-        if (time + 11) // 12 > len(chords) - 1:
-            break
-        # else, choose the right chor occuring in the next beat
-        else:
-            input_chord[0, 0] = chords[(time + 11) // 12]
+        if (self.time + 11) // 12 > len(self.chords) - 1:
+            self.finished = True
+            return
 
-        # last event is the new input
-        input_event[0, 0] = output
+        # else, choose the right chord occuring in the next beat and use the last event as the new input
+        self.chord = self.chords[(self.time + 11) // 12]
+        self.event = output
 
-        # if we are still priming, just continue the loop
-        if i < args.n_primes*input_size: continue
+        if self.step >= self.n_primes*self.input_size + self.max_length:
+            self.finished = True
+
+        # if we are still priming, just continue
+        if i < self.n_primes*self.input_size: return
 
         # if we encounter the "stop" chord, end
-        if input_chord.data[0, 0] == 24: break
+        if self.chord == 24:
+            self.finished = True
+            return
 
         # else append the generated event to result
-        result.append((output, input_chord.data[0,0], 0.5))
+        self.result.append((output, self.chord, volume))
 
-    # assign volumes to each event
-    if args.volume_model != '':
-        print("Generating volumes")
+        # stop when the generated music is long enough
+        if self.target_ticks is not None and self.replay_end_time is not None and self.time - self.replay_end_time >= self.target_ticks:
+            self.finished = True
 
-        notes = [event[0] for event in result]
-        volumes = generate_volumes(args.volume_model, primer, args.cuda, args.priming_length, args.n_primes, notes)
-        return [(result[i][0], result[i][1], volumes[i]) for i in range(len(volumes))]
 
+# load the primer and generate its chords, everything the note predictor needs to start a new stream
+def create_stream(args, primer, chord_model=None):
+    loader = Loader(primer)
+    event_tensor, _ = loader.create_event_tensor()
+    chord_tensor = loader.create_chord_tensor()
 
+    # use chord predictor to generate chords if specified, one chord per beat is enough for a song of known length
+    generated_chords = None
+    if chord_model is None: chord_model = load_predictor(args.chord_model, args) if args.chord_model != '' else ''
+    if not isinstance(chord_model, str) or chord_model != '':
+        print("Generating chords")
+        # the chords cover the replayed primer events and the requested length after them
+        ticks = target_ticks(args)
+        if ticks is not None: ticks += event_ticks(event_tensor[:args.priming_length + 1])
+        max_chords = 1000 if ticks is None else max(ticks // 12 + 2, args.chord_priming_length + 2)
+        # generate_chords looks for the primer in ../Primers/, the relative path also works for primers anywhere else
+        generated_chords = generate_chords(chord_model, os.path.relpath(primer, "../Primers/"), args.cuda, priming_length=args.chord_priming_length, max_length=max_chords, n_primes=args.n_primes, temperature=args.chord_temperature)
+
+    return MusicStream(event_tensor, chord_tensor, generated_chords, args)
+
+
+# assign volumes to each event of a finished stream
+def assign_volumes(args, primer, result, volume_model=None):
+    if volume_model is None: volume_model = load_predictor(args.volume_model, args) if args.volume_model != '' else ''
+    if isinstance(volume_model, str) and volume_model == '':
+        return result
+
+    print("Generating volumes")
+
+    notes = result.events[:len(result)] if isinstance(result, SongBuffer) else [event[0] for event in result]
+    volumes = generate_volumes(volume_model, primer, args.cuda, args.priming_length, args.n_primes, notes)
+    if isinstance(result, SongBuffer):
+        result.volumes[:len(volumes)] = torch.FloatTensor([float(volume) for volume in volumes])
+        return result
+    return [(result[i][0], result[i][1], volumes[i]) for i in range(len(volumes))]
+
+
+# the replayed primer events of a song generated by a joint model keep the real volumes of the primer (as in
+# generate_volumes), the predicted ones are used only for the generated music
+def replay_primer_volumes(args, primer, result):
+    _, volume_tensor = Loader(primer).create_volume_tensor()
+    # the replayed events wrap around a primer shorter than priming_length
+    n = min(args.priming_length + 1, len(result))
+    result.volumes[:n] = volume_tensor[torch.arange(n) % len(volume_tensor)]
     return result
 
 
+# generate a whole song, the predictors are loaded from args unless already loaded networks are given; a joint
+# model (see joint_train.py) predicts the volumes in the same step as the events, so no volume model is needed
+def generate_music(args, primer, model=None, chord_model=None, volume_model=None):
+    if model is None: model = load_predictor(args.note_model, args, set_threads=True, adapter=getattr(args, 'adapter', ''))
+    stream = create_stream(args, primer, chord_model)
+
+    print("Generating notes")
+
+    # wrapping scalars into tensors, so they can be put into the network
+    input_event = Variable(torch.LongTensor(1, 1))
+    input_chord = Variable(torch.LongTensor(1, 1))
+
+    if args.cuda:
+        input_event = input_event.cuda()
+        input_chord = input_chord.cuda()
+        model.cuda()
+    else:
+        model.cpu()
+
+    # set state of the model to evaluation and initialize hidden states
+    model.eval()
+    model.init_hidden(1)
+    joint = hasattr(model, 'forward_with_volume')
+
+    # feed forward the whole network with primer and then generate new music of maximal length args.max_length
+    while not stream.finished:
+        profiling.step('step')
+        model.repackage_hidden()
+
+        input_event[0, 0] = stream.event
+        input_chord[0, 0] = stream.chord
+
+        # generate probability distribution over all events (and the volume of the next event)
+        with profiling.phase('forward'):
+            if joint:
+                output, volume = model.forward_with_volume(input_event, input_chord)
+            else:
+                output = model(input_event, input_chord)
+        with profiling.phase('sampling'):
+            if joint:
+                stream.advance(output.data[0, 0], min(max(float(volume.data[0, 0]), 0.0), 1.0))
+            else:
+                stream.advance(output.data[0, 0])
+
+    profiling.end_step('step')
+    if joint: return replay_primer_volumes(args, primer, stream.result)
+    return assign_volumes(args, primer, stream.result, volume_model)
+
+
+# serialize the generated events into the .mus format
+def result_to_bytes(result):
+    return b''.join(bytes(Loader.output_to_bytes(event, chord, volume)) for event, chord, volume in result)
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generative Model -- Note Predictor Generating')
+    parser.add_argument('--note_model', type=str, default='music-model.loss_0.880.pt', help='path to trained model')
+    parser.add_argument('--adapter', type=str, default='', help='low-rank adapter of a style trained by adapter_train.py for the note model, merged into it when loading')
+    parser.add_argument('--primer', type=str, default="Nirvana - Lithium.mus", help='name of the priming song')
+    parser.add_argument('--priming_length', type=int, default=400, help='number of events primed from the input (default: 400)')
+    parser.add_argument('--chord_priming_length', type=int, default=20, help='number of events primed from the input for Chord Predictor (default: 20)')
+    parser.add_argument('--cuda', type=bool, default=False, help='use CUDA (default: False)')
+    parser.add_argument('--max_length', type=int, default=10000, help='maximal length of the generated sequence (default: 10000)')
+    parser.add_argument('--length_beats', type=float, default=0, help='musical length of the song in beats, the generating stops as soon as it is reached, 0 uses only max_length (default: 0)')
+    parser.add_argument('--length_bars', type=float, default=0, help='musical length of the song in bars, used when --length_beats is 0 (default: 0)')
+    parser.add_argument('--beats_per_bar', type=int, default=4, help='beats in a bar of --length_bars (default: 4)')
+    parser.add_argument('--temperature', type=float, default=0.95, help='temperature -- certainty of the prediction (default: 0.95)')
+    parser.add_argument('--chord_temperature', type=float, default=1.00, help='temperature -- certainty of the prediction for Chord Predictor (default: 1.00)')
+    parser.add_argument('--chord_model', type=str, default='../Chord_Predictor/chord-model.loss_0.54380.pt', help='path to the chord model, when left empty, chords in the original song are used')
+    parser.add_argument('--volume_model', type=str, default='../Volume_Predictor/volume-model.loss_0.02557.pt', help='path to the volume model, when left empty, no volume dynamics is used (not used with a joint note model)')
+    parser.add_argument('--n_primes', type=int, default=2, help="how many times do we feed forward the whole primer (default: 1)")
+    parser.add_argument('--single_instrument', type=bool, default=False, help="filter output to generate only single-instrumental music? (default: False)")
+    parser.add_argument('--output_folder', type=str, default="../Samples/")
+    parser.add_argument('--seed', type=int, default=42, help='random seed (default: 42)')
+    parser.add_argument('--lookup_tables', type=bool, default=False, help='replace the first recurrent layer input projection by precomputed lookup tables (default: False)')
+    parser.add_argument('--profile', type=str, default='', help='autotuning profile applied to the tuned models (see autotune.py), empty uses the profile of this machine, "none" disables it')
+    parser.add_argument('--quantize', type=bool, default=False, help='use int8 dynamic quantization of the predictors for faster CPU inference (default: False)')
+    parser.add_argument('--trace', type=str, default='', help='time the phases of the generating loop and save their Chrome trace (JSON) into this file, the statistics are saved next to it, see profiling.py')
+    args = parser.parse_args()
+
+    # Set the random seed manually for reproducibility.
+    if torch.cuda.is_available():
+        if not args.cuda:
+            print("WARNING: You have a CUDA device, so you should probably run with --cuda True")
+        else:
+            torch.cuda.manual_seed(args.seed)
+
+    if args.trace != '': profiling.enable()
 
     primer = "../Primers/{}".format(args.primer)
     output = generate_music(args, primer)
 
     filename = args.output_folder + args.primer
     with open(filename, 'wb') as f:
-        for pair in output:
-            a,b,c,d = Loader.output_to_bytes(pair[0], pair[1], pair[2])
-            f.write(bytes([a,b,c,d]))
-    print('saved as ' + filename)
\ No newline at end of file
+        f.write(result_to_bytes(output))
+    print('saved as ' + filename)
+    profiling.finish(args.trace)
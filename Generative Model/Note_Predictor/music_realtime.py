@@ -0,0 +1,312 @@
+import sys
+sys.path.append("../")
+
+import contextlib
+import json
+import queue
+import threading
+import time
+
+from Note_Predictor.music_generate import *
+
+
+# song time of an event in twelfths of a beat, only the time-shift events move the time (like in MusicStream)
+def shift_ticks(event):
+    if event == Loader.base_index_space(): return 1
+    if event == Loader.base_index_space() + 1: return 6
+    return 0
+
+
+# predicts the volume of every generated event as soon as it is generated, the same way as generate_volumes does
+# for a whole song: the network is primed by the primer, the first priming_length volumes are taken from it
+class VolumeFollower:
+
+    def __init__(self, model, primer, args):
+        self.model = model.cuda() if args.cuda else model.cpu()
+        self.model.eval()
+        self.cuda = args.cuda
+        self.priming_length = args.priming_length
+        self.input = torch.LongTensor(1, 1).cuda() if args.cuda else torch.LongTensor(1, 1)
+
+        self.primer_events, self.primer_volumes = Loader(primer).create_volume_tensor()
+        self.index = 0
+
+        self.model.init_hidden(1)
+        with torch.no_grad():
+            for _ in range(args.n_primes):
+                for event in self.primer_events:
+                    self.forward(event)
+
+    def forward(self, event):
+        self.model.repackage_hidden()
+        self.input[0, 0] = int(event)
+        return self.model(self.input)
+
+    def volume(self, event):
+        with torch.no_grad():
+            output = self.forward(event)
+
+        i = self.index
+        self.index += 1
+        if i < self.priming_length: return float(self.primer_volumes[i % len(self.primer_volumes)])
+        return float(output.data[0, 0, 0])
+
+
+# an event waiting in the lookahead buffer, its time is in twelfths of a beat from the start of the song
+class ScheduledEvent:
+
+    def __init__(self, event, chord, volume, ticks, generated_at):
+        self.event = event
+        self.chord = chord
+        self.volume = volume
+        self.ticks = ticks
+        self.generated_at = generated_at
+
+
+# where the played events go: the .mus records of the events (a player can read them from a pipe) or text lines
+class EventSink:
+
+    def __init__(self, path, format='mus'):
+        self.format = format
+        if path == '-':
+            self.f = sys.stdout.buffer if format == 'mus' else sys.stdout
+            self.close_file = False
+        else:
+            # a named pipe blocks here until a reader opens it
+            self.f = open(path, 'wb' if format == 'mus' else 'w')
+            self.close_file = True
+
+    def write(self, item, playback_time):
+        if self.format == 'mus':
+            self.f.write(bytes(Loader.output_to_bytes(item.event, item.chord, item.volume)))
+        else:
+            self.f.write('{:.4f} {} {} {:.4f}\n'.format(playback_time, int(item.event), int(item.chord), item.volume))
+        self.f.flush()
+
+    def close(self):
+        if self.close_file: self.f.close()
+
+
+# latencies of the played events and the underruns, an underrun is a run of events generated only after their time
+class RealtimeStats:
+
+    def __init__(self):
+        self.latencies = []
+        self.headroom = []
+        self.late_events = 0
+        self.underruns = 0
+        self.late = False
+
+    def add(self, latency, headroom):
+        self.latencies.append(latency)
+        self.headroom.append(headroom)
+        if headroom < 0:
+            self.late_events += 1
+            if not self.late: self.underruns += 1
+        self.late = headroom < 0
+
+    def percentile(self, values, p):
+        if len(values) == 0: return None
+        return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+    def report(self, duration, generated):
+        latencies = sorted(self.latencies)
+        headroom = sorted(self.headroom)
+        return {
+            'events': len(self.latencies),
+            'generated': generated,
+            'duration_s': duration,
+            'underruns': self.underruns,
+            'late_events': self.late_events,
+            'latency_ms': {'p{}'.format(p): None if self.percentile(latencies, p) is None else 1000 * self.percentile(latencies, p) for p in (50, 90, 99, 100)},
+            'headroom_ms': {'p{}'.format(p): None if self.percentile(headroom, p) is None else 1000 * self.percentile(headroom, p) for p in (0, 1, 10, 50)}
+        }
+
+
+# generates the song in a background thread at most `lookahead` beats ahead of the playback and plays the
+# events on the sink at their times; the playback clock never waits, events generated too late are played at once
+class RealtimeSession:
+
+    def __init__(self, model, stream, volume_follower, sink, tempo, lookahead, cuda=False, primer_volumes=None):
+        self.model = model.cuda() if cuda else model.cpu()
+        self.model.eval()
+        self.cuda = cuda
+        self.joint = hasattr(model, 'forward_with_volume')
+        self.stream = stream
+        self.volume_follower = volume_follower
+        # the volumes of the primer, which a joint model plays on the replayed primer events (as generate_music)
+        self.primer_volumes = primer_volumes
+        self.sink = sink
+
+        self.tick_seconds = 60.0 / (tempo * 12)
+        self.lookahead = lookahead * 12 * self.tick_seconds
+
+        self.buffer = queue.Queue()
+        self.prefilled = threading.Event()
+        self.start_time = None
+        self.started = threading.Event()
+        self.generated = 0
+        self.error = None
+
+    # feed the primer before the playback starts, the priming doesn't have to keep up with the time
+    def prime(self):
+        self.model.init_hidden(1)
+        self.input_event = torch.LongTensor(1, 1)
+        self.input_chord = torch.LongTensor(1, 1)
+        if self.cuda:
+            self.input_event = self.input_event.cuda()
+            self.input_chord = self.input_chord.cuda()
+
+        while self.stream.is_priming() and not self.stream.finished:
+            self.step()
+
+    def step(self):
+        self.model.repackage_hidden()
+        self.input_event[0, 0] = self.stream.event
+        self.input_chord[0, 0] = self.stream.chord
+
+        # a joint model predicts the volume of the next event in the same step
+        with torch.no_grad(), profiling.phase('forward'):
+            if self.joint:
+                output, volume = self.model.forward_with_volume(self.input_event, self.input_chord)
+            else:
+                output = self.model(self.input_event, self.input_chord)
+        with profiling.phase('sampling'):
+            if self.joint:
+                self.stream.advance(output.data[0, 0], min(max(float(volume.data[0, 0]), 0.0), 1.0))
+            else:
+                self.stream.advance(output.data[0, 0])
+
+    # the result of the stream is moved into the buffer as soon as an event is appended to it
+    def produce(self):
+        ticks = 0
+        produced = 0
+        try:
+            while True:
+                while produced < len(self.stream.result):
+                    event, chord, volume = self.stream.result[produced]
+                    ticks += shift_ticks(int(event))
+                    if self.volume_follower is not None: volume = self.volume_follower.volume(event)
+                    elif self.primer_volumes is not None and produced <= self.stream.priming_length:
+                        volume = float(self.primer_volumes[produced % len(self.primer_volumes)])
+                    produced += 1
+
+                    self.buffer.put(ScheduledEvent(event, chord, volume, ticks, time.perf_counter()))
+                    self.generated += 1
+
+                    # don't run further ahead of the playback than the lookahead
+                    if not self.started.is_set() and ticks * self.tick_seconds >= self.lookahead:
+                        self.prefilled.set()
+                        self.started.wait()
+                    if self.started.is_set():
+                        ahead = self.start_time + ticks * self.tick_seconds - self.lookahead - time.perf_counter()
+                        if ahead > 0: time.sleep(ahead)
+
+                if self.stream.finished: break
+                profiling.step('realtime_step')
+                self.step()
+        except Exception as e:
+            self.error = e
+        finally:
+            profiling.end_step('realtime_step')
+            self.prefilled.set()
+            self.buffer.put(None)
+
+    def play(self):
+        producer = threading.Thread(target=self.produce, daemon=True)
+        producer.start()
+
+        # the playback starts when the lookahead is filled (or the whole song is generated)
+        self.prefilled.wait()
+        self.start_time = time.perf_counter()
+        self.started.set()
+
+        stats = RealtimeStats()
+        while True:
+            item = self.buffer.get()
+            if item is None: break
+
+            scheduled = self.start_time + item.ticks * self.tick_seconds
+            wait = scheduled - time.perf_counter()
+            if wait > 0: time.sleep(wait)
+
+            now = time.perf_counter()
+            self.sink.write(item, now - self.start_time)
+            stats.add(time.perf_counter() - scheduled, scheduled - item.generated_at)
+
+        producer.join()
+        if self.error is not None: raise self.error
+        return stats.report(time.perf_counter() - self.start_time, self.generated)
+
+
+def print_report(report):
+    print('-' * 89, file=sys.stderr)
+    print('| played {} events in {:.2f}s | underruns {} | late events {}'.format(report['events'], report['duration_s'], report['underruns'], report['late_events']), file=sys.stderr)
+    print('| latency  (ms) | ' + ' | '.join('{} {:8.2f}'.format(p, value) for p, value in report['latency_ms'].items() if value is not None), file=sys.stderr)
+    print('| headroom (ms) | ' + ' | '.join('{} {:8.2f}'.format(p, value) for p, value in report['headroom_ms'].items() if value is not None), file=sys.stderr)
+    print('-' * 89, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generative Model -- Real-time Generating')
+    parser.add_argument('--note_model', type=str, default='music-model.loss_0.880.pt', help='path to trained model')
+    parser.add_argument('--primer', type=str, default="Nirvana - Lithium.mus", help='name of the priming song')
+    parser.add_argument('--priming_length', type=int, default=400, help='number of events primed from the input (default: 400)')
+    parser.add_argument('--chord_priming_length', type=int, default=20, help='number of events primed from the input for Chord Predictor (default: 20)')
+    parser.add_argument('--cuda', type=bool, default=False, help='use CUDA (default: False)')
+    parser.add_argument('--max_length', type=int, default=10000, help='maximal length of the generated sequence (default: 10000)')
+    parser.add_argument('--length_beats', type=float, default=0, help='musical length of the song in beats, the generating stops as soon as it is reached, 0 uses only max_length (default: 0)')
+    parser.add_argument('--length_bars', type=float, default=0, help='musical length of the song in bars, used when --length_beats is 0 (default: 0)')
+    parser.add_argument('--beats_per_bar', type=int, default=4, help='beats in a bar of --length_bars (default: 4)')
+    parser.add_argument('--temperature', type=float, default=0.95, help='temperature -- certainty of the prediction (default: 0.95)')
+    parser.add_argument('--chord_temperature', type=float, default=1.00, help='temperature -- certainty of the prediction for Chord Predictor (default: 1.00)')
+    parser.add_argument('--chord_model', type=str, default='../Chord_Predictor/chord-model.loss_0.54380.pt', help='path to the chord model, when left empty, chords in the original song are used')
+    parser.add_argument('--volume_model', type=str, default='../Volume_Predictor/volume-model.loss_0.02557.pt', help='path to the volume model, when left empty, no volume dynamics is used (not used with a joint note model)')
+    parser.add_argument('--n_primes', type=int, default=2, help="how many times do we feed forward the whole primer (default: 1)")
+    parser.add_argument('--single_instrument', type=bool, default=False, help="filter output to generate only single-instrumental music? (default: False)")
+    parser.add_argument('--seed', type=int, default=42, help='random seed (default: 42)')
+    parser.add_argument('--lookup_tables', type=bool, default=False, help='replace the first recurrent layer input projection by precomputed lookup tables (default: False)')
+    parser.add_argument('--profile', type=str, default='', help='autotuning profile applied to the tuned models (see autotune.py), empty uses the profile of this machine, "none" disables it')
+    parser.add_argument('--quantize', type=bool, default=False, help='use int8 dynamic quantization of the predictors for faster CPU inference (default: False)')
+    parser.add_argument('--tempo', type=float, default=100, help='tempo of the playback in beats per minute, a small time shift is 1/12 of a beat (default: 100)')
+    parser.add_argument('--lookahead', type=float, default=2, help='how many beats the generating may run ahead of the playback (default: 2)')
+    parser.add_argument('--sink', type=str, default='-', help='file or named pipe the events are played into, "-" is the standard output (default: -)')
+    parser.add_argument('--sink_format', type=str, default='mus', help='"mus" writes the .mus records of the events, "text" lines with the playback time, event, chord and volume (default: mus)')
+    parser.add_argument('--report', type=str, default='', help='save the latencies and underruns as JSON into this file')
+    parser.add_argument('--trace', type=str, default='', help='time the phases of the generating loop and save their Chrome trace (JSON) into this file, the statistics are saved next to it, see profiling.py')
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    if args.sink_format not in ('mus', 'text'): raise ValueError("unknown sink format '{}', please use mus or text".format(args.sink_format))
+    if args.trace != '': profiling.enable()
+
+    # the sink may be the standard output, so everything else goes to the standard error
+    primer = "../Primers/{}".format(args.primer)
+    with contextlib.redirect_stdout(sys.stderr):
+        model = load_predictor(args.note_model, args, set_threads=True)
+        stream = create_stream(args, primer)
+
+        # a joint model predicts the volumes together with the events
+        volume_follower, primer_volumes = None, None
+        if hasattr(model, 'forward_with_volume'):
+            _, primer_volumes = Loader(primer).create_volume_tensor()
+        elif args.volume_model != '':
+            volume_follower = VolumeFollower(load_predictor(args.volume_model, args), primer, args)
+
+        session = RealtimeSession(model, stream, volume_follower, None, args.tempo, args.lookahead, args.cuda, primer_volumes)
+        print("Priming")
+        session.prime()
+
+    session.sink = EventSink(args.sink, args.sink_format)
+    print("Playing at {} BPM with {} beats of lookahead".format(args.tempo, args.lookahead), file=sys.stderr)
+    report = session.play()
+    session.sink.close()
+
+    print_report(report)
+    if args.report != '':
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    # the profile report must not end up in a sink on the standard output
+    with contextlib.redirect_stdout(sys.stderr):
+        profiling.finish(args.trace)
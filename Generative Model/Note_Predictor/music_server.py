@@ -0,0 +1,345 @@
+import sys
+sys.path.append("../")
+
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from Note_Predictor.music_generate import *
+
+
+# all three predictors loaded once and shared by every request
+class ModelPool:
+
+    def __init__(self, args):
+        self.args = args
+        self.cuda = args.cuda
+
+        self.note = self.load(args.note_model, args.max_batch, set_threads=True)
+        self.chord = self.load(args.chord_model) if args.chord_model != '' else ''
+        self.volume = self.load(args.volume_model) if args.volume_model != '' else ''
+
+        # chord and volume predictors keep their hidden states inside the module, so only one request can use them at a time
+        self.chord_lock = threading.Lock()
+        self.volume_lock = threading.Lock()
+
+    def load(self, filename, batch_size=1, set_threads=False):
+        model = load_predictor(filename, self.args, batch_size, set_threads)
+        model = model.cuda() if self.cuda else model.cpu()
+        model.eval()
+        return model
+
+
+# a single generation request waiting for (or being processed by) the scheduler
+class GenerationJob:
+
+    def __init__(self, args, primer, stream):
+        self.args = args
+        self.primer = primer
+        self.stream = stream
+        self.done = threading.Event()
+        self.error = None
+
+
+# latency and throughput of the server, shared between the scheduler and the request handlers
+class ServerStats:
+
+    def __init__(self, window=1000, rate_window=60.0):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.latencies = deque(maxlen=window)
+        self.events = deque()
+        self.rate_window = rate_window
+        self.completed = 0
+        self.failed = 0
+        self.steps = 0
+        self.batched_rows = 0
+
+    def add_step(self, batch_size):
+        with self.lock:
+            self.steps += 1
+            self.batched_rows += batch_size
+
+    def add_request(self, latency, n_events):
+        with self.lock:
+            self.completed += 1
+            self.latencies.append(latency)
+            self.events.append((time.time(), n_events))
+
+    def add_failure(self):
+        with self.lock:
+            self.failed += 1
+
+    def percentile(self, latencies, p):
+        if len(latencies) == 0: return None
+        return latencies[min(len(latencies) - 1, int(p / 100.0 * len(latencies)))]
+
+    def report(self, queue_depth, active):
+        with self.lock:
+            now = time.time()
+            while len(self.events) > 0 and self.events[0][0] < now - self.rate_window:
+                self.events.popleft()
+
+            latencies = sorted(self.latencies)
+            elapsed = min(self.rate_window, now - self.start_time)
+
+            return {
+                'queue_depth': queue_depth,
+                'active_streams': active,
+                'completed': self.completed,
+                'failed': self.failed,
+                'latency_ms': {'p{}'.format(p): None if self.percentile(latencies, p) is None else 1000 * self.percentile(latencies, p) for p in (50, 90, 99)},
+                'events_per_second': sum(n for _, n in self.events) / max(elapsed, 1e-9),
+                'mean_batch_size': self.batched_rows / max(self.steps, 1),
+                'uptime_s': now - self.start_time
+            }
+
+
+# runs the note predictor over all active streams at once, new requests join the batch between two steps
+class BatchScheduler(threading.Thread):
+
+    def __init__(self, pool, stats, max_batch, batch_window):
+        super(BatchScheduler, self).__init__(daemon=True)
+        self.model = pool.note
+        self.cuda = pool.cuda
+        self.stats = stats
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.pending = queue.Queue()
+        self.active = []
+
+    def submit(self, job):
+        self.pending.put(job)
+
+    def queue_depth(self):
+        return self.pending.qsize()
+
+    # move waiting jobs into the running batch and give them fresh hidden states
+    def admit(self):
+        jobs = []
+
+        # when idle, block until a request comes and then wait a while for other requests to group them together
+        if len(self.active) == 0:
+            jobs.append(self.pending.get())
+            deadline = time.time() + self.batch_window
+            while len(jobs) < self.max_batch and time.time() < deadline:
+                try:
+                    jobs.append(self.pending.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+
+        while len(self.active) + len(jobs) < self.max_batch:
+            try:
+                jobs.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+
+        jobs = [job for job in jobs if not self.finish_if_done(job)]
+        if len(jobs) == 0: return
+
+        hidden = self.model.hidden if len(self.active) > 0 else None
+        self.model.init_hidden(len(jobs))
+        if hidden is not None:
+            self.model.hidden = tuple(torch.cat((old, new), 1) for old, new in zip(hidden, self.model.hidden))
+
+        self.active += jobs
+
+    def finish_if_done(self, job):
+        if job.stream.finished:
+            job.done.set()
+            return True
+        return False
+
+    # one forward pass of the note predictor over the whole batch
+    def step(self):
+        batch_size = len(self.active)
+
+        input_event = torch.LongTensor([[int(job.stream.event) for job in self.active]])
+        input_chord = torch.LongTensor([[int(job.stream.chord) for job in self.active]])
+        if self.cuda:
+            input_event = input_event.cuda()
+            input_chord = input_chord.cuda()
+
+        with torch.no_grad(), profiling.phase('forward'):
+            output = self.model(input_event, input_chord)
+
+        with profiling.phase('sampling'):
+            for b, job in enumerate(self.active):
+                job.stream.advance(output.data[0, b])
+        self.stats.add_step(batch_size)
+
+        # drop finished streams from the batch together with their hidden states
+        keep = [b for b, job in enumerate(self.active) if not self.finish_if_done(job)]
+        if len(keep) < batch_size:
+            if len(keep) > 0:
+                index = torch.LongTensor(keep)
+                if self.cuda: index = index.cuda()
+                self.model.hidden = tuple(h.index_select(1, index) for h in self.model.hidden)
+            self.active = [self.active[b] for b in keep]
+
+    def run(self):
+        while True:
+            self.admit()
+            if len(self.active) == 0: continue
+
+            # a failing step must not take the scheduler down, so report the error to every request in the batch
+            try:
+                with profiling.phase('step'):
+                    self.step()
+            except Exception as e:
+                for job in self.active:
+                    job.error = e
+                    job.done.set()
+                self.active = []
+
+
+class GenerationServer:
+
+    def __init__(self, args):
+        self.args = args
+        self.pool = ModelPool(args)
+        self.stats = ServerStats()
+        self.scheduler = BatchScheduler(self.pool, self.stats, args.max_batch, args.batch_window / 1000.0)
+        self.scheduler.start()
+
+    # parameters of a request, anything not sent by the client falls back to the server defaults
+    def request_args(self, request):
+        args = argparse.Namespace(**vars(self.args))
+        for key in ('priming_length', 'chord_priming_length', 'max_length', 'n_primes', 'beats_per_bar'):
+            if key in request: setattr(args, key, int(request[key]))
+        for key in ('temperature', 'chord_temperature', 'length_beats', 'length_bars'):
+            if key in request: setattr(args, key, float(request[key]))
+        if 'single_instrument' in request: args.single_instrument = bool(request['single_instrument'])
+        return args
+
+    def generate(self, request):
+        if 'primer' not in request: raise ValueError("missing 'primer', please send the name of a song in the Primers folder")
+
+        args = self.request_args(request)
+        primer = "../Primers/{}".format(os.path.basename(request['primer']))
+        start_time = time.time()
+
+        with self.pool.chord_lock:
+            stream = create_stream(args, primer, self.pool.chord)
+
+        job = GenerationJob(args, primer, stream)
+        self.scheduler.submit(job)
+        job.done.wait()
+        if job.error is not None: raise job.error
+
+        with self.pool.volume_lock:
+            result = assign_volumes(args, primer, stream.result, self.pool.volume)
+
+        self.stats.add_request(time.time() - start_time, len(result))
+        return result_to_bytes(result)
+
+    def report(self):
+        return self.stats.report(self.scheduler.queue_depth(), len(self.scheduler.active))
+
+
+class GenerationRequestHandler(BaseHTTPRequestHandler):
+
+    server_version = "MusicServer/1.0"
+
+    def send(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, code, obj):
+        self.send(code, json.dumps(obj).encode('utf-8'), 'application/json')
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(200, self.server.generator.report())
+        else:
+            self.send_json(404, {'error': 'unknown path ' + self.path})
+
+    def do_POST(self):
+        if self.path != '/generate':
+            self.send_json(404, {'error': 'unknown path ' + self.path})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8')) if length > 0 else {}
+            body = self.server.generator.generate(request)
+        except (ValueError, FileExistsError) as e:
+            self.server.generator.stats.add_failure()
+            self.send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self.server.generator.stats.add_failure()
+            self.send_json(500, {'error': str(e)})
+            return
+
+        self.send(200, body, 'application/octet-stream')
+
+    # unix sockets don't have a client address
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'local'
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generative Model -- Generation Server')
+    parser.add_argument('--note_model', type=str, default='music-model.loss_0.880.pt', help='path to trained model')
+    parser.add_argument('--chord_model', type=str, default='../Chord_Predictor/chord-model.loss_0.54380.pt', help='path to the chord model, when left empty, chords in the original song are used')
+    parser.add_argument('--volume_model', type=str, default='../Volume_Predictor/volume-model.loss_0.02557.pt', help='path to the volume model, when left empty, no volume dynamics is used')
+    parser.add_argument('--cuda', type=bool, default=False, help='use CUDA (default: False)')
+    parser.add_argument('--lookup_tables', type=bool, default=False, help='replace the first recurrent layer input projection by precomputed lookup tables (default: False)')
+    parser.add_argument('--profile', type=str, default='', help='autotuning profile applied to the tuned models (see autotune.py), empty uses the profile of this machine, "none" disables it')
+    parser.add_argument('--quantize', type=bool, default=False, help='use int8 dynamic quantization of the predictors for faster CPU inference (default: False)')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on (default: 8000)')
+    parser.add_argument('--socket', type=str, default='', help='path of a unix socket to listen on instead of the TCP port')
+    parser.add_argument('--max_batch', type=int, default=32, help='maximal number of songs generated in one batch (default: 32)')
+    parser.add_argument('--batch_window', type=float, default=20, help='how long (in ms) an idle server waits to group concurrent requests (default: 20)')
+    parser.add_argument('--priming_length', type=int, default=400, help='default number of events primed from the input (default: 400)')
+    parser.add_argument('--chord_priming_length', type=int, default=20, help='default number of events primed from the input for Chord Predictor (default: 20)')
+    parser.add_argument('--max_length', type=int, default=10000, help='default maximal length of the generated sequence (default: 10000)')
+    parser.add_argument('--length_beats', type=float, default=0, help='default musical length of the song in beats, the generating stops as soon as it is reached, 0 uses only max_length (default: 0)')
+    parser.add_argument('--length_bars', type=float, default=0, help='default musical length of the song in bars, used when --length_beats is 0 (default: 0)')
+    parser.add_argument('--beats_per_bar', type=int, default=4, help='default beats in a bar of --length_bars (default: 4)')
+    parser.add_argument('--temperature', type=float, default=0.95, help='default temperature of the Note Predictor (default: 0.95)')
+    parser.add_argument('--chord_temperature', type=float, default=1.00, help='default temperature of the Chord Predictor (default: 1.00)')
+    parser.add_argument('--n_primes', type=int, default=2, help="default number of times we feed forward the whole primer (default: 2)")
+    parser.add_argument('--single_instrument', type=bool, default=False, help="default for generating only single-instrumental music (default: False)")
+    parser.add_argument('--trace', type=str, default='', help='time the phases of the batched generating loop and save their Chrome trace (JSON) into this file at shutdown, the statistics are saved next to it, see profiling.py')
+    args = parser.parse_args()
+
+    if args.trace != '': profiling.enable()
+
+    generator = GenerationServer(args)
+
+    if args.socket != '':
+        if os.path.exists(args.socket): os.remove(args.socket)
+        server = ThreadingUnixHTTPServer(args.socket, GenerationRequestHandler)
+        print('listening on ' + args.socket)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), GenerationRequestHandler)
+        print('listening on http://{}:{}'.format(args.host, args.port))
+
+    server.generator = generator
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('shutting down')
+        server.server_close()
+        profiling.finish(args.trace)
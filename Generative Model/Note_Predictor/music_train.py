@@ -6,6 +6,10 @@ import datetime
 import time
 import torch.optim as optim
 
+import data_parallel as dp
+import profiling
+import training_state as ts
+import validation
 from utils import *
 from Note_Predictor.lstm_model import *
 
@@ -31,8 +35,24 @@ parser.add_argument('--tied', type=bool, default=True, help='tie the encoder-dec
 parser.add_argument('--optim', type=str, default='Adam', help='optimizer type (default: Adam)')
 parser.add_argument('--seq_len', type=int, default=120, help='total sequence length; how many time steps are unrolled (default: 120)')
 parser.add_argument('--cell', type=str, default='bnlstm', help='type of rnn cell, supported values are "bnlstm" for LSTM with batch norm and "lstm" for standard LSTM cell (default: bnlstm)')
+parser.add_argument('--softmax', type=str, default='full', help='output layer, supported values are "full" for softmax over all events and "cluster" for softmax over event groups (note-ons or note-offs of an instrument cluster) followed by a softmax over their pitches (default: full)')
+parser.add_argument('--resume', type=str, default='', help='path to a full-state checkpoint (music-resume.pt) to continue an interrupted training from')
+parser.add_argument('--checkpoint_interval', type=int, default=1000, help='how many steps it takes before writing the full-state checkpoint (default: 1000)')
+parser.add_argument('--val_worker', type=bool, default=False, help='validate snapshots of the weights in a separate process while the training continues, only on CPU (default: False)')
+parser.add_argument('--val_batch_size', type=int, default=0, help='batch size of the validation worker, 0 uses --batch_size (default: 0)')
+parser.add_argument('--val_threads', type=int, default=0, help='torch threads of the validation worker, 0 keeps the default (default: 0)')
+parser.add_argument('--distributed', type=bool, default=False, help='data-parallel CPU training in processes started by torchrun, see data_parallel.py (default: False)')
+parser.add_argument('--threads', type=int, default=0, help='torch threads of every process when training distributed, 0 splits the cores of the node between its processes (default: 0)')
+parser.add_argument('--bf16', type=bool, default=False, help='bfloat16 mixed precision of the forward passes (autocast), the weights, batch norm statistics and optimizer state stay in float32 (default: False)')
+parser.add_argument('--trace', type=str, default='', help='time the phases of the training loop and save their Chrome trace (JSON) into this file, the statistics are saved next to it, see profiling.py')
 args = parser.parse_args()
 
+# join the other processes, when training distributed
+dp.init_distributed(args)
+
+# time the phases of the training loop
+if args.trace != '': profiling.enable()
+
 
 # Set the random seed manually for reproducibility.
 torch.manual_seed(args.seed)
@@ -52,17 +72,25 @@ val_loader = Loader('../Data/' + args.val_file)
 train_event_data, train_chord_data = train_loader.create_event_tensor()
 val_event_data, val_chord_data = val_loader.create_event_tensor()
 
+# the validation worker batchifies the validation set with its own batch size
+val_sources = (val_event_data, val_chord_data)
+
 # divide the tensors into batches
-train_event_data = batchify(train_event_data, args.batch_size)
-train_chord_data = batchify(train_chord_data, args.batch_size)
-val_event_data = batchify(val_event_data, args.batch_size)
-val_chord_data = batchify(val_chord_data, args.batch_size)
+train_event_data = dp.shard(batchify(train_event_data, args.batch_size))
+train_chord_data = dp.shard(batchify(train_chord_data, args.batch_size))
+val_event_data = dp.shard(batchify(val_event_data, args.batch_size))
+val_chord_data = dp.shard(batchify(val_chord_data, args.batch_size))
+
+# every process trains on its own slice of the batches, from now on batch_size is the size of the slice
+args.batch_size //= dp.world_size()
 
 n_event = Loader.number_of_events()
 n_chords = Loader.number_of_chords()
 
 # initialize the network graph
-model = lstm_model(args.event_emsize, args.chord_emsize, n_event, args.nhid, args.layers, n_chords, args.dropout, args.tied, args.cell, args.seq_len)
+model = lstm_model(args.event_emsize, args.chord_emsize, n_event, args.nhid, args.layers, n_chords, args.dropout, args.tied, args.cell, args.seq_len, args.softmax)
+dp.broadcast_model(model)
+profiling.time_recurrence(model)
 
 if args.cuda:
     model.cuda()
@@ -74,8 +102,20 @@ criterion = nn.CrossEntropyLoss()
 lr = args.lr
 optimizer = getattr(optim, args.optim)(model.parameters(), lr=lr)
 
+# continue an interrupted training from its full-state checkpoint
+resume_state = None
+if args.resume != '':
+    resume_state = ts.load_training_state(args.resume, model, optimizer)
+    lr = resume_state['lr']
 
+# checkpoints and models are written in the background
+writer = ts.CheckpointWriter()
+
+
+@profiling.timed('validation')
 def evaluate(event_source, chord_source):
+    # the running statistics of batch norm differ between processes
+    dp.synchronize_buffers(model)
     model.eval()
     model.init_hidden(args.batch_size)
     total_loss = 0
@@ -83,47 +123,61 @@ def evaluate(event_source, chord_source):
     for i in range(0, event_source.size(0) - 1, args.seq_len):
         event_data, targets = get_batch(event_source, i, args, evaluation=True)
         chord_data = get_batch_without_target(chord_source, i, args, evaluation=True)
-        output = model(event_data, chord_data)
+        loss = model.loss(event_data, chord_data, targets, criterion)
 
-        output_flat = output.view(-1, n_event)
-        total_loss += len(event_data) * criterion(output_flat, targets).data
+        total_loss += len(event_data) * loss.data
         model.repackage_hidden()
-    return total_loss[0] / len(event_source)
+    return dp.average(float(total_loss) / len(event_source))
 
 
-def train(train_log, test_log):
+def train(train_log, test_log, start_batch=0):
     model.train()
     model.init_hidden(args.batch_size)
     total_loss = 0
     start_time = time.time()
 
+    # when resuming in the middle of the epoch, continue with the hidden states of the interrupted training
+    if start_batch > 0: ts.restore_position(model, resume_state, args.cuda)
+
     #for each batch
     for batch, i in enumerate(range(0, train_event_data.size(0) - 1, args.seq_len)):
-        event_data, targets = get_batch(train_event_data, i, args, evaluation=False)
-        chord_data = get_batch_without_target(train_chord_data, i, args, evaluation=False)
+        # skip the batches trained before resuming
+        if batch < start_batch: continue
+        profiling.step('batch')
+
+        with profiling.phase('get_batch'):
+            event_data, targets = get_batch(train_event_data, i, args, evaluation=False)
+            chord_data = get_batch_without_target(train_chord_data, i, args, evaluation=False)
 
         # repackage hidden states to not backpropagate into the old ones
         model.repackage_hidden()
         optimizer.zero_grad()
 
         # forward and backward pass
-        output = model(event_data, chord_data)
-        loss = criterion(output.view(-1, n_event), targets)
-        loss.backward()
+        with profiling.phase('forward'), autocast(args):
+            loss = model.loss(event_data, chord_data, targets, criterion)
+        with profiling.phase('backward'):
+            loss.backward()
+
+        # average the gradients of all processes
+        with profiling.phase('all_reduce'):
+            dp.all_reduce_gradients(model)
 
         # clip gradient and update weights according to it
-        torch.nn.utils.clip_grad_norm(model.parameters(), args.clip)
-        optimizer.step()
+        with profiling.phase('clip'):
+            torch.nn.utils.clip_grad_norm(model.parameters(), args.clip)
+        with profiling.phase('optimizer'):
+            optimizer.step()
 
         total_loss += loss.data
 
         # log train progress if we are at the right step
         if batch % args.log_interval == 0 and batch > 0:
-            cur_loss = total_loss[0] / args.log_interval
+            cur_loss = dp.average(float(total_loss) / args.log_interval)
             elapsed = time.time() - start_time
-            print('| epoch {:3d} | {:5d}/{:5d} batches | lr {:02.5f} | ms/batch {:5.5f} | loss {:5.2f}'.format(
+            print('| epoch {:3d} | {:5d}/{:5d} batches | lr {:02.5f} | ms/batch {:5.5f} | events/s {:8.0f} | loss {:5.2f}'.format(
                 epoch, batch, train_event_data.size(0) // args.seq_len, lr,
-                elapsed * 1000 / args.log_interval, cur_loss))
+                elapsed * 1000 / args.log_interval, args.log_interval * args.seq_len * args.batch_size * dp.world_size() / elapsed, cur_loss))
 
             total_loss = 0
             start_time = time.time()
@@ -132,39 +186,69 @@ def train(train_log, test_log):
 
         # evaluate the progress on validation set if we are at the right step
         if batch % args.val_interval == 0 and batch > 0:
-            val_loss = evaluate(val_event_data, val_chord_data)
-            print(val_loss, file=test_log, flush=True)
-            save(model, 'music', val_loss, args)
+            if args.val_worker:
+                validation.validate_in_background(validator, model, 'music')
+            else:
+                val_loss = evaluate(val_event_data, val_chord_data)
+                print(val_loss, file=test_log, flush=True)
+                if dp.rank() == 0: ts.save_model(writer, model, 'music', val_loss, args)
+
+                model.train()
+                model.init_hidden(args.batch_size)
+
+        # log the validations finished by the worker
+        if validator is not None: validator.log_results(test_log)
+
+        # write the full training state in the background
+        if (batch + 1) % args.checkpoint_interval == 0:
+            ts.save_training_state(writer, ts.snapshot(model, optimizer, lr, epoch, batch + 1, best_val_loss), ts.resume_filename('music'))
 
-            model.train()
-            model.init_hidden(args.batch_size)
+    profiling.end_step('batch')
 
 
 # at any point you can hit Ctrl + C to break out of training early.
 if __name__ == "__main__":
-    best_val_loss = None
+    best_val_loss = None if resume_state is None else resume_state['best_val_loss']
 
-    with open("train_log_{}".format(datetime.datetime.now().strftime("%Y-%m-%d_%H.%M.%S")), "w") as train_log:
-        with open("test_log_{}".format(datetime.datetime.now().strftime("%Y-%m-%d_%H.%M.%S")), "w") as test_log:
+    # validation in a separate process on snapshots of the weights, the first rank validates for all of them
+    validator = None
+    if args.val_worker and dp.rank() == 0:
+        validator = validation.ValidationWorker(model, evaluate, val_sources, args.val_batch_size or args.batch_size * dp.world_size(), args, args.val_threads)
+
+    with open(dp.log_filename("train_log_{}".format(datetime.datetime.now().strftime("%Y-%m-%d_%H.%M.%S"))), "w") as train_log:
+        with open(dp.log_filename("test_log_{}".format(datetime.datetime.now().strftime("%Y-%m-%d_%H.%M.%S"))), "w") as test_log:
 
             try:
-                for epoch in range(1, args.epochs+1):
+                start_epoch = 1 if resume_state is None else resume_state['epoch']
+                for epoch in range(start_epoch, args.epochs+1):
                     epoch_start_time = time.time()
-                    train(train_log, test_log)
-                    val_loss = evaluate(val_event_data, val_chord_data)
+                    start_batch = resume_state['batch'] if resume_state is not None and epoch == start_epoch else 0
+                    train(train_log, test_log, start_batch)
+                    val_loss = validation.validate_and_wait(validator, model, test_log) if args.val_worker else evaluate(val_event_data, val_chord_data)
 
                     print('-' * 89)
                     print('| end of epoch {:3d} | time: {:5.2f}s | valid loss {:5.2f}'.format(epoch, (time.time() - epoch_start_time), val_loss))
                     print('-' * 89)
 
-                    save(model, 'music', val_loss, args)
+                    if dp.rank() == 0: ts.save_model(writer, model, 'music', val_loss, args)
 
                     # decay learning rate
                     lr /= args.lr_decay
                     for param_group in optimizer.param_groups:
                         param_group['lr'] = lr
 
+                    # the next epoch starts from its first batch
+                    ts.save_training_state(writer, ts.snapshot(model, optimizer, lr, epoch + 1, 0, best_val_loss), ts.resume_filename('music'))
 
             except KeyboardInterrupt:
                 print('-' * 89)
                 print('Exiting from training early')
+
+            if validator is not None: validator.close(test_log)
+
+    # wait for the checkpoints still being written
+    writer.close()
+
+    # statistics and the timeline of the phases
+    if args.trace != '': profiling.finish(ts.rank_filename(args.trace))
+    dp.cleanup_distributed()
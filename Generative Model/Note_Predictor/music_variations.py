@@ -0,0 +1,196 @@
+import sys
+sys.path.append("../")
+
+from Note_Predictor.music_generate import *
+
+
+# one continuation of the primed song: its stream and the hidden states of the Note Predictor after its last step
+class Branch:
+
+    def __init__(self, stream, hidden, seed=None):
+        self.stream = stream
+        self.hidden = hidden
+        self.seed = seed
+
+
+# primes the Note Predictor only once and then samples many continuations of the primed state in one batch,
+# every branch can be forked again at any point, which gives a tree of continuations
+class ForkedSampler:
+
+    def __init__(self, model, cuda=False):
+        self.model = model.cuda() if cuda else model.cpu()
+        self.model.eval()
+        self.cuda = cuda
+
+    # feed the whole primer into the network, the returned branch is ready to generate new events
+    def prime(self, stream):
+        self.model.init_hidden(1)
+        branch = Branch(stream, self.model.hidden)
+        steps = stream.n_primes*stream.input_size + stream.priming_length - stream.step
+        return self.run([branch], steps)[0]
+
+    # copy a branch n times, each copy samples with its own random generator
+    def fork(self, branch, n, seeds=None):
+        if seeds is None:
+            # derive the seeds from the parent, so the whole tree is reproducible from a single seed
+            generator = branch.stream.generator
+            seeds = [int(torch.randint(2**62, (1,), generator=generator)[0]) for _ in range(n)]
+
+        branches = []
+        for seed in seeds:
+            generator = torch.Generator()
+            generator.manual_seed(seed)
+            hidden = tuple(h.clone() for h in branch.hidden)
+            branches.append(Branch(branch.stream.fork(generator), hidden, seed))
+        return branches
+
+    # advance all branches together by (at most) n_steps events, or until they end when n_steps is None
+    def run(self, branches, n_steps=None):
+        active = [branch for branch in branches if not branch.stream.finished]
+        if len(active) == 0: return branches
+
+        targets = [None if n_steps is None else branch.stream.step + n_steps for branch in active]
+        self.model.hidden = tuple(torch.cat([branch.hidden[k] for branch in active], 1) for k in range(2))
+
+        while len(active) > 0:
+            input_event = torch.LongTensor([[int(branch.stream.event) for branch in active]])
+            input_chord = torch.LongTensor([[int(branch.stream.chord) for branch in active]])
+            if self.cuda:
+                input_event = input_event.cuda()
+                input_chord = input_chord.cuda()
+
+            profiling.step('step')
+            with torch.no_grad(), profiling.phase('forward'):
+                output = self.model(input_event, input_chord)
+
+            with profiling.phase('sampling'):
+                for b, branch in enumerate(active):
+                    branch.stream.advance(output.data[0, b])
+
+            # store the hidden states of the branches that stopped and remove them from the batch
+            done = [b for b, branch in enumerate(active) if branch.stream.finished or (targets[b] is not None and branch.stream.step >= targets[b])]
+            if len(done) == 0: continue
+
+            for b in done:
+                active[b].hidden = tuple(h[:, b:b + 1].clone() for h in self.model.hidden)
+
+            keep = [b for b in range(len(active)) if b not in done]
+            if len(keep) > 0:
+                index = torch.LongTensor(keep)
+                if self.cuda: index = index.cuda()
+                self.model.hidden = tuple(h.index_select(1, index) for h in self.model.hidden)
+
+            active = [active[b] for b in keep]
+            targets = [targets[b] for b in keep]
+
+        profiling.end_step('step')
+        return branches
+
+
+# assign volumes to the results of all branches, the primer is fed into the Volume Predictor only once
+def assign_branch_volumes(args, primer, results, volume_model):
+    if isinstance(volume_model, str):
+        if volume_model == '': return results
+        volume_model = load_predictor(volume_model, args)
+
+    volume_model = volume_model.cuda() if args.cuda else volume_model.cpu()
+    volume_model.eval()
+
+    print("Generating volumes")
+
+    event_tensor, volume_tensor = Loader(primer).create_volume_tensor()
+    primer_size = len(event_tensor)
+
+    # the same steps as generate_volumes does before it starts to predict
+    input = torch.LongTensor(1, 1)
+    if args.cuda: input = input.cuda()
+    volume_model.init_hidden(1)
+
+    with torch.no_grad():
+        for i in range(args.n_primes*primer_size + args.priming_length):
+            input[0, 0] = event_tensor[i % primer_size]
+            volume_model(input)
+
+    primed_volumes = [volume_tensor[i % primer_size] for i in range(args.priming_length)]
+
+    # regress the volumes of all branches in one batch, shorter results are padded
+    lengths = [max(len(result) - args.priming_length, 0) for result in results]
+    volume_model.hidden = tuple(h.expand(-1, len(results), -1).contiguous() for h in volume_model.hidden)
+    volumes = [[] for _ in results]
+
+    with torch.no_grad():
+        for t in range(max(lengths + [0])):
+            input = torch.LongTensor([[int(result[args.priming_length + t][0]) if t < lengths[r] else 0 for r, result in enumerate(results)]])
+            if args.cuda: input = input.cuda()
+
+            output = volume_model(input)
+            for r in range(len(results)):
+                if t < lengths[r]: volumes[r].append(float(output.data[0, r, 0]))
+
+    return [[(event, chord, volume) for (event, chord, _), volume in zip(result, primed_volumes + volumes[r])] for r, result in enumerate(results)]
+
+
+# fork the primed state according to branching, generating fork_after events between two forks;
+# returns the results of all leaves of the tree
+def generate_variations(args, primer, branching, fork_after):
+    batch_size = 1
+    for n in branching: batch_size *= n
+    sampler = ForkedSampler(load_predictor(args.note_model, args, batch_size, set_threads=True), args.cuda)
+    stream = create_stream(args, primer)
+
+    stream.generator = torch.Generator()
+    stream.generator.manual_seed(args.seed)
+
+    print("Priming")
+    branches = [sampler.prime(stream)]
+
+    print("Generating notes")
+    for level, n in enumerate(branching):
+        branches = [child for branch in branches for child in sampler.fork(branch, n)]
+        last_level = level == len(branching) - 1
+        sampler.run(branches, None if last_level else fork_after)
+
+    results = [branch.stream.result for branch in branches]
+    return assign_branch_volumes(args, primer, results, args.volume_model)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generative Model -- Note Predictor Variations')
+    parser.add_argument('--note_model', type=str, default='music-model.loss_0.880.pt', help='path to trained model')
+    parser.add_argument('--primer', type=str, default="Nirvana - Lithium.mus", help='name of the priming song')
+    parser.add_argument('--priming_length', type=int, default=400, help='number of events primed from the input (default: 400)')
+    parser.add_argument('--chord_priming_length', type=int, default=20, help='number of events primed from the input for Chord Predictor (default: 20)')
+    parser.add_argument('--cuda', type=bool, default=False, help='use CUDA (default: False)')
+    parser.add_argument('--max_length', type=int, default=10000, help='maximal length of the generated sequence (default: 10000)')
+    parser.add_argument('--temperature', type=float, default=0.95, help='temperature -- certainty of the prediction (default: 0.95)')
+    parser.add_argument('--chord_temperature', type=float, default=1.00, help='temperature -- certainty of the prediction for Chord Predictor (default: 1.00)')
+    parser.add_argument('--chord_model', type=str, default='../Chord_Predictor/chord-model.loss_0.54380.pt', help='path to the chord model, when left empty, chords in the original song are used')
+    parser.add_argument('--volume_model', type=str, default='../Volume_Predictor/volume-model.loss_0.02557.pt', help='path to the volume model, when left empty, no volume dynamics is used')
+    parser.add_argument('--n_primes', type=int, default=2, help="how many times do we feed forward the whole primer (default: 2)")
+    parser.add_argument('--single_instrument', type=bool, default=False, help="filter output to generate only single-instrumental music? (default: False)")
+    parser.add_argument('--variations', type=str, default='50', help='comma separated number of forks at each level of the tree, e.g. "5,10" forks the primed state 5 times and each of them 10 times again (default: 50)')
+    parser.add_argument('--fork_after', type=int, default=500, help='number of events generated between two levels of the tree (default: 500)')
+    parser.add_argument('--output_folder', type=str, default="../Samples/")
+    parser.add_argument('--seed', type=int, default=42, help='random seed (default: 42)')
+    parser.add_argument('--lookup_tables', type=bool, default=False, help='replace the first recurrent layer input projection by precomputed lookup tables (default: False)')
+    parser.add_argument('--profile', type=str, default='', help='autotuning profile applied to the tuned models (see autotune.py), empty uses the profile of this machine, "none" disables it')
+    parser.add_argument('--quantize', type=bool, default=False, help='use int8 dynamic quantization of the predictors for faster CPU inference (default: False)')
+    parser.add_argument('--trace', type=str, default='', help='time the phases of the generating loop and save their Chrome trace (JSON) into this file, the statistics are saved next to it, see profiling.py')
+    args = parser.parse_args()
+
+    if torch.cuda.is_available() and not args.cuda:
+        print("WARNING: You have a CUDA device, so you should probably run with --cuda True")
+
+    if args.trace != '': profiling.enable()
+
+    primer = "../Primers/{}".format(args.primer)
+    branching = [int(n) for n in args.variations.split(',')]
+    outputs = generate_variations(args, primer, branching, args.fork_after)
+
+    name = os.path.splitext(args.primer)[0]
+    for k, output in enumerate(outputs):
+        filename = args.output_folder + '{}.variation_{}.mus'.format(name, k)
+        with open(filename, 'wb') as f:
+            f.write(result_to_bytes(output))
+    print('saved {} variations into {}'.format(len(outputs), args.output_folder))
+    profiling.finish(args.trace)
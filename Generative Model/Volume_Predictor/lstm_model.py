@@ -55,10 +55,10 @@ class lstm_model(nn.Module):
     # repackage hidden states to not backpropagate into the old ones
     def __repackage_hidden(self, h):
         """Wraps hidden states in new Variables, to detach them from their history."""
-        if type(h) == Variable:
-            h.detach_()
-        else:
+        if isinstance(h, tuple):
             return tuple(self.__repackage_hidden(v) for v in h)
+        else:
+            h.detach_()
 
     def repackage_hidden(self):
         self.__repackage_hidden(self.hidden)
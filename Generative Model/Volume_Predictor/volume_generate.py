@@ -2,11 +2,14 @@ import sys
 sys.path.append("../")
 
 import argparse
+from autotune import load_tuned_model
+import profiling
 from utils import *
 
 
 def generate_volumes(model, primer, cuda, priming_length=50, n_primes=1, events_for_regression=None):
-    model = torch.load(model)
+    # the model is either a path to the checkpoint or an already loaded network
+    if isinstance(model, str): model = load_model(model, cuda)
     loader = Loader(primer)
 
     event_tensor, volume_tensor = loader.create_volume_tensor()
@@ -31,12 +34,14 @@ def generate_volumes(model, primer, cuda, priming_length=50, n_primes=1, events_
 
     # feed forward the whole network with primer and then generate new music of maximal length args.max_length
     for i in range(n_primes*primer_size + prediction_size):
+        profiling.step('volume_step')
         model.repackage_hidden()
 
         # don't generate anything, just feed the network to set its hidden states
         if i < n_primes*primer_size + priming_length:
             input[0,0] = event_tensor[i % primer_size]
-            _ = model(input)
+            with profiling.phase('forward'):
+                _ = model(input)
             if i < n_primes * primer_size: continue
 
             output = volume_tensor[i % primer_size]
@@ -45,11 +50,13 @@ def generate_volumes(model, primer, cuda, priming_length=50, n_primes=1, events_
         else:
             input[0,0] = events_for_regression[i - n_primes*primer_size]
 
-            output  = model(input)
+            with profiling.phase('forward'):
+                output  = model(input)
             output = output.data[0,0,0]
 
         result.append(output)
 
+    profiling.end_step('volume_step')
     return result
 
 
@@ -61,6 +68,10 @@ if __name__ == "__main__":
     parser.add_argument('--primer', type=str, default='', help='path to priming song')
     parser.add_argument('--priming_length', type=int, default=100, help='number of items primed from the input')
     parser.add_argument('--n_primes', type=int, default=1, help='number of loops over the primer')
+    parser.add_argument('--lookup_tables', type=bool, default=False, help='replace the first recurrent layer input projection by precomputed lookup tables (default: False)')
+    parser.add_argument('--profile', type=str, default='', help='autotuning profile applied to the tuned models (see autotune.py), empty uses the profile of this machine, "none" disables it')
+    parser.add_argument('--quantize', type=bool, default=False, help='use int8 dynamic quantization for faster CPU inference (default: False)')
+    parser.add_argument('--trace', type=str, default='', help='time the phases of the generating loop and save their Chrome trace (JSON) into this file, the statistics are saved next to it, see profiling.py')
     args = parser.parse_args()
 
     # Set the random seed manually for reproducibility.
@@ -70,6 +81,10 @@ if __name__ == "__main__":
         else:
             torch.cuda.manual_seed(args.seed)
 
-    output = generate_volumes(args.model, args.primer, args.cuda, args.priming_length, args.n_primes)
+    if args.trace != '': profiling.enable()
+
+    model = load_tuned_model(args.model, args.cuda, args.lookup_tables, args.quantize, set_threads=True, profile=args.profile)
+    output = generate_volumes(model, args.primer, args.cuda, args.priming_length, args.n_primes)
     print(output)
+    profiling.finish(args.trace)
 
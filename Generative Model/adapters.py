@@ -0,0 +1,146 @@
+"""Low-rank adapters: small trainable updates of a frozen predictor, saved and applied separately from it."""
+
+# Every adapted weight matrix W of the recurrent layers (input and hidden projections of every layer, with either
+# cell type) and of the output layer is replaced by W + (alpha / rank) * up @ down, where down has `rank` rows and
+# up is initialized to zeros, so a new adapter doesn't change the network. The weights are parametrized in place
+# (torch.nn.utils.parametrize), the frozen base weights stay in the network, and only the factors are trained and
+# saved, a few hundred kB per style instead of a full checkpoint. When loading for generating, the updates are
+# merged into the weights, so an adapted network is exactly as fast as the base one and all inference transforms
+# (lookup tables, quantization) apply to it. The output layer of a tied network gets its own merged weights, the
+# event embeddings keep the base ones.
+
+import argparse
+import math
+
+import torch
+from torch import nn
+import torch.nn.utils.parametrize as parametrize
+
+import bnlstm as bn
+from utils import load_model
+
+
+# attributes of the recurrent layers of the predictors
+RECURRENT_LAYERS = ('lstm', 'forward_lstm')
+
+
+class LowRankUpdate(nn.Module):
+
+    def __init__(self, weight, rank, alpha):
+        super(LowRankUpdate, self).__init__()
+        rows, columns = weight.size()
+        self.scale = alpha / rank
+        self.down = nn.Parameter(weight.new_empty(rank, columns).normal_(0, 1 / math.sqrt(columns)))
+        self.up = nn.Parameter(weight.new_zeros(rows, rank))
+
+    def delta(self):
+        return self.scale * torch.mm(self.up, self.down)
+
+    def forward(self, weight):
+        return weight + self.delta()
+
+
+# (name, module, attribute) of every adapted weight matrix, the names are the keys of the saved adapters
+def adapter_targets(model):
+    targets = []
+    for attribute in RECURRENT_LAYERS:
+        layers = getattr(model, attribute, None)
+        if isinstance(layers, nn.LSTM):
+            for layer in range(layers.num_layers):
+                for weight in ('weight_ih_l{}'.format(layer), 'weight_hh_l{}'.format(layer)):
+                    targets.append(('{}.{}'.format(attribute, weight), layers, weight))
+        elif isinstance(layers, bn.LSTM):
+            for layer in range(layers.num_layers):
+                for weight in ('weight_ih', 'weight_hh'):
+                    targets.append(('{}.cell_{}.{}'.format(attribute, layer, weight), layers.get_cell(layer), weight))
+
+    # the weight of a parametrized decoder is no longer a parameter
+    decoder = getattr(model, 'decoder', None)
+    if decoder is not None and (parametrize.is_parametrized(decoder, 'weight') or isinstance(getattr(decoder, 'weight', None), nn.Parameter)):
+        targets.append(('decoder.weight', decoder, 'weight'))
+    return targets
+
+
+# freeze the network and parametrize its weights by new low-rank updates, returns the trainable parameters
+def add_adapters(model, rank=8, alpha=8.0):
+    for parameter in model.parameters():
+        parameter.requires_grad = False
+
+    for name, module, attribute in adapter_targets(model):
+        parametrize.register_parametrization(module, attribute, LowRankUpdate(getattr(module, attribute), rank, alpha))
+
+    model.adapter_config = {'rank': rank, 'alpha': alpha}
+    return adapter_parameters(model)
+
+
+def adapter_parameters(model):
+    return [parameter for module in model.modules() if isinstance(module, LowRankUpdate) for parameter in module.parameters()]
+
+
+# the factors of all updates, keyed by the names of the adapted weights
+def adapter_state(model):
+    state = {}
+    for name, module, attribute in adapter_targets(model):
+        update = module.parametrizations[attribute][0]
+        state[name] = {'up': update.up.detach().cpu().clone(), 'down': update.down.detach().cpu().clone()}
+    return state
+
+
+# the frozen network in training mode: dropout is on, but batch norm keeps using the running statistics of the base
+def train_mode(model):
+    model.train()
+    for module in model.modules():
+        if isinstance(module, bn.SeparatedBatchNorm1d):
+            module.eval()
+
+
+# the adapter is saved together with its configuration and the name of the base model it belongs to
+def save_adapter(state, config, base, name, loss):
+    save_filename = '{:}-adapter.loss_{:.5f}.pt'.format(name, loss)
+    torch.save({'config': config, 'base': base, 'adapters': state}, save_filename)
+    print('Saved as %s' % save_filename)
+
+
+# add the updates of a saved adapter into the weights of a loaded (not parametrized) network, in place
+def merge_adapter(model, filename):
+    adapter = torch.load(filename, map_location=lambda storage, location: storage, weights_only=False)
+    config = adapter['config']
+    targets = {name: (module, attribute) for name, module, attribute in adapter_targets(model)}
+
+    for name, factors in adapter['adapters'].items():
+        if name not in targets: raise ValueError("the adapter {} doesn't fit the network, it has no weight {}".format(filename, name))
+        module, attribute = targets[name]
+        weight = getattr(module, attribute)
+
+        update = LowRankUpdate(weight, factors['up'].size(1), config['alpha'])
+        update.up.data.copy_(factors['up'])
+        update.down.data.copy_(factors['down'])
+
+        # a new parameter, so the tied event embeddings keep the base weights
+        with torch.no_grad():
+            merged = update(weight.detach())
+        setattr(module, attribute, nn.Parameter(merged))
+
+    return model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generative Model -- Adapter Info')
+    parser.add_argument('adapters', type=str, nargs='+', help='paths to adapters saved by Note_Predictor/adapter_train.py')
+    parser.add_argument('--base_model', type=str, default='', help='when given, report the relative size of the updates of its weights')
+    args = parser.parse_args()
+
+    base = load_model(args.base_model) if args.base_model != '' else None
+    targets = {name: getattr(module, attribute) for name, module, attribute in adapter_targets(base)} if base is not None else {}
+
+    for filename in args.adapters:
+        adapter = torch.load(filename, map_location=lambda storage, location: storage, weights_only=False)
+        n_parameters = sum(factors['up'].numel() + factors['down'].numel() for factors in adapter['adapters'].values())
+
+        print('-' * 89)
+        print('| {} (base {}, rank {}, alpha {}, {} parameters)'.format(filename, adapter['base'], adapter['config']['rank'], adapter['config']['alpha'], n_parameters))
+        for name, factors in adapter['adapters'].items():
+            delta = adapter['config']['alpha'] / factors['up'].size(1) * torch.mm(factors['up'], factors['down'])
+            relative = ' | relative {:10.6f}'.format(float(delta.norm() / targets[name].norm())) if name in targets else ''
+            print('| {:24s} | norm {:10.6f}{}'.format(name, float(delta.norm()), relative))
+    print('-' * 89)
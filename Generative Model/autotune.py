@@ -0,0 +1,249 @@
+"""Autotuning of the CPU inference: torch threads, interop threads and the implementation of the predictors."""
+
+# Every model is benchmarked on steps of random inputs for all combinations of thread counts, interop threads,
+# batch sizes and implementations (plain, lookup tables, int8 quantization and both). The fastest configuration
+# of every batch size is stored in the profile of the machine, which the generating scripts apply whenever they
+# load a model that has been tuned. Interop threads can be set only once per process, so each value is measured
+# in its own process.
+
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import torch
+
+import profiling
+from adapters import merge_adapter
+from lookup_tables import tabulate_inputs
+from quantization import quantize_model
+from utils import load_model
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+IMPLEMENTATIONS = ['default', 'lookup_tables', 'quantize', 'lookup_tables+quantize']
+
+# models benchmarked when no model is given on the command line (the ones that exist)
+SHIPPED_MODELS = ['Note_Predictor/music-model.loss_0.880.pt', 'Chord_Predictor/chord-model.loss_0.54380.pt', 'Volume_Predictor/volume-model.loss_0.02557.pt']
+
+
+# the profile is valid only on the machine (and torch build) where it was measured
+def machine_info():
+    processor = platform.processor()
+    if os.path.isfile('/proc/cpuinfo'):
+        with open('/proc/cpuinfo') as f:
+            names = [line.split(':', 1)[1].strip() for line in f if line.startswith('model name')]
+        if len(names) > 0: processor = names[0]
+
+    return {'hostname': platform.node(), 'processor': processor, 'cpu_count': os.cpu_count(), 'torch': torch.__version__}
+
+
+def default_profile_path():
+    return os.path.join(ROOT, 'Profiles', 'autotune-{}.json'.format(platform.node() or 'default'))
+
+
+# the profile of this machine, path '' means the default one, 'none' disables the profile
+def load_profile(path=''):
+    if path == 'none': return None
+    path = path or default_profile_path()
+    if not os.path.isfile(path): return None
+
+    with open(path) as f:
+        profile = json.load(f)
+    if profile.get('machine') != machine_info(): return None
+    return profile
+
+
+def model_key(filename):
+    return os.path.abspath(filename)
+
+
+# retuning is needed when the checkpoint changes
+def model_stamp(filename):
+    return {'size': os.path.getsize(filename), 'mtime': os.path.getmtime(filename)}
+
+
+# the fastest configuration of the model for the nearest tuned batch size, None when the model hasn't been tuned
+def tuned_configuration(filename, batch_size=1, path=''):
+    profile = load_profile(path)
+    if profile is None: return None
+
+    entry = profile['models'].get(model_key(filename))
+    if entry is None or entry['stamp'] != model_stamp(filename): return None
+
+    nearest = min(entry['best'], key=lambda size: abs(math.log(int(size)) - math.log(max(batch_size, 1))))
+    return entry['best'][nearest]
+
+
+def apply_threads(configuration):
+    torch.set_num_threads(configuration['threads'])
+    try:
+        torch.set_num_interop_threads(configuration['interop_threads'])
+    except RuntimeError:
+        # interop threads can be set only before any inter-op parallel work started, keep the current ones
+        pass
+
+
+# apply the transforms named in the implementation (e.g. "lookup_tables+quantize") to a loaded model
+def apply_implementation(model, implementation):
+    transforms = set(implementation.split('+')) if isinstance(implementation, str) else set(implementation)
+    if 'lookup_tables' in transforms: model = tabulate_inputs(model)
+    if 'quantize' in transforms: model = quantize_model(model)
+    return model
+
+
+# load a model with the requested transforms and the ones found by autotuning (on CPU only), a low-rank adapter
+# (see adapters.py) is merged into the weights before them; set_threads should be used only for the model that
+# dominates the run time of the script
+def load_tuned_model(filename, cuda=False, lookup_tables=False, quantize=False, batch_size=1, set_threads=False, profile='', adapter=''):
+    if quantize and cuda: raise ValueError("quantized inference is supported only on CPU, please don't use --quantize together with --cuda")
+
+    configuration = None if cuda else tuned_configuration(filename, batch_size, profile)
+
+    transforms = set()
+    if configuration is not None:
+        transforms.update(configuration['implementation'].split('+'))
+        if set_threads: apply_threads(configuration)
+    if lookup_tables: transforms.add('lookup_tables')
+    if quantize: transforms.add('quantize')
+
+    # the weights stay in the stored dtype (shared by all processes using the checkpoint) unless an adapter or a
+    # transform has to compute new float32 weights from them
+    dtype = None if adapter == '' and transforms <= {'default'} else torch.float32
+    model = load_model(filename, cuda, dtype)
+    if adapter != '': merge_adapter(model, adapter)
+
+    model = apply_implementation(model, transforms)
+    # the recurrent layers are timed when profiling is on
+    profiling.time_recurrence(model)
+    return model
+
+
+# random inputs of a predictor, one tuple per step
+def random_inputs(model, batch_size, n_steps):
+    if hasattr(model, 'chord_encoder'):
+        sizes = [model.event_encoder.num_embeddings, model.chord_encoder.num_embeddings]
+    elif hasattr(model, 'forward_encoder'):
+        sizes = [model.forward_encoder.num_embeddings]
+    else:
+        sizes = [model.encoder.num_embeddings]
+
+    return [tuple(torch.randint(size, (1, batch_size)) for size in sizes) for _ in range(n_steps)]
+
+
+# seconds per step of the network fed by the inputs
+def time_steps(model, inputs, batch_size):
+    model.init_hidden(batch_size)
+    with torch.no_grad():
+        for input in inputs[:10]:
+            model(*input)
+
+        start_time = time.perf_counter()
+        for input in inputs:
+            model(*input)
+    return (time.perf_counter() - start_time) / len(inputs)
+
+
+# benchmark all combinations in the current process (with its interop threads)
+def measure(filename, threads, batch_sizes, implementations, n_steps, repeats=3, seed=42):
+    torch.manual_seed(seed)
+    results = []
+
+    for implementation in implementations:
+        model = apply_implementation(load_model(filename), implementation)
+        model.eval()
+
+        for batch_size in batch_sizes:
+            inputs = random_inputs(model, batch_size, n_steps)
+            for n_threads in threads:
+                torch.set_num_threads(n_threads)
+                step_time = min(time_steps(model, inputs, batch_size) for _ in range(repeats))
+                results.append({'implementation': implementation, 'batch_size': batch_size, 'threads': n_threads,
+                                'interop_threads': torch.get_num_interop_threads(), 'ms_per_step': 1000 * step_time})
+
+    return results
+
+
+# benchmark the model with every number of interop threads (each in a fresh process) and return all results
+def tune(filename, threads, interop_threads, batch_sizes, implementations, n_steps):
+    results = []
+    for n_interop in interop_threads:
+        command = [sys.executable, '-W', 'ignore', os.path.abspath(__file__), os.path.abspath(filename), '--worker_interop_threads', str(n_interop),
+                   '--threads', ','.join(map(str, threads)), '--batch_sizes', ','.join(map(str, batch_sizes)),
+                   '--implementations', ','.join(implementations), '--steps', str(n_steps)]
+        output = subprocess.check_output(command, cwd=ROOT).decode()
+        results.extend(json.loads(output.strip().split('\n')[-1]))
+    return results
+
+
+# store the fastest configuration of every batch size into the profile of the machine
+def save_results(filename, results, path=''):
+    path = path or default_profile_path()
+    profile = load_profile(path) or {'machine': machine_info(), 'models': {}}
+
+    best = {}
+    for result in results:
+        key = str(result['batch_size'])
+        if key not in best or result['ms_per_step'] < best[key]['ms_per_step']:
+            best[key] = result
+
+    profile['models'][model_key(filename)] = {'stamp': model_stamp(filename), 'best': best, 'results': results}
+
+    if not os.path.isdir(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        json.dump(profile, f, indent=1)
+    return best
+
+
+def default_threads():
+    cpu_count = os.cpu_count() or 1
+    threads = [1]
+    while threads[-1] * 2 < cpu_count: threads.append(threads[-1] * 2)
+    if threads[-1] != cpu_count: threads.append(cpu_count)
+    return threads
+
+
+def parse_list(value, type=int):
+    return [type(item) for item in value.split(',') if item != '']
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generative Model -- CPU Inference Autotuning')
+    parser.add_argument('models', type=str, nargs='*', help='paths to trained models of any predictor, all shipped models when empty')
+    parser.add_argument('--threads', type=str, default='', help='comma separated numbers of torch threads, powers of two up to the number of cores when empty')
+    parser.add_argument('--interop_threads', type=str, default='', help='comma separated numbers of interop threads (default: 1 and the number of cores)')
+    parser.add_argument('--batch_sizes', type=str, default='1,8,32', help='comma separated batch sizes (default: 1,8,32)')
+    parser.add_argument('--implementations', type=str, default=','.join(IMPLEMENTATIONS), help='comma separated implementations, each one is "default" or transforms joined by "+" (default: all)')
+    parser.add_argument('--steps', type=int, default=200, help='number of measured steps of every configuration (default: 200)')
+    parser.add_argument('--profile', type=str, default='', help='path of the profile, empty uses Profiles/autotune-<hostname>.json')
+    parser.add_argument('--worker_interop_threads', type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    threads = parse_list(args.threads) or default_threads()
+    batch_sizes = parse_list(args.batch_sizes)
+    implementations = parse_list(args.implementations, str)
+
+    # a worker process measures a single model with the given interop threads and prints the results as JSON
+    if args.worker_interop_threads > 0:
+        torch.set_num_interop_threads(args.worker_interop_threads)
+        print(json.dumps(measure(args.models[0], threads, batch_sizes, implementations, args.steps)))
+        sys.exit(0)
+
+    interop_threads = parse_list(args.interop_threads) or sorted(set([1, os.cpu_count() or 1]))
+    models = args.models or [os.path.join(ROOT, filename) for filename in SHIPPED_MODELS if os.path.isfile(os.path.join(ROOT, filename))]
+
+    for filename in models:
+        best = save_results(filename, tune(filename, threads, interop_threads, batch_sizes, implementations, args.steps), args.profile)
+
+        print('-' * 89)
+        print('| {}'.format(filename))
+        for batch_size, result in sorted(best.items(), key=lambda item: int(item[0])):
+            print('| batch {:4d} | {:24s} | threads {:3d} | interop {:3d} | {:8.3f} ms per step'.format(
+                int(batch_size), result['implementation'], result['threads'], result['interop_threads'], result['ms_per_step']))
+    print('-' * 89)
+    print('saved into ' + (args.profile or default_profile_path()))
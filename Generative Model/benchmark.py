@@ -0,0 +1,333 @@
+"""Benchmarks of the data pipeline, the BN-LSTM and the generating, stored as JSON and compared between commits."""
+
+# The benchmarks run on a synthetic corpus (see synthetic.py) unless a real one is given: decoding by the Loader,
+# batchify and the iteration over all batches by get_batch, forward and backward passes of bnlstm.LSTM (and of both
+# cells in float32 and bfloat16 autocast) with the sizes of the shipped predictors (the Note Predictor isn't shipped, so its size is the default of music_train.py)
+# and the end-to-end generating of chords, volumes and whole songs with the shipped checkpoints. Every result
+# is a throughput (events per second, higher is better) of the best of several repeats, saved together with the
+# machine and the commit. --compare reports the changes between two result files and fails on regressions.
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+from torch import nn
+
+import bnlstm as bn
+import synthetic
+from autotune import machine_info
+from utils import *
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+BENCHMARKS = ['loader', 'batchify', 'bnlstm', 'bf16', 'softmax', 'generate']
+
+# input size, hidden size, layers and seq_len of the recurrent layers of the predictors
+PREDICTOR_SIZES = {
+    'note': (812, 800, 3, 120),
+    'chord': (16, 128, 2, 100),
+    'volume': (128, 64, 2, 60)
+}
+
+CHORD_MODEL = os.path.join(ROOT, 'Chord_Predictor', 'chord-model.loss_0.54380.pt')
+VOLUME_MODEL = os.path.join(ROOT, 'Volume_Predictor', 'volume-model.loss_0.02557.pt')
+
+
+# best and median time of the function over the repeats, in seconds
+def measure(function, repeats):
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start_time)
+    return min(times), statistics.median(times)
+
+
+def throughput(amount, times, unit='events/s'):
+    best, median = times
+    return {'value': amount / best, 'unit': unit, 'best_s': best, 'median_s': median}
+
+
+def bench_loader(corpus, repeats):
+    loader = Loader(corpus)
+    n_events = loader.total_event_inputs()
+
+    return {
+        'loader.create_event_tensor': throughput(n_events, measure(loader.create_event_tensor, repeats)),
+        'loader.create_chord_tensor': throughput(n_events, measure(loader.create_chord_tensor, repeats)),
+        'loader.create_volume_tensor': throughput(n_events, measure(loader.create_volume_tensor, repeats))
+    }
+
+
+def bench_batchify(corpus, batch_size, seq_len, repeats):
+    event_tensor, _ = Loader(corpus).create_event_tensor()
+    data = batchify(event_tensor, batch_size)
+    args = argparse.Namespace(seq_len=seq_len, cuda=False)
+
+    def iterate():
+        for i in range(0, data.size(0) - 1, seq_len):
+            get_batch(data, i, args)
+
+    return {
+        'batchify': throughput(len(event_tensor), measure(lambda: batchify(event_tensor, batch_size), repeats)),
+        'get_batch': throughput(data.numel(), measure(iterate, repeats))
+    }
+
+
+def bench_bnlstm(batch_size, repeats):
+    results = {}
+    for name, (input_size, hidden_size, layers, seq_len) in PREDICTOR_SIZES.items():
+        torch.manual_seed(42)
+        model = bn.LSTM(input_size=input_size, hidden_size=hidden_size, num_layers=layers, max_length=seq_len)
+        input = torch.randn(seq_len, batch_size, input_size)
+        hidden = (torch.zeros(layers, batch_size, hidden_size), torch.zeros(layers, batch_size, hidden_size))
+
+        def forward():
+            with torch.no_grad():
+                model(input, hx=hidden)
+
+        def forward_backward():
+            model.zero_grad()
+            output, _ = model(input, hx=hidden)
+            output.sum().backward()
+
+        # the first pass allocates the memory
+        forward_backward()
+        results['bnlstm.{}.forward'.format(name)] = throughput(seq_len * batch_size, measure(forward, repeats))
+        results['bnlstm.{}.forward_backward'.format(name)] = throughput(seq_len * batch_size, measure(forward_backward, repeats))
+
+    return results
+
+
+# training passes (forward and backward) of both recurrent cells in float32 and with bfloat16 autocast (--bf16 of
+# the training scripts), the weights and the gradients stay in float32
+def bench_bf16(batch_size, repeats):
+    results = {}
+    for name, (input_size, hidden_size, layers, seq_len) in PREDICTOR_SIZES.items():
+        torch.manual_seed(42)
+        models = {
+            'bnlstm': bn.LSTM(input_size=input_size, hidden_size=hidden_size, num_layers=layers, max_length=seq_len),
+            'lstm': nn.LSTM(input_size, hidden_size, layers)
+        }
+        input = torch.randn(seq_len, batch_size, input_size)
+        hidden = (torch.zeros(layers, batch_size, hidden_size), torch.zeros(layers, batch_size, hidden_size))
+
+        for cell, model in models.items():
+            for precision in ('fp32', 'bf16'):
+                def forward_backward():
+                    model.zero_grad()
+                    with torch.autocast('cpu', dtype=torch.bfloat16, enabled=precision == 'bf16'):
+                        output, _ = model(input, hx=hidden)
+                    output.float().sum().backward()
+
+                forward_backward()
+                results['bf16.{}.{}.{}'.format(name, cell, precision)] = throughput(seq_len * batch_size, measure(forward_backward, repeats))
+
+    return results
+
+
+# output layer and loss of the Note Predictor for a batch of seq_len steps, the full softmax and the cluster one
+def bench_softmax(batch_size, repeats):
+    from Note_Predictor.lstm_model import ClusterSoftmax
+
+    torch.manual_seed(42)
+    input_size, hidden_size, layers, seq_len = PREDICTOR_SIZES['note']
+    n_events = Loader.number_of_events()
+    hidden = torch.randn(seq_len * batch_size, hidden_size, requires_grad=True)
+    targets = torch.randint(n_events, (seq_len * batch_size,))
+
+    decoder = nn.Linear(hidden_size, n_events)
+    criterion = nn.CrossEntropyLoss()
+    cluster = ClusterSoftmax(hidden_size, n_events)
+    cluster.weight.data.normal_(0, 0.01)
+    cluster.bias.data.fill_(0)
+
+    results = {}
+    for name, loss in [('full', lambda: criterion(decoder(hidden), targets)), ('cluster', lambda: cluster.loss(hidden, targets))]:
+        loss().backward()
+        results['softmax.{}.forward_backward'.format(name)] = throughput(seq_len * batch_size, measure(lambda: loss().backward(), repeats))
+    return results
+
+
+# end-to-end generating with the shipped checkpoints, counted in generated events (without the priming)
+def bench_generate(length, primer_events, note_model, repeats):
+    from Note_Predictor.lstm_model import lstm_model
+    from Note_Predictor.music_generate import generate_chords, generate_music, generate_volumes
+
+    chord_model = load_model(CHORD_MODEL)
+    volume_model = load_model(VOLUME_MODEL)
+    if note_model != '':
+        note_model = load_model(note_model)
+    else:
+        # an untrained network of the default size is as fast as a trained one
+        torch.manual_seed(42)
+        input_size, hidden_size, layers, seq_len = PREDICTOR_SIZES['note']
+        note_model = lstm_model(hidden_size, input_size - hidden_size, Loader.number_of_events(), hidden_size, layers, Loader.number_of_chords(), 0.1, True, 'bnlstm', seq_len)
+
+    with tempfile.TemporaryDirectory() as folder:
+        primer = os.path.join(folder, 'primer.mus')
+        synthetic.synthesize_corpus(primer, primer_events, primer_events)
+        events = [event for event, _ in Loader(primer).iterate_events()]
+        regressed = (events * (length // len(events) + 1))[:length]
+
+        args = argparse.Namespace(cuda=False, priming_length=min(100, len(events)), chord_priming_length=20, n_primes=1, max_length=length,
+                                  temperature=0.95, chord_temperature=1.0, single_instrument=False)
+
+        def run(function):
+            def timed():
+                torch.manual_seed(42)
+                with torch.no_grad(), contextlib.redirect_stdout(io.StringIO()):
+                    timed.result = function()
+            times = measure(timed, repeats)
+            return len(timed.result), times
+
+        # generate_chords looks for the primer in ../Primers/, so the generating runs in a predictor folder
+        working_directory = os.getcwd()
+        os.chdir(os.path.join(ROOT, 'Note_Predictor'))
+        try:
+            n, times = run(lambda: generate_chords(chord_model, os.path.relpath(primer, '../Primers/'), False, 20, length, 1.0, 1))
+            chords = throughput(n, times, 'chords/s')
+            n, times = run(lambda: generate_volumes(volume_model, primer, False, args.priming_length, 1, regressed))
+            volumes = throughput(n, times)
+            n, times = run(lambda: generate_music(args, primer, note_model, chord_model, volume_model))
+            songs = throughput(n, times)
+        finally:
+            os.chdir(working_directory)
+
+    return {'generate.chord': chords, 'generate.volume': volumes, 'generate.music': songs}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def default_output_path(commit):
+    return os.path.join(ROOT, 'Benchmarks', '{}-{}.json'.format(platform.node() or 'default', commit))
+
+
+def run_benchmarks(args):
+    corpus = args.corpus
+    temporary = None
+    if corpus == '':
+        temporary = tempfile.NamedTemporaryFile(suffix='.mus', delete=False)
+        temporary.close()
+        corpus = temporary.name
+        synthetic.synthesize_corpus(corpus, args.events, seed=args.seed)
+
+    benchmarks = [name for name in args.benchmarks.split(',') if name != '']
+    results = {}
+    try:
+        for name in benchmarks:
+            print('running ' + name)
+            if name == 'loader': results.update(bench_loader(corpus, args.repeats))
+            elif name == 'batchify': results.update(bench_batchify(corpus, args.batch_size, args.seq_len, args.repeats))
+            elif name == 'bnlstm': results.update(bench_bnlstm(args.batch_size, args.repeats))
+            elif name == 'bf16': results.update(bench_bf16(args.batch_size, args.repeats))
+            elif name == 'softmax': results.update(bench_softmax(args.batch_size, args.repeats))
+            elif name == 'generate': results.update(bench_generate(args.length, args.primer_events, args.note_model, args.repeats))
+            else: raise ValueError("unknown benchmark '{}', the supported ones are {}".format(name, ', '.join(BENCHMARKS)))
+    finally:
+        if temporary is not None: os.remove(corpus)
+
+    return {
+        'machine': machine_info(),
+        'commit': git_commit(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'threads': torch.get_num_threads(),
+        'parameters': {'corpus': args.corpus or 'synthetic', 'events': Loader(args.corpus).total_event_inputs() if args.corpus else args.events,
+                       'batch_size': args.batch_size, 'seq_len': args.seq_len, 'length': args.length, 'repeats': args.repeats},
+        'results': results
+    }
+
+
+# changes of all results between two runs, a result slower by more than the tolerance is a regression
+def compare(base, new, tolerance):
+    rows = []
+    for key in sorted(set(base['results']) | set(new['results'])):
+        old_value = base['results'].get(key, {}).get('value')
+        new_value = new['results'].get(key, {}).get('value')
+        if old_value is None or new_value is None:
+            rows.append((key, old_value, new_value, None, 'missing'))
+            continue
+
+        change = new_value / old_value - 1
+        status = 'REGRESSION' if change < -tolerance else 'faster' if change > tolerance else 'ok'
+        rows.append((key, old_value, new_value, change, status))
+    return rows
+
+
+def print_results(results):
+    print('-' * 89)
+    for key, result in sorted(results['results'].items()):
+        print('| {:36s} | {:14.1f} {:10s} | best {:9.4f} s | median {:9.4f} s'.format(key, result['value'], result['unit'], result['best_s'], result['median_s']))
+    print('-' * 89)
+
+
+def print_comparison(rows, base, new):
+    print('-' * 89)
+    print('| {} ({}) -> {} ({})'.format(base['commit'], base['date'], new['commit'], new['date']))
+    if base['machine'] != new['machine'] or base.get('threads') != new.get('threads'):
+        print('| WARNING: the results were measured on different machines or with different threads')
+    print('-' * 89)
+    for key, old_value, new_value, change, status in rows:
+        if change is None:
+            print('| {:36s} | {:>14s} | {:>14s} | {:>8s} | {}'.format(key, '-' if old_value is None else '{:.1f}'.format(old_value),
+                                                                     '-' if new_value is None else '{:.1f}'.format(new_value), '', status))
+        else:
+            print('| {:36s} | {:14.1f} | {:14.1f} | {:+7.1%} | {}'.format(key, old_value, new_value, change, status))
+    print('-' * 89)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generative Model -- Benchmarks')
+    parser.add_argument('--benchmarks', type=str, default=','.join(BENCHMARKS), help='comma separated benchmarks to run (default: all of {})'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--corpus', type=str, default='', help='.mus file used by the loader and batchify benchmarks, a synthetic corpus of --events events when empty')
+    parser.add_argument('--events', type=int, default=200000, help='number of events of the synthetic corpus (default: 200000)')
+    parser.add_argument('--batch_size', type=int, default=16, help='batch size of batchify, bnlstm, bf16 and softmax (default: 16)')
+    parser.add_argument('--seq_len', type=int, default=120, help='sequence length of get_batch (default: 120)')
+    parser.add_argument('--length', type=int, default=500, help='number of events generated end-to-end (default: 500)')
+    parser.add_argument('--primer_events', type=int, default=300, help='number of events of the synthetic primer of the generating (default: 300)')
+    parser.add_argument('--note_model', type=str, default='', help='Note Predictor of the end-to-end generating, an untrained network of the default size when empty')
+    parser.add_argument('--repeats', type=int, default=3, help='number of repeats of every benchmark, the best one counts (default: 3)')
+    parser.add_argument('--threads', type=int, default=0, help='number of torch threads, 0 keeps the default (default: 0)')
+    parser.add_argument('--seed', type=int, default=42, help='random seed of the synthetic corpus (default: 42)')
+    parser.add_argument('--output', type=str, default='', help='path of the results, empty uses Benchmarks/<hostname>-<commit>.json')
+    parser.add_argument('--compare', type=str, nargs=2, default=None, metavar=('BASE', 'NEW'), help='compare two result files instead of running the benchmarks')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative slowdown reported as a regression by --compare (default: 0.1)')
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        with open(args.compare[0]) as f:
+            base = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+
+        rows = compare(base, new, args.tolerance)
+        print_comparison(rows, base, new)
+        if any(status == 'REGRESSION' for *_, status in rows): sys.exit(1)
+        sys.exit(0)
+
+    if args.threads > 0: torch.set_num_threads(args.threads)
+
+    results = run_benchmarks(args)
+    print_results(results)
+
+    path = args.output or default_output_path(results['commit'])
+    if os.path.dirname(path) != '' and not os.path.isdir(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('saved into ' + path)
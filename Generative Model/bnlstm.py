@@ -30,8 +30,8 @@ class SeparatedBatchNorm1d(nn.Module):
         self.eps = eps
         self.momentum = momentum
         if self.affine:
-            self.weight = nn.Parameter(torch.FloatTensor(num_features))
-            self.bias = nn.Parameter(torch.FloatTensor(num_features))
+            self.weight = nn.Parameter(torch.empty(num_features))
+            self.bias = nn.Parameter(torch.empty(num_features))
         else:
             self.register_parameter('weight', None)
             self.register_parameter('bias', None)
@@ -63,8 +63,10 @@ class SeparatedBatchNorm1d(nn.Module):
             time = self.max_length - 1
         running_mean = getattr(self, 'running_mean_{}'.format(time))
         running_var = getattr(self, 'running_var_{}'.format(time))
+        # normalize in the dtype of the running statistics: float32 under bfloat16 autocast, so the statistics
+        # stay exact, or half precision when the weights of a checkpoint are kept as they are stored
         return functional.batch_norm(
-            input=input_, running_mean=running_mean, running_var=running_var,
+            input=input_.to(running_mean.dtype), running_mean=running_mean, running_var=running_var,
             weight=self.weight, bias=self.bias, training=self.training,
             momentum=self.momentum, eps=self.eps)
 
@@ -86,10 +88,10 @@ class BNLSTMCell(nn.Module):
         self.hidden_size = hidden_size
         self.max_length = max_length
         self.use_bias = use_bias
-        self.weight_ih = nn.Parameter(torch.FloatTensor(input_size, 4 * hidden_size))
-        self.weight_hh = nn.Parameter(torch.FloatTensor(hidden_size, 4 * hidden_size))
+        self.weight_ih = nn.Parameter(torch.empty(input_size, 4 * hidden_size))
+        self.weight_hh = nn.Parameter(torch.empty(hidden_size, 4 * hidden_size))
         if use_bias:
-            self.bias = nn.Parameter(torch.FloatTensor(4 * hidden_size))
+            self.bias = nn.Parameter(torch.empty(4 * hidden_size))
         else:
             self.register_parameter('bias', None)
         # BN parameters
@@ -112,7 +114,7 @@ class BNLSTMCell(nn.Module):
         # matrix.
         weight_hh_data = torch.eye(self.hidden_size)
         weight_hh_data = weight_hh_data.repeat(1, 4)
-        self.weight_hh.data.set_(weight_hh_data)
+        self.weight_hh.data.copy_(weight_hh_data)
         # The bias is just set to zero vectors.
         init.constant(self.bias.data, val=0)
         # Initialization of BN parameters.
@@ -141,15 +143,29 @@ class BNLSTMCell(nn.Module):
         """
 
         h_0, c_0 = hx
-        batch_size = h_0.size(0)
-        bias_batch = (self.bias.unsqueeze(0)
-                      .expand(batch_size, *self.bias.size()))
         wh = torch.mm(h_0, self.weight_hh)
         wi = torch.mm(input_, self.weight_ih)
+        return self.recurrence(wi, wh, c_0, time)
+
+    def recurrence(self, wi, wh, c_0, time):
+        """
+        Args:
+            wi: A (batch, 4 * hidden_size) tensor with the input projection.
+            wh: A (batch, 4 * hidden_size) tensor with the hidden projection.
+            c_0: A (batch, hidden_size) tensor with the cell state.
+            time: The current timestep value.
+
+        Returns:
+            h_1, c_1: Tensors containing the next hidden and cell state.
+        """
+
+        batch_size = c_0.size(0)
+        bias_batch = (self.bias.unsqueeze(0)
+                      .expand(batch_size, *self.bias.size()))
         bn_wh = self.bn_hh(wh, time=time)
         bn_wi = self.bn_ih(wi, time=time)
         f, i, o, g = torch.split(bn_wh + bn_wi + bias_batch,
-                                 split_size=self.hidden_size, dim=1)
+                                 self.hidden_size, dim=1)
         c_1 = torch.sigmoid(f)*c_0 + torch.sigmoid(i)*torch.tanh(g)
         h_1 = torch.sigmoid(o) * torch.tanh(self.bn_c(c_1, time=time))
         return h_1, c_1
@@ -192,7 +208,7 @@ class LSTM(nn.Module):
         output = []
         for time in range(max_time):
             h_next, c_next = cell(input_=input_[time], hx=hx, time=time)
-            mask = (time < length).float().unsqueeze(1).expand_as(h_next)
+            mask = (time < length).to(h_next.dtype).unsqueeze(1).expand_as(h_next)
             h_next = h_next*mask + hx[0]*(1 - mask)
             c_next = c_next*mask + hx[1]*(1 - mask)
             hx_next = (h_next, c_next)
@@ -0,0 +1,301 @@
+"""Checkpoint format with an explicit config and memory-mapped weights."""
+
+# A checkpoint consists of two files:
+#  - <name>.json with the predictor type, the constructor arguments of its network and the layout of the weights
+#  - <name>.tensors with the raw bytes of all tensors of the state dict, each one aligned to ALIGNMENT bytes
+# Loading doesn't unpickle anything, the network is rebuilt from the config without allocating its weights and
+# the tensors are views into a copy-on-write memory map of the tensor file, so processes loading the same checkpoint
+# share its pages. Weights stored in half precision are shared only when they are kept in the stored dtype
+# (dtype=None), which the generating scripts do; a conversion to float32 makes a private copy in every process.
+
+import argparse
+import importlib
+import json
+import os
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+from torch import nn
+
+import bnlstm as bn
+
+
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+# folder with the lstm_model definition of each predictor
+PREDICTORS = {'note': 'Note_Predictor', 'chord': 'Chord_Predictor', 'volume': 'Volume_Predictor', 'joint': 'Note_Predictor'}
+
+DTYPES = {'float32': torch.float32, 'float16': torch.float16, 'bfloat16': torch.bfloat16}
+
+
+# predictor type and constructor arguments of a network (with argument names of the respective lstm_model)
+def model_config(model):
+    if hasattr(model, 'chord_encoder'):
+        return 'joint' if hasattr(model, 'volume_decoder') else 'note', {
+            'event_emsize': model.event_encoder.embedding_dim,
+            'chord_emsize': model.chord_encoder.embedding_dim,
+            'events_size': model.event_encoder.num_embeddings,
+            'hidden_size': model.hidden_size,
+            'layers': model.n_layers,
+            'chords_size': model.chord_encoder.num_embeddings,
+            'dropout': model.drop.p,
+            'tie_weights': model.decoder.weight is model.event_encoder.weight,
+            'cell': model.cell,
+            'seq_len': model.seq_len,
+            'softmax': getattr(model, 'softmax', 'full')
+        }
+
+    if hasattr(model, 'forward_encoder'):
+        return 'volume', {
+            'emsize': model.forward_encoder.embedding_dim,
+            'hidden_size': model.hidden_size,
+            'layers': model.n_layers,
+            'event_size': model.forward_encoder.num_embeddings,
+            'dropout': model.drop.p,
+            'cell': model.cell,
+            'seq_len': model.seq_len,
+            'tie_weights': False
+        }
+
+    return 'chord', {
+        'emsize': model.encoder.embedding_dim,
+        'hidden_size': model.hidden_size,
+        'layers': model.n_layers,
+        'chords_size': model.encoder.num_embeddings,
+        'dropout': model.drop.p,
+        'tie_weights': model.decoder.weight is model.encoder.weight,
+        'cell': model.cell,
+        'seq_len': model.seq_len
+    }
+
+
+def model_class(predictor):
+    module = importlib.import_module('{}.lstm_model'.format(PREDICTORS[predictor]))
+    return module.joint_model if predictor == 'joint' else module.lstm_model
+
+
+def checkpoint_paths(filename):
+    stem = filename[:-len('.json')] if filename.endswith('.json') else os.path.splitext(filename)[0]
+    return stem + '.json', stem + '.tensors'
+
+
+# the weights are overwritten by the checkpoint anyway, so skip the (costly) random initialization of the network
+@contextmanager
+def skip_initialization(cls):
+    patched = [(nn.Embedding, 'reset_parameters'), (nn.Linear, 'reset_parameters'), (nn.LSTM, 'reset_parameters'),
+               (bn.BNLSTMCell, 'reset_parameters'), (bn.SeparatedBatchNorm1d, 'reset_parameters'), (cls, 'init_weights')]
+    originals = [(owner, name, owner.__dict__[name]) for owner, name in patched if name in owner.__dict__]
+
+    for owner, name, _ in originals:
+        setattr(owner, name, lambda self: None)
+    try:
+        yield
+    finally:
+        for owner, name, original in originals:
+            setattr(owner, name, original)
+
+
+# write the network as a config and a tensor file, floating point weights are converted to the given dtype
+def save_checkpoint(model, filename, dtype='float32'):
+    config_filename, tensors_filename = checkpoint_paths(filename)
+    predictor, config = model_config(model)
+
+    entries = {}
+    stored = {}
+    offset = 0
+
+    with open(tensors_filename, 'wb') as f:
+        for key, tensor in model.state_dict().items():
+            # tied weights are stored only once
+            if tensor.data_ptr() in stored and entries[stored[tensor.data_ptr()]]['shape'] == list(tensor.size()):
+                entries[key] = entries[stored[tensor.data_ptr()]]
+                continue
+            stored[tensor.data_ptr()] = key
+
+            tensor = tensor.detach().cpu()
+            if tensor.is_floating_point(): tensor = tensor.to(DTYPES[dtype])
+            data = tensor.contiguous().view(-1).view(torch.uint8).numpy().tobytes()
+
+            padding = -offset % ALIGNMENT
+            f.write(bytes(padding))
+            offset += padding
+
+            entries[key] = {'dtype': str(tensor.dtype).replace('torch.', ''), 'shape': list(tensor.size()), 'offset': offset}
+            f.write(data)
+            offset += len(data)
+
+    with open(config_filename, 'w') as f:
+        json.dump({
+            'format': FORMAT_VERSION,
+            'predictor': predictor,
+            'dtype': dtype,
+            'config': config,
+            'tensors': os.path.basename(tensors_filename),
+            'entries': entries
+        }, f, indent=1)
+
+    return config_filename
+
+
+# map the tensor file into memory and cut the state dict out of it (without copying anything)
+def map_tensors(filename, entries):
+    data = torch.from_numpy(np.memmap(filename, dtype=np.uint8, mode='c'))
+
+    state = {}
+    for key, entry in entries.items():
+        dtype = getattr(torch, entry['dtype'])
+        numel = int(np.prod(entry['shape']))
+        size = numel * torch.empty(0, dtype=dtype).element_size()
+        state[key] = data[entry['offset']:entry['offset'] + size].view(dtype).view(entry['shape'])
+    return state
+
+
+# use the mapped tensors directly as parameters and buffers of the network,
+# cheaper than load_state_dict as the BN-LSTM has thousands of small per-timestep buffers
+def assign_state(model, state):
+    modules = dict(model.named_modules())
+    for key, tensor in state.items():
+        path, _, name = key.rpartition('.')
+        module = modules.get(path)
+
+        if module is not None and name in module._parameters:
+            setattr(module, name, nn.Parameter(tensor))
+        elif module is not None and name in module._buffers:
+            module._buffers[name] = tensor
+        else:
+            raise ValueError('unexpected tensor {} in the checkpoint'.format(key))
+
+
+# rebuild the network from the config and map its weights from the tensor file,
+# weights stored in half precision are converted to dtype (pass None to keep them as they are stored)
+def load_checkpoint(filename, cuda=False, dtype=torch.float32):
+    config_filename, _ = checkpoint_paths(filename)
+    with open(config_filename) as f:
+        checkpoint = json.load(f)
+
+    if checkpoint['format'] > FORMAT_VERSION:
+        raise ValueError('{} has checkpoint format {}, only formats up to {} are supported'.format(config_filename, checkpoint['format'], FORMAT_VERSION))
+
+    # the network is built without any storage, every parameter and buffer is then a view into the tensor file
+    cls = model_class(checkpoint['predictor'])
+    config = checkpoint['config']
+    with skip_initialization(cls), torch.device('meta'):
+        model = cls(**config)
+
+    state = map_tensors(os.path.join(os.path.dirname(config_filename), checkpoint['tensors']), checkpoint['entries'])
+    if dtype is not None:
+        state = {key: tensor.to(dtype) if tensor.is_floating_point() else tensor for key, tensor in state.items()}
+
+    assign_state(model, state)
+
+    # assigning the state breaks the tie between the embedding and the decoder, restore it
+    if config.get('tie_weights', False):
+        if checkpoint['predictor'] in ('note', 'joint'):
+            model.decoder.weight = model.event_encoder.weight
+        elif checkpoint['predictor'] == 'chord':
+            model.decoder.weight = model.encoder.weight
+
+    if cuda: model.cuda()
+    model.eval()
+    return model
+
+
+# kB of anonymous memory (which no other process can share) of this process and its proportional share of the
+# given mapped file (the pages mapped by n processes count 1/n in each of them)
+def memory_usage(mapped_filename=None):
+    anonymous, mapped, current = 0, 0, None
+    with open('/proc/self/smaps') as f:
+        for line in f:
+            fields = line.split()
+            if not fields[0].endswith(':'): current = fields[5] if len(fields) > 5 else None
+            elif fields[0] == 'Anonymous:': anonymous += int(fields[1])
+            elif fields[0] == 'Pss:' and mapped_filename is not None and current == mapped_filename: mapped += int(fields[1])
+    return anonymous, mapped
+
+
+# a worker of measure_load: load the model for inference (in the stored dtype) and read all its weights like the
+# first generated steps do, then wait until all workers got here and report the load time and the memory, the
+# standard input tells when to measure and when to exit
+def measure_worker(filename):
+    tensors_filename = None
+    if filename.endswith('.json'):
+        with open(filename) as f:
+            tensors_filename = os.path.join(os.path.dirname(os.path.abspath(filename)), json.load(f)['tensors'])
+
+    from utils import load_model
+
+    anonymous, _ = memory_usage()
+    start_time = time.time()
+    model = load_model(filename, dtype=None)
+    load_time = time.time() - start_time
+
+    with torch.no_grad():
+        for tensor in model.state_dict().values():
+            tensor.sum()
+
+    print('ready', flush=True)
+    sys.stdin.readline()
+
+    loaded, mapped = memory_usage(tensors_filename)
+    print(load_time, loaded - anonymous, mapped, flush=True)
+
+    # the model is held until all workers are measured
+    sys.stdin.readline()
+
+
+# load the model in `processes` fresh processes at once, returns the load time of one of them, the private memory
+# of the model in one process and the memory of the model in all of them together (the shared pages counted once)
+def measure_load(filename, processes=1):
+    root = os.path.dirname(os.path.abspath(__file__))
+    command = [sys.executable, '-W', 'ignore', os.path.abspath(__file__), os.path.abspath(filename), '--measure_worker', 'True']
+    workers = [subprocess.Popen(command, cwd=root, stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True) for _ in range(processes)]
+
+    # the memory is read while every worker holds its model
+    for worker in workers:
+        if worker.stdout.readline().strip() != 'ready': raise RuntimeError('measuring {} failed'.format(filename))
+    for worker in workers:
+        worker.stdin.write('\n')
+        worker.stdin.flush()
+    results = [worker.stdout.readline().split() for worker in workers]
+    for worker in workers:
+        worker.communicate('\n')
+
+    load_time, private, _ = results[0]
+    total = sum(int(anonymous) + int(mapped) for _, anonymous, mapped in results)
+    return float(load_time), int(private), total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generative Model -- Checkpoint Converter')
+    parser.add_argument('models', type=str, nargs='+', help='paths to models saved by torch.save (e.g. Chord_Predictor/chord-model.loss_0.54380.pt)')
+    parser.add_argument('--dtype', type=str, default='float32', help='dtype of the stored weights, supported values are "float32", "float16" and "bfloat16" (default: float32)')
+    parser.add_argument('--compare', type=bool, default=False, help='measure load time and memory of the original and the converted checkpoint (default: False)')
+    parser.add_argument('--processes', type=int, default=4, help='number of processes loading the model at once when comparing the memory (default: 4)')
+    parser.add_argument('--measure_worker', type=bool, default=False, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # a worker process of --compare measures a single model
+    if args.measure_worker:
+        measure_worker(args.models[0])
+        sys.exit(0)
+
+    from utils import load_model
+
+    for filename in args.models:
+        model = load_model(filename)
+        config_filename = save_checkpoint(model, filename, args.dtype)
+        print('converted {} to {}'.format(filename, config_filename))
+
+        # the private memory is the anonymous memory of the model in one process (the mapped weights are shared and
+        # aren't part of it), the total is the memory of the model in all processes with the shared pages counted once
+        if args.compare:
+            print('-' * 89)
+            for name in (filename, config_filename):
+                load_time, private, total = measure_load(name, args.processes)
+                print('| {:40s} | load {:8.2f} ms | private +{:7d} kB | {} processes +{:7d} kB'.format(os.path.basename(name)[-40:], 1000 * load_time, private, args.processes, total))
+            print('-' * 89)
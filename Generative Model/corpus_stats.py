@@ -0,0 +1,293 @@
+"""Statistics of .mus corpora computed by vectorized operations over the raw records, in chunks and in parallel."""
+
+# A .mus file is read as an (N, 4) array of its records (memory mapped, in chunks of --chunk_size records) and
+# every statistic is computed by numpy over the whole chunk: the event counts and pitches of every instrument
+# cluster, the durations of notes (a note-on is ended by the next note-off of its pitch in its cluster, by the
+# next note-on of the same pitch, or by the end of the song), the number of sounding notes in every frame, the
+# chords on the beats and their transitions, and the gaps between notes. Times are counted in 50 ms frames from
+# the start of every song (a song ends by the end event). The only state carried from one chunk to the next is
+# the time and the last chord of the current song and its sounding notes, so the memory doesn't depend on the
+# size of the file. All statistics are sums, the files are processed in worker processes and their statistics
+# added. The report is plain text with one statistic per line, so the reports of two versions of a dataset can
+# be compared by diff.
+
+import argparse
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from utils import Loader, find_files
+
+
+NUM_CLUSTERS = Loader.num_clusters
+CLUSTER_RANGES = np.array(Loader.cluster_range)
+PERCUSSION = 9
+MAX_RANGE = 64  # keys of notes are cluster * MAX_RANGE + pitch
+NUM_CHORDS = Loader.number_of_chords()
+MAX_DURATION = 97  # longer notes are counted in the last bin
+MAX_POLYPHONY = 64
+MAX_GAP = 49
+BIG_SPACE_FRAMES = 6
+FRAMES_PER_BEAT = 12
+FRAME_SECONDS = 0.05
+
+EVENT_TYPES = ['note_on', 'note_off', 'percussion_on', 'percussion_off', 'small_space', 'big_space', 'end', 'invalid']
+
+
+class CorpusStatistics:
+
+    def __init__(self):
+        self.files = 0
+        self.songs = 0
+        self.frames = 0
+        self.event_types = np.zeros(len(EVENT_TYPES), dtype=np.int64)
+        self.note_ons = np.zeros(NUM_CLUSTERS * MAX_RANGE, dtype=np.int64)
+        self.note_offs = np.zeros(NUM_CLUSTERS * MAX_RANGE, dtype=np.int64)
+        self.durations = np.zeros(NUM_CLUSTERS * MAX_DURATION, dtype=np.int64)
+        self.unended_notes = np.zeros(NUM_CLUSTERS, dtype=np.int64)
+        self.orphan_offs = np.zeros(NUM_CLUSTERS, dtype=np.int64)
+        self.polyphony = np.zeros(MAX_POLYPHONY, dtype=np.int64)  # frames with the given number of sounding notes
+        self.beat_chords = np.zeros(NUM_CHORDS, dtype=np.int64)
+        self.chord_transitions = np.zeros(NUM_CHORDS * NUM_CHORDS, dtype=np.int64)
+        self.gaps = np.zeros(MAX_GAP + 1, dtype=np.int64)  # frames between the following times with notes
+
+    def add(self, other):
+        for name, value in vars(other).items():
+            setattr(self, name, getattr(self, name) + value)
+        return self
+
+
+# the state of the song that continues into the next chunk
+class StreamState:
+
+    def __init__(self):
+        self.time = 0
+        self.in_song = False
+        self.chord = -1  # last chord on a beat
+        self.note_time = -1  # last time with a note event
+        self.sounding_keys = np.zeros(0, dtype=np.int64)
+        self.sounding_times = np.zeros(0, dtype=np.int64)
+
+
+def time_within_songs(advance, is_end, carried_time):
+    frames = np.cumsum(advance)
+    # frames counted before the start of the song of every record
+    restart = np.maximum.accumulate(np.where(is_end, frames + carried_time, 0))
+    restart = np.concatenate(([0], restart[:-1]))
+    return frames + carried_time - restart
+
+
+def histogram(values, size, weights=None):
+    return np.bincount(values, weights=weights, minlength=size)[:size].astype(np.int64)
+
+
+# add the statistics of a chunk of records, the state continues the song of the previous chunk
+def update(stats, state, records):
+    n = len(records)
+    if n == 0: return
+    typ = (records[:, 0] & 0x0F).astype(np.int64)
+    is_end = typ == 6
+
+    cluster = np.where(typ == 0, records[:, 0] >> 4, np.where(typ == 1, records[:, 2], PERCUSSION)).astype(np.int64)
+    pitch = records[:, 1].astype(np.int64)
+    is_note = typ <= 3
+    valid = ~is_note | ((cluster < NUM_CLUSTERS) & (pitch < CLUSTER_RANGES[np.minimum(cluster, NUM_CLUSTERS - 1)]))
+    typ = np.where(valid & (typ <= 6), typ, 7)
+    is_note = typ <= 3
+    is_on = (typ == 0) | (typ == 2)
+
+    stats.event_types += histogram(typ, len(EVENT_TYPES))
+    key = cluster * MAX_RANGE + pitch
+    stats.note_ons += histogram(key[is_on], NUM_CLUSTERS * MAX_RANGE)
+    stats.note_offs += histogram(key[is_note & ~is_on], NUM_CLUSTERS * MAX_RANGE)
+
+    advance = np.where(typ == 4, 1, np.where(typ == 5, BIG_SPACE_FRAMES, 0))
+    stats.frames += int(advance.sum())
+    times = time_within_songs(advance, is_end, state.time)
+    song = np.cumsum(is_end) - is_end
+    last_song = int(song[-1])
+    continues = not is_end[-1]
+
+    stats.songs += int(is_end.sum())
+    state.in_song = continues
+
+    # notes: the carried ones first, sorted by song, key and position, every note-on is ended by the next
+    # event of its group
+    carried = len(state.sounding_keys)
+    note_positions = np.concatenate((np.full(carried, -1), np.flatnonzero(is_note)))
+    note_keys = np.concatenate((state.sounding_keys, key[is_note]))
+    note_times = np.concatenate((state.sounding_times, times[is_note]))
+    note_songs = np.concatenate((np.zeros(carried, dtype=np.int64), song[is_note]))
+    note_is_on = np.concatenate((np.ones(carried, dtype=bool), is_on[is_note]))
+
+    order = np.lexsort((note_positions, note_keys, note_songs))
+    note_positions, note_keys, note_times, note_songs, note_is_on = note_positions[order], note_keys[order], note_times[order], note_songs[order], note_is_on[order]
+    same_next = np.zeros(len(order), dtype=bool)
+    same_next[:-1] = (note_songs[1:] == note_songs[:-1]) & (note_keys[1:] == note_keys[:-1])
+
+    ended = note_is_on & same_next
+    ended_index = np.flatnonzero(ended)
+    durations = note_times[ended_index + 1] - note_times[ended_index]
+    note_clusters = note_keys // MAX_RANGE
+    stats.durations += histogram(note_clusters[ended_index] * MAX_DURATION + np.minimum(durations, MAX_DURATION - 1), NUM_CLUSTERS * MAX_DURATION)
+
+    previous_on = np.zeros(len(order), dtype=bool)
+    previous_on[1:] = ended[:-1]
+    stats.orphan_offs += histogram(note_clusters[~note_is_on & ~previous_on], NUM_CLUSTERS)
+
+    # notes still sounding at the end of the chunk continue, the others end with their songs
+    open_notes = note_is_on & ~same_next
+    still_sounding = open_notes & (note_songs == last_song) & continues
+    stats.unended_notes += histogram(note_clusters[open_notes & ~still_sounding], NUM_CLUSTERS)
+    state.sounding_keys = note_keys[still_sounding]
+    state.sounding_times = note_times[still_sounding]
+
+    # polyphony: +1 at every note-on, -1 where its note ends, the frames of every time shift are counted with the
+    # number of notes sounding before it
+    delta = np.zeros(n, dtype=np.int64)
+    np.add.at(delta, note_positions[note_is_on & (note_positions >= 0)], 1)
+    np.add.at(delta, note_positions[ended_index + 1], -1)
+    end_positions = np.flatnonzero(is_end)
+    np.add.at(delta, end_positions[note_songs[open_notes & ~still_sounding]], -1)
+    level = carried + np.cumsum(delta) - delta
+    stats.polyphony += histogram(np.minimum(level, MAX_POLYPHONY - 1), MAX_POLYPHONY, advance)
+
+    # chords of the time shifts that end on a beat, transitions within songs
+    on_beat = (advance > 0) & (times % FRAMES_PER_BEAT == 0)
+    chords = np.minimum(records[on_beat, 3].astype(np.int64), NUM_CHORDS - 1)
+    chord_songs = song[on_beat]
+    stats.beat_chords += histogram(chords, NUM_CHORDS)
+    previous_chords = np.concatenate(([state.chord], chords[:-1]))
+    previous_songs = np.concatenate(([0], chord_songs[:-1]))
+    transition = (previous_chords >= 0) & (previous_songs == chord_songs)
+    stats.chord_transitions += histogram(previous_chords[transition] * NUM_CHORDS + chords[transition], NUM_CHORDS * NUM_CHORDS)
+    if not continues: state.chord = -1
+    elif len(chords) > 0 and chord_songs[-1] == last_song: state.chord = int(chords[-1])
+    elif last_song > 0: state.chord = -1
+
+    # gaps between the following times with note events within songs
+    event_times = times[is_note]
+    event_songs = song[is_note]
+    previous_times = np.concatenate(([state.note_time], event_times[:-1]))
+    previous_songs = np.concatenate(([0], event_songs[:-1]))
+    gap = (previous_times >= 0) & (previous_songs == event_songs) & (event_times > previous_times)
+    stats.gaps += histogram(np.minimum(event_times[gap] - previous_times[gap], MAX_GAP), MAX_GAP + 1)
+    if not continues: state.note_time = -1
+    elif len(event_times) > 0 and event_songs[-1] == last_song: state.note_time = int(event_times[-1])
+    elif last_song > 0: state.note_time = -1
+
+    state.time = int(times[-1]) if continues else 0
+
+
+def file_statistics(filename, chunk_size=1 << 20):
+    stats = CorpusStatistics()
+    stats.files = 1
+    state = StreamState()
+
+    size = os.path.getsize(filename) // 4
+    if size > 0:
+        records = np.memmap(filename, dtype=np.uint8, mode='r', shape=(size, 4))
+        for start in range(0, size, chunk_size):
+            update(stats, state, np.asarray(records[start:start + chunk_size]))
+
+    # a song without an end event ends with the file
+    if state.in_song: stats.songs += 1
+    stats.unended_notes += histogram(state.sounding_keys // MAX_RANGE, NUM_CLUSTERS)
+    return stats
+
+
+def statistics_in_worker(job):
+    return file_statistics(*job)
+
+
+# statistics of all files added together, computed in `workers` processes or in this one when workers is 0
+def corpus_statistics(filenames, workers=0, chunk_size=1 << 20):
+    stats = CorpusStatistics()
+    jobs = [(filename, chunk_size) for filename in filenames]
+    if workers == 0:
+        for job in jobs:
+            stats.add(statistics_in_worker(job))
+        return stats
+
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        for file_stats in pool.imap_unordered(statistics_in_worker, jobs):
+            stats.add(file_stats)
+    return stats
+
+
+# (mean, 50th, 90th and 99th percentile) of a histogram
+def summary(counts):
+    total = counts.sum()
+    if total == 0: return 0.0, 0, 0, 0
+    cumulative = np.cumsum(counts)
+    percentiles = [int(np.searchsorted(cumulative, q * total)) for q in (0.5, 0.9, 0.99)]
+    return float((np.arange(len(counts)) * counts).sum() / total), *percentiles
+
+
+def line(name, values):
+    return name + ' ' + ' '.join(str(int(value)) for value in values)
+
+
+def report(stats):
+    lines = ['files {}'.format(stats.files), 'songs {}'.format(stats.songs), 'events {}'.format(int(stats.event_types.sum())),
+             'frames {}'.format(stats.frames), 'hours {:.3f}'.format(stats.frames * FRAME_SECONDS / 3600)]
+    lines += ['events.{} {}'.format(name, int(count)) for name, count in zip(EVENT_TYPES, stats.event_types)]
+
+    seconds = max(stats.frames * FRAME_SECONDS, 1e-9)
+    notes = int(stats.event_types[0] + stats.event_types[2])
+    lines.append('density.note_ons_per_second {:.4f}'.format(notes / seconds))
+    lines.append('density.time_shifts_per_second {:.4f}'.format(int(stats.event_types[4] + stats.event_types[5]) / seconds))
+    lines.append('density.gap_mean_p50_p90_p99 {:.4f} {} {} {}'.format(*summary(stats.gaps)))
+    lines.append(line('density.gap_histogram', stats.gaps))
+
+    for cluster in range(NUM_CLUSTERS):
+        name = 'cluster_{}'.format(cluster)
+        ons = stats.note_ons[cluster * MAX_RANGE:cluster * MAX_RANGE + Loader.cluster_range[cluster]]
+        offs = stats.note_offs[cluster * MAX_RANGE:cluster * MAX_RANGE + Loader.cluster_range[cluster]]
+        durations = stats.durations[cluster * MAX_DURATION:(cluster + 1) * MAX_DURATION]
+        lines.append('{}.ons {}'.format(name, int(ons.sum())))
+        lines.append('{}.offs {}'.format(name, int(offs.sum())))
+        lines.append('{}.unended_notes {}'.format(name, int(stats.unended_notes[cluster])))
+        lines.append('{}.orphan_offs {}'.format(name, int(stats.orphan_offs[cluster])))
+        lines.append('{}.duration_mean_p50_p90_p99 {:.4f} {} {} {}'.format(name, *summary(durations)))
+        lines.append(line(name + '.pitch_histogram', ons))
+        lines.append(line(name + '.duration_histogram', durations))
+
+    lines.append('polyphony.mean_p50_p90_p99 {:.4f} {} {} {}'.format(*summary(stats.polyphony)))
+    lines.append('polyphony.max {}'.format(int(np.flatnonzero(stats.polyphony)[-1]) if stats.polyphony.any() else 0))
+    lines.append(line('polyphony.frames', stats.polyphony))
+
+    lines.append(line('chords.beats', stats.beat_chords))
+    transitions = stats.chord_transitions.reshape(NUM_CHORDS, NUM_CHORDS)
+    changes = transitions.sum() - np.trace(transitions)
+    lines.append('chords.change_rate {:.4f}'.format(changes / max(transitions.sum(), 1)))
+    lines += [line('chords.transitions_from_{}'.format(chord), row) for chord, row in enumerate(transitions)]
+    return '\n'.join(lines) + '\n'
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generative Model -- Corpus Statistics')
+    parser.add_argument('files', type=str, nargs='+', help='.mus files or folders with them')
+    parser.add_argument('--workers', type=int, default=0, help='number of worker processes, 0 computes in this process (default: 0)')
+    parser.add_argument('--chunk_size', type=int, default=1 << 20, help='number of records processed at once (default: 1048576)')
+    parser.add_argument('--output', type=str, default='', help='write the report into this file (printed by default)')
+    args = parser.parse_args()
+
+    filenames = find_files(args.files)
+    start_time = time.time()
+    stats = corpus_statistics(filenames, args.workers, args.chunk_size)
+    elapsed = time.time() - start_time
+
+    text = report(stats)
+    if args.output != '':
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text, end='')
+
+    print('-' * 89)
+    print('| {} files, {} events in {:.2f}s, {:.0f} events/s'.format(stats.files, int(stats.event_types.sum()), elapsed, stats.event_types.sum() / max(elapsed, 1e-9)))
+    if args.output != '': print('| report saved as ' + args.output)
+    print('-' * 89)
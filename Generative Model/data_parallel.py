@@ -0,0 +1,126 @@
+"""Data-parallel training of the predictors on CPU processes (and nodes) with the gloo backend."""
+
+# The training scripts are started by torchrun, e.g. from Note_Predictor/
+#   torchrun --nproc_per_node 8 music_train.py --distributed True ...
+# and on several nodes with --nnodes, --node_rank and --master_addr. The data is batchified into --batch_size
+# streams as before and every rank trains on its own contiguous slice of them. Gradients are averaged over all
+# ranks before clipping, so every rank makes the same update as a single process training on the whole batch.
+# Batch norm statistics are computed on the streams of each rank, the running statistics are averaged before
+# every evaluation. Only rank 0 prints, logs and saves models. All functions do nothing in a single process.
+
+import os
+import sys
+
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+
+# processes forked from a rank (e.g. the validation worker) must not take part in collective operations
+forked = False
+
+
+def is_distributed():
+    return not forked and dist.is_available() and dist.is_initialized()
+
+
+def rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+# join the process group created by torchrun, returns the rank of this process and the number of processes
+def init_distributed(args):
+    if not args.distributed: return 0, 1
+
+    if args.cuda:
+        print("distributed training runs on CPU, ignoring --cuda")
+        args.cuda = False
+
+    dist.init_process_group(backend='gloo')
+
+    # split the cores of the node between its ranks
+    threads = args.threads if args.threads > 0 else max(1, (os.cpu_count() or 1) // int(os.environ.get('LOCAL_WORLD_SIZE', 1)))
+    torch.set_num_threads(threads)
+
+    # only the first rank reports the progress
+    if dist.get_rank() > 0:
+        sys.stdout = open(os.devnull, 'w')
+
+    return dist.get_rank(), dist.get_world_size()
+
+
+def cleanup_distributed():
+    if is_distributed(): dist.destroy_process_group()
+
+
+# the slice of the streams of a batchified tensor that belongs to this rank
+def shard(data):
+    if data.size(1) % world_size() != 0:
+        raise ValueError('batch size {} is not divisible by the number of processes {}'.format(data.size(1), world_size()))
+
+    size = data.size(1) // world_size()
+    return data[:, rank()*size:(rank() + 1)*size].contiguous()
+
+
+# path of a log file, the other ranks write into the void
+def log_filename(filename):
+    return filename if rank() == 0 else os.devnull
+
+
+def all_reduce_coalesced(tensors, average=True):
+    if len(tensors) == 0: return
+
+    # a single all-reduce of one flat buffer is much faster than one per tensor (the BN-LSTM has thousands of them)
+    flat = _flatten_dense_tensors(tensors)
+    dist.all_reduce(flat)
+    if average: flat /= world_size()
+
+    for tensor, reduced in zip(tensors, _unflatten_dense_tensors(flat, tensors)):
+        tensor.copy_(reduced)
+
+
+# start every rank from the weights and statistics of rank 0
+def broadcast_model(model):
+    if not is_distributed(): return
+
+    tensors = [parameter.data for parameter in model.parameters()] + [buffer for buffer in model.buffers()]
+    for dtype in set(tensor.dtype for tensor in tensors):
+        group = [tensor for tensor in tensors if tensor.dtype == dtype]
+        flat = _flatten_dense_tensors(group)
+        dist.broadcast(flat, 0)
+        for tensor, received in zip(group, _unflatten_dense_tensors(flat, group)):
+            tensor.copy_(received)
+
+
+# average the gradients over all ranks, call it after backward and before clipping
+def all_reduce_gradients(model):
+    if not is_distributed(): return
+    all_reduce_coalesced([parameter.grad.data for parameter in model.parameters() if parameter.grad is not None])
+
+
+# average the running statistics of batch norm (and any other floating point buffers) over all ranks
+def synchronize_buffers(model):
+    if not is_distributed(): return
+    all_reduce_coalesced([buffer for buffer in model.buffers() if buffer.is_floating_point()])
+
+
+# the value of a scalar on rank 0
+def broadcast_value(value):
+    if not is_distributed(): return value
+
+    tensor = torch.tensor([float(value)], dtype=torch.float64)
+    dist.broadcast(tensor, 0)
+    return tensor.item()
+
+
+# average of a scalar (e.g. a loss) over all ranks
+def average(value):
+    if not is_distributed(): return value
+
+    tensor = torch.tensor([float(value)], dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return tensor.item() / world_size()
@@ -0,0 +1,285 @@
+"""Numerical equivalence of optimized engines with golden outputs recorded from the reference implementation."""
+
+# --record runs the current code with the shipped Chord and Volume Predictors on a primer (Primers/piano.mus) and
+# saves the golden outputs: the tensors decoded by Loader, the outputs (logits of the chords, volumes) and the
+# hidden states of every layer after every step of feeding the primer step by step, the sequences generated by
+# generate_chords and generate_volumes under fixed seeds, and the loss and the gradients of one training batch.
+# Checking runs the same with an engine applied to the loaded networks, either a transform of autotune.py
+# ("lookup_tables", "quantize", ...) or any function model -> model given as module:function (e.g. a fused cell
+# under development), and compares every output with the golden one. Floats pass when |output - golden| <=
+# atol + rtol * |golden| (like torch.allclose), the decoded tensors and the sampled chords must be equal unless
+# --sequence_tolerance allows a fraction of different steps. The report shows the largest deviation of every
+# check; the training batch is checked only for the engines given as module:function (the transforms of autotune.py
+# are only for inference) and skipped when the engine can't be trained.
+
+import argparse
+import contextlib
+import importlib
+import io
+import os
+import sys
+
+import torch
+from torch import nn
+
+from autotune import apply_implementation, machine_info
+from benchmark import CHORD_MODEL, VOLUME_MODEL, git_commit
+from quantization import primer_inputs
+from utils import Loader, batchify, load_model
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+PREDICTORS = {'chord': CHORD_MODEL, 'volume': VOLUME_MODEL}
+SECTIONS = ['decoded', 'steps', 'samples', 'train']
+
+
+def default_golden_path():
+    return os.path.join(ROOT, 'Golden', 'reference.pt')
+
+
+# function model -> model of an engine and whether the engine trains, the transforms of autotune.py are only for
+# inference, an engine given as module:function is checked in every section
+def engine_transform(engine):
+    if engine in ('', 'default'): return (lambda model: model), True
+    if ':' in engine:
+        module, function = engine.split(':', 1)
+        return getattr(importlib.import_module(module), function), True
+    return (lambda model: apply_implementation(model, engine)), False
+
+
+# every tensor decoded from the primer by Loader
+def decoded_tensors(primer):
+    loader = Loader(primer)
+    events, chords = loader.create_event_tensor()
+    volume_events, volumes = loader.create_volume_tensor()
+    joint = loader.create_joint_tensor()
+    return {'events': events, 'event_chords': chords, 'chords': loader.create_chord_tensor(),
+            'volume_events': volume_events, 'volumes': volumes,
+            'joint_events': joint[0], 'joint_chords': joint[1], 'joint_volumes': joint[2]}
+
+
+# outputs and hidden states after every step of the primer fed step by step, (steps, ...) tensors
+def step_outputs(model, primer, length, seed):
+    inputs = primer_inputs(model, primer, length)
+    model.eval()
+    torch.manual_seed(seed)
+    model.init_hidden(1)
+
+    outputs, hiddens, cells = [], [], []
+    with torch.no_grad():
+        for input in inputs:
+            outputs.append(model(*input)[0, 0].float())
+            hiddens.append(model.hidden[0][:, 0].float().clone())
+            cells.append(model.hidden[1][:, 0].float().clone())
+
+    return {'output': torch.stack(outputs), 'hidden': torch.stack(hiddens), 'cell': torch.stack(cells)}
+
+
+# sequences generated under fixed seeds, the generating functions print nothing here
+def sampled_sequences(predictor, model, primer, seeds, length):
+    from Chord_Predictor.chord_generate import generate_chords
+    from Volume_Predictor.volume_generate import generate_volumes
+
+    samples = {}
+    # generate_chords looks for the primer in ../Primers/, so the generating runs in a predictor folder
+    working_directory = os.getcwd()
+    primer = os.path.abspath(primer)
+    os.chdir(os.path.join(ROOT, 'Chord_Predictor'))
+    try:
+        for seed in seeds:
+            torch.manual_seed(seed)
+            with torch.no_grad(), contextlib.redirect_stdout(io.StringIO()):
+                if predictor == 'chord':
+                    sequence = generate_chords(model, os.path.relpath(primer, '../Primers/'), False, 20, length, 1.0, 1)
+                    samples['seed_{}'.format(seed)] = torch.LongTensor([int(chord) for chord in sequence])
+                else:
+                    sequence = generate_volumes(model, primer, False, 50, 1, Loader(primer).create_volume_tensor()[0][:length])
+                    samples['seed_{}'.format(seed)] = torch.FloatTensor([float(volume) for volume in sequence])
+    finally:
+        os.chdir(working_directory)
+
+    return samples
+
+
+# loss and gradients of one training batch (the first seq_len steps of the primer batchified, the model in the
+# training mode with its dropout), computed like in chord_train.py and volume_train.py; batch norm normalizes by
+# the statistics of the batch, which are ill-conditioned for a few columns of the same chords, so the batch has 16
+def training_batch(predictor, model, primer, seed, batch_size=16):
+    model.train()
+    torch.manual_seed(seed)
+    model.init_hidden(batch_size)
+
+    if predictor == 'chord':
+        data = batchify(Loader(primer).create_chord_tensor(), batch_size)
+        data = data[:min(model.seq_len, len(data) - 1) + 1].long()
+        output = model(data[:-1])
+        loss = nn.CrossEntropyLoss()(output.view(-1, output.size(2)), data[1:].reshape(-1))
+    else:
+        events, volumes = Loader(primer).create_volume_tensor()
+        seq_len = min(model.seq_len, len(events) // batch_size - 1)
+        events = batchify(events, batch_size)[:seq_len + 1].long()
+        targets = batchify(volumes, batch_size)[1:seq_len + 1].reshape(-1)
+        output = model(events[:-1])
+        mask = (targets != -1).float()
+        loss = (nn.MSELoss(reduction='none')(output.view(-1), targets) * mask).sum() / mask.sum()
+
+    model.zero_grad()
+    loss.backward()
+    result = {'loss': loss.detach().float().reshape(1)}
+    for name, parameter in model.named_parameters():
+        if parameter.grad is not None: result['grad.' + name] = parameter.grad.float().clone()
+    return result
+
+
+# outputs of one predictor with the engine applied to a freshly loaded network for every section
+def predictor_outputs(predictor, filename, transform, trains, primer, length, seeds, sections):
+    outputs = {}
+    if 'steps' in sections:
+        outputs['steps'] = step_outputs(transform(load_model(filename)), primer, length, seeds[0])
+    if 'samples' in sections:
+        outputs['samples'] = sampled_sequences(predictor, transform(load_model(filename)), primer, seeds, length)
+    if 'train' in sections and not trains:
+        outputs['train'] = {'skipped': 'inference-only engine'}
+    elif 'train' in sections:
+        try:
+            outputs['train'] = training_batch(predictor, transform(load_model(filename)), primer, seeds[0])
+        except (RuntimeError, NotImplementedError) as e:
+            outputs['train'] = {'skipped': '{}: {}'.format(type(e).__name__, str(e).splitlines()[0] if str(e) else '')}
+    return outputs
+
+
+def run(primer, engine='default', length=500, seeds=(42,), sections=SECTIONS, models=PREDICTORS):
+    transform, trains = engine_transform(engine)
+    outputs = {}
+    if 'decoded' in sections: outputs['decoded'] = decoded_tensors(primer)
+    for predictor, filename in models.items():
+        outputs[predictor] = predictor_outputs(predictor, filename, transform, trains, primer, length, list(seeds), sections)
+    return outputs
+
+
+def record(path, primer, length, seeds, sections=SECTIONS, models=PREDICTORS):
+    golden = {
+        'machine': machine_info(),
+        'commit': git_commit(),
+        'parameters': {'primer': primer, 'length': length, 'seeds': list(seeds), 'sections': list(sections),
+                       'models': {predictor: os.path.abspath(filename) for predictor, filename in models.items()}},
+        'outputs': run(primer, 'default', length, seeds, sections, models)
+    }
+    if os.path.dirname(path) != '' and not os.path.isdir(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+    torch.save(golden, path)
+    return golden
+
+
+# (check name, golden tensor, tensor) of every output, in the order of the golden outputs
+def flatten(golden, outputs, prefix=''):
+    for key, value in golden.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            if 'skipped' in outputs.get(key, {}): yield name, None, outputs[key]['skipped']
+            else: yield from flatten(value, outputs.get(key, {}), name + '/')
+        else:
+            yield name, value, outputs.get(key)
+
+
+# largest absolute and relative deviation and whether the output passes, for integer tensors the number and the
+# fraction of different steps
+def compare_tensor(golden, output, atol, rtol, sequence_tolerance):
+    if output is None: return None, None, 'FAIL (missing)'
+    if golden.shape != output.shape and (golden.dim() != 1 or output.dim() != 1):
+        return None, None, 'FAIL (shape {} != {})'.format(tuple(output.shape), tuple(golden.shape))
+
+    # sampled sequences may end at different lengths, the missing steps count as different
+    length = min(len(golden), len(output))
+    missing = max(len(golden), len(output)) - length
+    golden, output = golden[:length], output[:length]
+
+    if golden.is_floating_point():
+        golden, output = golden.double(), output.double()
+        deviation = (output - golden).abs()
+        max_abs = deviation.max().item() if deviation.numel() > 0 else 0.0
+        max_rel = (deviation / golden.abs().clamp(min=1e-12)).max().item() if deviation.numel() > 0 else 0.0
+        if missing > 0: return max_abs, max_rel, 'FAIL ({} steps missing or added)'.format(missing)
+        return max_abs, max_rel, 'ok' if bool((deviation <= atol + rtol * golden.abs()).all()) else 'FAIL'
+
+    different = (golden != output).view(length, -1).any(1).nonzero()
+    mismatches = len(different) + missing
+    fraction = mismatches / max(length + missing, 1)
+    if fraction <= sequence_tolerance: return float(mismatches), fraction, 'ok'
+    return float(mismatches), fraction, 'FAIL ({} steps differ, the first at {})'.format(mismatches, different[0, 0].item() if len(different) > 0 else length)
+
+
+# every check of the golden outputs against the outputs of the engine, rows (name, max abs, max rel, status)
+def check(golden, engine='default', atol=1e-5, rtol=1e-5, sequence_tolerance=0.0):
+    parameters = golden['parameters']
+    outputs = run(parameters['primer'], engine, parameters['length'], parameters['seeds'], parameters['sections'], parameters['models'])
+
+    rows = []
+    for name, golden_tensor, output in flatten(golden['outputs'], outputs):
+        if golden_tensor is None:
+            rows.append((name, None, None, 'skipped ({})'.format(output)))
+            continue
+        # sequences are exact in the reference, integer decoded tensors too
+        tolerance = sequence_tolerance if name.startswith('chord/samples') else 0.0
+        rows.append((name,) + compare_tensor(golden_tensor, output, atol, rtol, tolerance))
+    return rows
+
+
+def print_report(rows, golden, engine):
+    print('-' * 89)
+    print('| engine {} against the golden outputs of {} ({})'.format(engine, golden['commit'], golden['parameters']['primer']))
+    if golden['machine'] != machine_info():
+        print('| WARNING: the golden outputs were recorded on a different machine or torch, small deviations are expected')
+    print('-' * 89)
+    print('| {:50s} | {:>11s} | {:>11s} | status'.format('check', 'max abs dev', 'max rel dev'))
+    print('-' * 89)
+    for name, max_abs, max_rel, status in rows:
+        if max_abs is None:
+            print('| {:50s} | {:>11s} | {:>11s} | {}'.format(name[-50:], '-', '-', status))
+        else:
+            print('| {:50s} | {:11.4e} | {:11.4e} | {}'.format(name[-50:], max_abs, max_rel, status))
+    print('-' * 89)
+
+    # the largest deviation of the float outputs, the integer ones count differing steps
+    floats = [(max_abs, name) for name, max_abs, _, status in rows if max_abs is not None and not name.startswith(('decoded', 'chord/samples'))]
+    failed = [row for row in rows if not (row[3] == 'ok' or row[3].startswith('skipped'))]
+    if len(floats) > 0:
+        print('| largest deviation {:.4e} in {}'.format(*max(floats)))
+    print('| {} of {} checks passed, {} skipped'.format(sum(row[3] == 'ok' for row in rows), len(rows), sum(row[3].startswith('skipped') for row in rows)))
+    print('-' * 89)
+    return len(failed) == 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generative Model -- Numerical Equivalence')
+    parser.add_argument('--record', type=bool, default=False, help='record the golden outputs of the current implementation instead of checking (default: False)')
+    parser.add_argument('--golden', type=str, default='', help='path of the golden outputs, empty uses Golden/reference.pt')
+    parser.add_argument('--engine', type=str, default='default', help='engine checked: default, a transform of autotune.py (lookup_tables, quantize, lookup_tables+quantize) or module:function (default: default)')
+    parser.add_argument('--primer', type=str, default='Primers/piano.mus', help='song of the recorded outputs (default: Primers/piano.mus)')
+    parser.add_argument('--chord_model', type=str, default=CHORD_MODEL, help='Chord Predictor of the recorded outputs (default: the shipped one)')
+    parser.add_argument('--volume_model', type=str, default=VOLUME_MODEL, help='Volume Predictor of the recorded outputs (default: the shipped one)')
+    parser.add_argument('--length', type=int, default=500, help='maximal number of recorded steps and generated items (default: 500)')
+    parser.add_argument('--seeds', type=str, default='42,1,2', help='comma-separated seeds of the sampled sequences, the first one also of the other sections (default: 42,1,2)')
+    parser.add_argument('--sections', type=str, default=','.join(SECTIONS), help='comma-separated recorded sections (default: all of {})'.format(', '.join(SECTIONS)))
+    parser.add_argument('--atol', type=float, default=1e-5, help='absolute tolerance of the float outputs (default: 1e-5)')
+    parser.add_argument('--rtol', type=float, default=1e-5, help='relative tolerance of the float outputs (default: 1e-5)')
+    parser.add_argument('--sequence_tolerance', type=float, default=0.0, help='fraction of the sampled chords allowed to differ (default: 0)')
+    parser.add_argument('--threads', type=int, default=0, help='number of torch threads, 0 keeps the default (default: 0)')
+    args = parser.parse_args()
+
+    if args.threads > 0: torch.set_num_threads(args.threads)
+    path = args.golden or default_golden_path()
+
+    if args.record:
+        sections = [section for section in args.sections.split(',') if section != '']
+        for section in sections:
+            if section not in SECTIONS: raise ValueError("unknown section '{}', the supported ones are {}".format(section, ', '.join(SECTIONS)))
+        golden = record(path, args.primer, args.length, [int(seed) for seed in args.seeds.split(',')], sections,
+                        {'chord': args.chord_model, 'volume': args.volume_model})
+        n_tensors = sum(1 for _ in flatten(golden['outputs'], golden['outputs']))
+        print('recorded {} golden tensors into {}'.format(n_tensors, path))
+        sys.exit(0)
+
+    golden = torch.load(path, weights_only=False)
+    rows = check(golden, args.engine, args.atol, args.rtol, args.sequence_tolerance)
+    sys.exit(0 if print_report(rows, golden, args.engine) else 1)
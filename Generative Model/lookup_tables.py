@@ -0,0 +1,141 @@
+"""Precomputed embedding-to-gate lookup tables for the first recurrent layer."""
+
+# The first recurrent layer of every predictor gets only embeddings of a few hundred possible events or chords,
+# so W_ih applied to its input has only as many distinct results as there are embedding rows. The transform
+# precomputes them: each embedding layer is replaced by a table of its contribution to the gates and the first
+# layer just sums the rows gathered from the tables instead of multiplying its input by W_ih.
+# Dropout is ignored, the transform is meant only for inference.
+
+import argparse
+
+import torch
+from torch import nn
+
+import bnlstm as bn
+
+
+# BN-LSTM cell whose input is the concatenation of precomputed input projections, otherwise identical to bnlstm.BNLSTMCell
+class TabulatedBNLSTMCell(nn.Module):
+
+    def __init__(self, cell, parts):
+        super(TabulatedBNLSTMCell, self).__init__()
+        self.hidden_size = cell.hidden_size
+        self.max_length = cell.max_length
+        self.parts = parts
+
+        self.weight_hh = cell.weight_hh
+        self.bias = cell.bias
+        self.bn_ih = cell.bn_ih
+        self.bn_hh = cell.bn_hh
+        self.bn_c = cell.bn_c
+
+    def forward(self, input_, hx, time):
+        h_0, c_0 = hx
+        wi = input_.view(input_.size(0), self.parts, 4 * self.hidden_size).sum(1)
+        wh = torch.mm(h_0, self.weight_hh)
+        return bn.BNLSTMCell.recurrence(self, wi, wh, c_0, time)
+
+
+# nn.LSTM whose first layer gets the concatenation of precomputed input projections (including both biases)
+class TabulatedLSTM(nn.Module):
+
+    def __init__(self, lstm, parts):
+        super(TabulatedLSTM, self).__init__()
+        self.hidden_size = lstm.hidden_size
+        self.num_layers = lstm.num_layers
+        self.parts = parts
+
+        self.weight_hh = nn.Parameter(lstm.weight_hh_l0.data.clone())
+
+        # the other layers stay a regular nn.LSTM
+        self.upper = None
+        if lstm.num_layers > 1:
+            self.upper = nn.LSTM(input_size=lstm.hidden_size, hidden_size=lstm.hidden_size, num_layers=lstm.num_layers - 1, dropout=lstm.dropout)
+            for layer in range(1, lstm.num_layers):
+                for name in ('weight_ih', 'weight_hh', 'bias_ih', 'bias_hh'):
+                    getattr(self.upper, '{}_l{}'.format(name, layer - 1)).data.copy_(getattr(lstm, '{}_l{}'.format(name, layer)).data)
+
+    def forward(self, input_, hx):
+        h, c = hx[0][0], hx[1][0]
+        inputs = input_.view(input_.size(0), input_.size(1), self.parts, 4 * self.hidden_size).sum(2)
+
+        output = []
+        for time in range(input_.size(0)):
+            gates = inputs[time] + torch.mm(h, self.weight_hh.t())
+            i, f, g, o = gates.chunk(4, 1)
+            c = torch.sigmoid(f)*c + torch.sigmoid(i)*torch.tanh(g)
+            h = torch.sigmoid(o)*torch.tanh(c)
+            output.append(h)
+        output = torch.stack(output, 0)
+
+        if self.upper is None:
+            return output, (h.unsqueeze(0), c.unsqueeze(0))
+
+        output, (h_n, c_n) = self.upper(output, (hx[0][1:].contiguous(), hx[1][1:].contiguous()))
+        return output, (torch.cat((h.unsqueeze(0), h_n), 0), torch.cat((c.unsqueeze(0), c_n), 0))
+
+
+# embedding layer returning the contribution of each embedding to the gates of the first layer
+def gate_table(embedding, weight, bias=None):
+    table = torch.mm(embedding.weight.data, weight)
+    if bias is not None: table += bias
+    return nn.Embedding.from_pretrained(table, freeze=True)
+
+
+# replace the embeddings and the first recurrent layer of the network (of any predictor) by lookup tables, in place
+def tabulate_inputs(model):
+    model.eval()
+
+    # embedding layers in the order in which they are concatenated, and the recurrent layers after them
+    if hasattr(model, 'chord_encoder'):
+        names, lstm_name = ['event_encoder', 'chord_encoder'], 'lstm'
+    elif hasattr(model, 'forward_encoder'):
+        names, lstm_name = ['forward_encoder'], 'forward_lstm'
+    else:
+        names, lstm_name = ['encoder'], 'lstm'
+
+    lstm = getattr(model, lstm_name)
+    embeddings = [getattr(model, name) for name in names]
+
+    with torch.no_grad():
+        if isinstance(lstm, bn.LSTM):
+            cell = lstm.get_cell(0)
+            weights = torch.split(cell.weight_ih.data, [embedding.embedding_dim for embedding in embeddings], 0)
+            tables = [gate_table(embedding, weight) for embedding, weight in zip(embeddings, weights)]
+            setattr(lstm, 'cell_0', TabulatedBNLSTMCell(cell, len(tables)))
+        else:
+            weights = torch.split(lstm.weight_ih_l0.data.t(), [embedding.embedding_dim for embedding in embeddings], 0)
+            bias = lstm.bias_ih_l0.data + lstm.bias_hh_l0.data
+            tables = [gate_table(embedding, weight, bias if k == 0 else None) for k, (embedding, weight) in enumerate(zip(embeddings, weights))]
+            setattr(model, lstm_name, TabulatedLSTM(lstm, len(tables)))
+
+    for name, table in zip(names, tables):
+        setattr(model, name, table)
+
+    return model
+
+
+if __name__ == "__main__":
+    from quantization import compare_models
+    from utils import load_model
+    import copy
+
+    parser = argparse.ArgumentParser(description='Generative Model -- Lookup Tables Report')
+    parser.add_argument('models', type=str, nargs='+', help='paths to trained models of any predictor')
+    parser.add_argument('--primer', type=str, default='Primers/piano.mus', help='path to the song fed into both networks')
+    parser.add_argument('--length', type=int, default=2000, help='maximal number of primer steps compared (default: 2000)')
+    parser.add_argument('--threads', type=int, default=0, help='number of torch threads, 0 keeps the default (default: 0)')
+    args = parser.parse_args()
+
+    if args.threads > 0: torch.set_num_threads(args.threads)
+
+    for filename in args.models:
+        model = load_model(filename)
+        model.eval()
+        report = compare_models(model, tabulate_inputs(copy.deepcopy(model)), args.primer, args.length, names=('original', 'tables'))
+
+        print('-' * 89)
+        print('| {} ({} cell)'.format(filename, model.cell))
+        for key, value in report.items():
+            print('| {:24s} {:12.6f}'.format(key, value))
+    print('-' * 89)
@@ -0,0 +1,1607 @@
+"""Conversion of MIDI files into .mus files on any machine, a Python port of the batch conversion of the Analyzer."""
+
+# "Convert Batch" of the Analyzer parses every MIDI file into its MidiModel, analyses it and writes it by
+# ModelToMusicEvents. This module goes through the same steps in the same order and with the same arithmetic:
+#  - real times of the events from the tempo map, note lengths, volumes (velocity, channel volume and expression),
+#    notes prolonged by the sustain pedal, instruments and their clusters (MidiModel)
+#  - the metre: the beats of the MIDI itself when its notes fit them, otherwise the beats found by the tactus
+#    tracker and their strengths, after which the tempo is normalized to 600 ms per beat (MetreNormalizer)
+#  - the key (from the key signatures or from the pitch profile) and a chord of every beat (ChordDetector)
+#  - the .mus events in 50 ms frames (12 ticks per beat), pitches folded into the ranges of the instrument
+#    clusters (ClusterRanges) and the chord of the next beat in every time shift (MusParser)
+# Times are whole milliseconds like the TimeSpans of .NET Framework and the volumes are computed in float32 where
+# the Analyzer uses floats, so that the output follows the Analyzer byte by byte. The one deliberate difference is
+# the key of songs without a key signature: the Analyzer predicts it by a random forest trained on a dataset that
+# isn't part of the repository, here it's the correlation of the same pitch profile with Krumhansl's key profiles
+# (KeyFinder.AlternativeAnalyze). The key only biases the chords, so such songs can differ in some chord bytes.
+# Files are converted in worker processes, --compare checks the output against .mus files of the Analyzer.
+
+import argparse
+import bisect
+import math
+import multiprocessing
+import os
+import random
+import sys
+import time
+from collections import deque
+
+import numpy as np
+
+from utils import find_files
+
+
+FRAME = 50  # milliseconds per tick of the .mus format
+BEAT = 600  # milliseconds per beat after the tempo normalization
+TICKS_PER_BEAT = BEAT // FRAME
+MAX_NOTE_LENGTH = 4800 // FRAME
+RETRIGGER_FRAMES = 400 // FRAME
+STOP_CHORD = 24
+
+PERCUSSION_CHANNEL = 9
+PERCUSSION = 128  # instrument id of the drums
+PERCUSSION_MIN, PERCUSSION_MAX = 35, 82
+NONMUSICAL = 11
+
+# (min, max) pitch of every instrument cluster, see MusParser/ClusterRanges.cs
+CLUSTER_RANGES = [(36, 84), (43, 76), (43, 84), (24, 50), (43, 84), (55, 81), (36, 76), (48, 84), (43, 84), (PERCUSSION_MIN, PERCUSSION_MAX), (43, 84)]
+
+# instrument cluster of every General MIDI program, see MidiModel/Instrument.cs
+PROGRAM_CLUSTERS = ([0] * 8 + [8] * 8 + [7] * 8 + [1] * 5 + [6] * 3 + [3] * 8 + [10] * 4 + [2, 8, 1, 8] + [2] * 4 + [5, 5, 2, 8] +
+                    [4] * 28 + [6, 5, 4, 4] + [5] * 16 + [1] * 4 + [8, 7, 10, 4] + [8] * 8 + [NONMUSICAL] * 8)
+
+MIN_DOUBLE = -sys.float_info.max
+
+
+def instrument_cluster(instrument):
+    return PERCUSSION_CHANNEL if instrument == PERCUSSION else PROGRAM_CLUSTERS[instrument]
+
+
+# TimeSpan.FromMilliseconds of .NET Framework rounds to whole milliseconds
+def timespan(milliseconds):
+    return int(milliseconds + 0.5) if milliseconds >= 0 else int(milliseconds - 0.5)
+
+
+# TimeSpan.TotalSeconds, which isn't exactly milliseconds / 1000
+def total_seconds(milliseconds):
+    return milliseconds * 10000 * 1e-7
+
+
+def float32(value):
+    return float(np.float32(value))
+
+
+# Enumerable.Sum and Average add the values one by one (unlike sum() of newer Pythons)
+def linq_sum(values):
+    total = 0.0
+    for value in values:
+        total += value
+    return total
+
+
+def linq_average(values):
+    values = list(values)
+    if len(values) == 0: raise ValueError('average of no values')
+    return linq_sum(values) / len(values)
+
+
+# division of doubles that gives infinity or NaN instead of an exception
+def divide(a, b):
+    if b != 0: return a / b
+    if a != a or a == 0: return math.nan
+    return math.copysign(math.inf, a) * math.copysign(1.0, b)
+
+
+# index and value of the first maximum, compared like double.CompareTo (NaN is the smallest)
+def max_with_index(values):
+    if len(values) == 0: raise ValueError('maximum of no values')
+    index = 0
+    for i in range(1, len(values)):
+        if values[i] > values[index] or (values[index] != values[index] and values[i] == values[i]):
+            index = i
+    return index, values[index]
+
+
+# first change at or before the time (the latest one, the first of them in the list when there are more), see
+# the selections by Aggregate in VolumeChangeCollector and InstrumentChangeCollector
+class ChangeTimeline:
+
+    def __init__(self, changes):
+        changes = sorted(changes, key=lambda change: change[0])
+        self.times = [change[0] for change in changes]
+        self.values = [change[1] for change in changes]
+        self.sums = [0]
+        for value in self.values:
+            self.sums.append(self.sums[-1] + value)
+
+    def latest(self, time, default):
+        index = bisect.bisect_right(self.times, time)
+        if index == 0: return default
+        return self.values[bisect.bisect_left(self.times, self.times[index - 1])]
+
+    # average of the values changed in [start, end)
+    def average(self, start, end):
+        low, high = bisect.bisect_left(self.times, start), bisect.bisect_left(self.times, end)
+        if high <= low: return None
+        return (self.sums[high] - self.sums[low]) / (high - low)
+
+
+# ----------------------------------------------------------------------------------------------------------------
+# object model of a MIDI file (MidiModel)
+
+class Event:
+    __slots__ = ('ticks', 'time')
+
+    def __init__(self, ticks=0, time=0):
+        self.ticks = ticks
+        self.time = time  # real time in milliseconds
+
+
+class ControlEvent(Event):
+    __slots__ = ('channel',)
+
+    def __init__(self, ticks, channel):
+        super(ControlEvent, self).__init__(ticks)
+        self.channel = channel
+
+
+class NoteOn(ControlEvent):
+    __slots__ = ('note', 'volume', 'real_volume', 'length', 'end', 'instrument', 'bends')
+
+    def __init__(self, ticks, channel, note, volume):
+        super(NoteOn, self).__init__(ticks, channel)
+        self.note = note
+        self.volume = volume
+        self.real_volume = 0.0
+        self.length = 0  # real time length in milliseconds
+        self.end = 0
+        self.instrument = None
+        self.bends = []
+
+    @property
+    def is_percussion(self):
+        return self.channel == PERCUSSION_CHANNEL
+
+
+class NoteOff(ControlEvent):
+    __slots__ = ('note',)
+
+    def __init__(self, ticks, channel, note):
+        super(NoteOff, self).__init__(ticks, channel)
+        self.note = note
+
+
+class Controller(ControlEvent):
+    __slots__ = ('number', 'value')
+
+    def __init__(self, ticks, channel, number, value):
+        super(Controller, self).__init__(ticks, channel)
+        self.number = number
+        self.value = value
+
+
+class InstrumentChange(ControlEvent):
+    __slots__ = ('program',)
+
+    def __init__(self, ticks, channel, program):
+        super(InstrumentChange, self).__init__(ticks, channel)
+        self.program = program
+
+
+class PitchBend(ControlEvent):
+    __slots__ = ('value', 'range')
+
+    def __init__(self, ticks, channel, value):
+        super(PitchBend, self).__init__(ticks, channel)
+        self.value = value
+        self.range = 0
+
+    @property
+    def real_pitch_change(self):
+        return self.range * (self.value - 8192) / 16384
+
+
+# note and channel aftertouch, they don't affect the conversion but are kept in the channels like in the Analyzer
+class Aftertouch(ControlEvent):
+    __slots__ = ()
+
+
+class EndOfTrack(Event):
+    __slots__ = ()
+
+
+class SetTempo(Event):
+    __slots__ = ('tempo',)
+
+    def __init__(self, ticks, tempo):
+        super(SetTempo, self).__init__(ticks)
+        self.tempo = tempo
+
+
+class TimeSignature(Event):
+    __slots__ = ('numerator', 'denominator')
+
+    def __init__(self, ticks, numerator, denominator):
+        super(TimeSignature, self).__init__(ticks)
+        self.numerator = numerator
+        self.denominator = denominator
+
+
+# keys and chords are numbered like Key.ToInt(): major keys 0-11 and minor keys 12-23, from C
+class KeySignature(Event):
+    __slots__ = ('key',)
+
+    def __init__(self, ticks, key):
+        super(KeySignature, self).__init__(ticks)
+        self.key = key
+
+
+class BeatEvent(Event):
+    __slots__ = ('length', 'chord', 'level')
+
+    def __init__(self, ticks=0, time=0, length=0, level=0):
+        super(BeatEvent, self).__init__(ticks, time)
+        self.length = length
+        self.chord = 0
+        self.level = level  # 0 - strong, 1 - medium, 2 - weak
+
+
+class Track:
+
+    def __init__(self):
+        self.channels = [[] for _ in range(16)]
+        self.meta_events = []
+
+
+class Model:
+
+    def __init__(self):
+        self.tracks = []
+        self.ticks_per_beat = None
+        self.frames = None
+        self.ticks_per_frame = None
+        self.length = 0
+        self.goodness_of_metre_fit = 0.0
+        self.key = None
+        self.is_key_found_by_midi_itself = False
+
+    def control_events(self):
+        for track in self.tracks:
+            for channel in track.channels:
+                yield from channel
+
+    def meta_events(self):
+        for track in self.tracks:
+            yield from track.meta_events
+
+    def events(self):
+        yield from self.control_events()
+        yield from self.meta_events()
+
+    def events_of_type(self, typ):
+        events = self.control_events() if issubclass(typ, ControlEvent) else self.meta_events()
+        return [event for event in events if isinstance(event, typ)]
+
+    # ticks of a beat (or of a frame with SMPTE time division)
+    def base_ticks(self):
+        return self.ticks_per_beat if self.ticks_per_beat is not None else self.ticks_per_frame
+
+
+# ----------------------------------------------------------------------------------------------------------------
+# MIDI parser (MidiParser/MidiToModelParser.cs)
+
+class MidiReader:
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, length):
+        if self.position + length > len(self.data): raise ValueError('unexpected end of the file')
+        self.position += length
+        return self.data[self.position - length:self.position]
+
+    def skip(self, length):
+        if length < 0: raise ValueError('negative length of a chunk')
+        self.position = min(self.position + length, len(self.data))
+
+    def byte(self):
+        return self.read(1)[0]
+
+    def uint(self, size):
+        return int.from_bytes(self.read(size), 'big')
+
+    # returns the value and the number of its bytes
+    def variable_length(self):
+        value = 0
+        length = 0
+        while True:
+            c = self.byte()
+            length += 1
+            value = (value << 7) | (c & 0x7F)
+            if c & 0x80 == 0: return value, length
+            if length >= 4: raise ValueError("variable length value shouldn't be longer than 4 bytes")
+
+
+def parse_midi(data):
+    reader = MidiReader(data)
+    midi = Model()
+
+    # header chunk, possibly in a RIFF wrapper
+    chunk = reader.uint(4)
+    while chunk == 0x52494646:
+        reader.skip(16)
+        chunk = reader.uint(4)
+    if chunk != 0x4D546864: raise ValueError('MIDI should start with "MThd"')
+
+    length = reader.uint(4)
+    if reader.uint(2) > 2: raise ValueError('format type should be 0, 1 or 2')
+    midi.tracks = [Track() for _ in range(reader.uint(2))]
+
+    division = reader.uint(2)
+    if division & 0x8000 == 0:
+        midi.ticks_per_beat = division & 0x7FFF
+    else:
+        midi.frames = (division & 0x7F00) >> 8
+        if midi.frames not in (24, 25, 29, 30): raise ValueError('invalid value of SMPTE frames, should be 24, 25, 29 or 30')
+        midi.ticks_per_frame = division & 0x00FF
+    reader.skip(length - 6)
+
+    for track in midi.tracks:
+        parse_track(reader, track)
+    return midi
+
+
+def parse_track(reader, track):
+    # skip the chunks of unexpected types
+    while True:
+        chunk = reader.uint(4)
+        total_size = reader.uint(4)
+        if chunk == 0x4D54726B: break
+        reader.skip(total_size)
+
+    size = 0
+    last_type = 0
+    last_channel = 0
+    ticks = 0
+
+    while True:
+        delta, delta_length = reader.variable_length()
+        ticks += delta
+        size += delta_length
+
+        status = reader.byte()
+        size += 1
+
+        if 0x80 <= status <= 0xEF:
+            last_type, last_channel = status >> 4, status & 0x0F
+            size += parse_control_event(reader, track, last_type, last_channel, ticks, reader.byte()) + 1
+
+        elif status >> 4 < 0x8:
+            # running status
+            if last_type < 0x8: raise ValueError('no event is saved, so running status cannot be applied')
+            size += parse_control_event(reader, track, last_type, last_channel, ticks, status)
+
+        elif status == 0xFF:
+            typ = reader.byte()
+            length, length_length = reader.variable_length()
+            size += 1 + length_length
+            parse_meta_event(reader, track, typ, length, ticks)
+
+            # end of track should be at the end of the track
+            if typ == 0x2F:
+                if size + length == total_size: return
+                raise ValueError('unexpected end of track')
+
+            size += length
+            last_type = 0
+
+        elif status == 0xF0 or status == 0xF7:
+            # system exclusive events are skipped
+            length, length_length = reader.variable_length()
+            reader.read(length)
+            size += length_length + length
+            last_type = 0
+
+        else:
+            raise ValueError('unexpected event type')
+
+        if size > total_size: raise ValueError('track is longer than expected')
+
+
+# adds the event into its channel, returns the number of bytes read after the first data byte
+def parse_control_event(reader, track, typ, channel, ticks, data):
+    events = track.channels[channel]
+
+    if typ == 0x8:
+        if data > 127: return 0
+        events.append(NoteOff(ticks, channel, data))
+        reader.byte()
+        return 1
+
+    if typ == 0x9:
+        if data > 127: return 0
+        events.append(NoteOn(ticks, channel, data, reader.byte()))
+        return 1
+
+    if typ == 0xA:
+        if data > 127: return 0
+        events.append(Aftertouch(ticks, channel))
+        reader.byte()
+        return 1
+
+    if typ == 0xB:
+        events.append(Controller(ticks, channel, data, min(reader.byte(), 127)))
+        return 1
+
+    if typ == 0xC:
+        if data > 127: raise ValueError('instrument should be <= 127')
+        events.append(InstrumentChange(ticks, channel, data))
+        return 0
+
+    if typ == 0xD:
+        events.append(Aftertouch(ticks, channel))
+        return 0
+
+    # pitch bend
+    value = (reader.byte() << 7) | data
+    if value > 16383: raise ValueError("pitch value shouldn't be greater than 16383")
+    events.append(PitchBend(ticks, channel, value))
+    return 1
+
+
+# only the meta events used by the analysis are kept, the lengths of the others are checked like in the Analyzer
+META_LENGTHS = {0x00: 2, 0x20: 1, 0x2F: 0, 0x51: 3, 0x54: 5, 0x58: 4, 0x59: 2}
+
+
+def parse_meta_event(reader, track, typ, length, ticks):
+    if typ in META_LENGTHS and length != META_LENGTHS[typ]:
+        raise ValueError('meta event {:#x} should have length {}'.format(typ, META_LENGTHS[typ]))
+
+    if typ == 0x2F:
+        track.meta_events.append(EndOfTrack(ticks))
+    elif typ == 0x51:
+        track.meta_events.append(SetTempo(ticks, reader.uint(3)))
+    elif typ == 0x58:
+        numerator, denominator = reader.byte(), reader.byte()
+        reader.read(2)
+        track.meta_events.append(TimeSignature(ticks, numerator, (1 << (denominator & 31)) & 0xFF))
+    elif typ == 0x59:
+        sharps = reader.byte()
+        if sharps > 127: sharps -= 256
+        if sharps < -7 or sharps > 7: raise ValueError('key should be from -7 to 7')
+        minor = reader.byte() != 0
+        tone = ((12 - sharps) * 5 + (9 if minor else 0)) % 12
+        track.meta_events.append(KeySignature(ticks, tone + (12 if minor else 0)))
+    else:
+        reader.read(length)
+
+
+# ----------------------------------------------------------------------------------------------------------------
+# simplifiers (MidiModel/Simplifiers)
+
+def compute_real_times(midi):
+    if midi.ticks_per_beat is not None:
+        seconds_per_beat = 0.5
+        ticks_per_beat = float(midi.ticks_per_beat)
+    else:
+        seconds_per_beat = 1 / (29.97 if midi.frames == 29 else midi.frames)
+        ticks_per_beat = float(midi.ticks_per_frame)
+
+    last_ticks = 0
+    real_time = 0.0
+    for event in sorted(midi.events(), key=lambda event: event.ticks):
+        real_time += (event.ticks - last_ticks) / ticks_per_beat * seconds_per_beat
+        last_ticks = event.ticks
+        event.time = timespan(real_time * 1000)
+
+        if isinstance(event, SetTempo):
+            seconds_per_beat = event.tempo / 1000000.0
+
+
+# a note ends by a note-off or by a note-on with zero volume of the same pitch in its channel
+def create_note_lengths(midi):
+    for track in midi.tracks:
+        for channel in track.channels:
+            events = sorted(channel, key=lambda event: event.time)
+
+            endings = {}
+            for i, event in enumerate(events):
+                if isinstance(event, NoteOff) or (isinstance(event, NoteOn) and event.volume == 0):
+                    endings.setdefault(event.note, []).append(i)
+
+            for i, note in enumerate(events):
+                if not isinstance(note, NoteOn) or note.volume == 0: continue
+                indices = endings.get(note.note, [])
+                j = bisect.bisect_right(indices, i)
+                if j < len(indices):
+                    note.end = events[indices[j]].time
+                    note.length = note.end - note.time
+
+
+# velocity / 127 in float32, as note.Volume / 127f
+VELOCITY_FRACTIONS = [np.float32(velocity) / np.float32(127) for velocity in range(256)]
+
+
+def determine_volumes(midi):
+    volumes = [[] for _ in range(16)]
+    expressions = [[] for _ in range(16)]
+    for controller in midi.events_of_type(Controller):
+        if controller.number == 7: volumes[controller.channel].append((controller.time, controller.value))
+        if controller.number == 11: expressions[controller.channel].append((controller.time, controller.value))
+    volumes = [ChangeTimeline(changes) for changes in volumes]
+    expressions = [ChangeTimeline(changes) for changes in expressions]
+
+    def value_during_note(timeline, note):
+        during = timeline.average(note.time, note.time + note.length)
+        return during if during is not None else timeline.latest(note.time, 96)
+
+    for note in midi.events_of_type(NoteOn):
+        volume = value_during_note(volumes[note.channel], note)
+        expression = value_during_note(expressions[note.channel], note)
+        note.real_volume = float32(float(VELOCITY_FRACTIONS[note.volume]) * volume / 127.0 * expression / 127.0)
+
+
+def prolong_sustained_notes(midi):
+    # (time, kind, event) with kinds 0 - pedal change, 1 - note start, 2 - note end
+    events = [(controller.time, 0, controller) for controller in midi.events_of_type(Controller) if controller.number == 64]
+    for note in midi.events_of_type(NoteOn):
+        if note.volume > 0:
+            events.append((note.time, 1, note))
+            events.append((note.end, 2, note))
+    events.sort(key=lambda event: event[0])
+
+    sustained = [[None] * 128 for _ in range(16)]
+    is_sustained = [False] * 16
+
+    for event_time, kind, event in events:
+        if kind == 1:
+            if sustained[event.channel][event.note] is not None:
+                previous = sustained[event.channel][event.note][0]
+                previous.end = event_time
+                previous.length = previous.end - previous.time
+            sustained[event.channel][event.note] = (event, False)
+
+        elif kind == 2:
+            sustained[event.channel][event.note] = (event, True) if is_sustained[event.channel] else None
+
+        else:
+            is_on = event.value >= 64
+            if not is_on:
+                for held in sustained[event.channel]:
+                    if held is None or not held[1]: continue
+                    note = held[0]
+                    note.end = event_time
+                    note.length = note.end - note.time
+                    sustained[event.channel][note.note] = None
+            is_sustained[event.channel] = is_on
+
+
+def determine_instruments(midi):
+    changes = [[] for _ in range(16)]
+    for change in midi.events_of_type(InstrumentChange):
+        changes[change.channel].append((change.time, change.program))
+    changes = [ChangeTimeline(channel) for channel in changes]
+
+    for note in midi.events_of_type(NoteOn):
+        if note.channel == PERCUSSION_CHANNEL: note.instrument = PERCUSSION
+        # a channel without any change before the note plays the piano, the default instrument of the Analyzer
+        else: note.instrument = changes[note.channel].latest(note.time, 0)
+
+
+def join_pitch_bends(midi):
+    for track in midi.tracks:
+        for channel in track.channels:
+            notes = [event for event in channel if isinstance(event, NoteOn)]
+            for bend in [event for event in channel if isinstance(event, PitchBend)]:
+                for note in notes:
+                    if note.time <= bend.time and note.time + note.length >= bend.time:
+                        note.bends.append(bend)
+
+
+# ranges set by the registered parameter 0 (controllers 101 and 100 with value 0, then the data entry 6)
+def determine_pitch_ranges(midi):
+    changes = [[] for _ in range(16)]
+    for track in midi.tracks:
+        for number, channel in enumerate(track.channels):
+            state = None
+            for event in channel:
+                if not isinstance(event, Controller):
+                    state = None
+                    continue
+                is_101 = event.number == 101 and event.value == 0
+                is_100 = event.number == 100 and event.value == 0
+                if state is None:
+                    if is_101: state = 101
+                elif state == 101:
+                    if is_100: state = 100
+                    elif is_101: state = 101
+                else:
+                    if event.number == 6:
+                        changes[number].append((event.time, event.value))
+                        state = None
+                    elif is_100: state = 100
+                    elif is_101: state = 101
+    changes = [ChangeTimeline(channel) for channel in changes]
+
+    for bend in midi.events_of_type(PitchBend):
+        bend.range = changes[bend.channel].latest(bend.time, 4)
+
+
+# bent notes are split into notes of the nearest pitches
+def discretize_bends(midi):
+    for note in [note for note in midi.events_of_type(NoteOn) if len(note.bends) > 0]:
+        current = note
+        end = note.end
+
+        bends = sorted(note.bends, key=lambda bend: bend.time)
+        note.bends = []
+
+        for bend in bends:
+            current.end = bend.time
+            current.length = current.end - current.time
+
+            pitch = int(note.note + bend.real_pitch_change + 0.5) & 0xFF
+            if pitch != current.note:
+                current = NoteOn(bend.ticks, note.channel, pitch, note.volume)
+                current.time = bend.time
+                current.instrument = note.instrument
+                current.real_volume = note.real_volume
+                midi.tracks[0].channels[current.channel].append(current)
+
+        current.end = end
+        current.length = current.end - current.time
+
+    for track in midi.tracks:
+        for i, channel in enumerate(track.channels):
+            track.channels[i] = [event for event in channel if not isinstance(event, PitchBend)]
+
+
+def transpose(midi, tone):
+    if midi.key is None: return
+
+    key_tone, minor = midi.key % 12, midi.key >= 12
+    target = tone if not minor else (tone - 3 + 12) % 12
+    down = key_tone - target if key_tone > target else key_tone - target + 12
+    up = 12 - down
+    shift = -down if down < up else up
+
+    for note in midi.events_of_type(NoteOn):
+        if note.is_percussion: continue
+        pitch = note.note + shift
+        if pitch < 0: pitch += 12
+        elif pitch > 127: pitch -= 12
+        note.note = pitch & 0xFF
+
+    def shifted(key):
+        return (key // 12) * 12 + (key % 12 + shift + 12) % 12
+
+    for beat in midi.events_of_type(BeatEvent):
+        beat.chord = shifted(beat.chord)
+    for signature in midi.events_of_type(KeySignature):
+        signature.key = shifted(signature.key)
+
+
+# ----------------------------------------------------------------------------------------------------------------
+# metre detection and tempo normalization (MidiParser/MetreNormalizer)
+
+PIP_TIME = 35  # quantization of the tactus tracker (milliseconds)
+MAX_EFFECTIVE_LENGTH = 1000
+TACTUS_MIN, TACTUS_MAX, TACTUS_WIDTH, TACTUS_STEP = 400.0, 1200.0, 1.8, 1.1
+BEAT_INTERVAL_FACTOR = 10.0
+NOTE_BONUS = 0.2
+PERCUSSION_MULTIPLE = 1.0
+
+
+def quantize(t):
+    return int(t / PIP_TIME + 0.5)
+
+
+MIN_PIPS, MAX_PIPS = quantize(TACTUS_MIN), quantize(TACTUS_MAX)
+DEFAULT_SCORE = math.log((TACTUS_MIN + TACTUS_MIN) / 2.0 + 1, 2.0)
+
+
+# Meter Fitness Metric of the beats written in the MIDI, returns the best offset of the metre
+def meter_fitness_metric(midi):
+    notes = midi.events_of_type(NoteOn)
+    if len(notes) == 0: return 0
+
+    tick = midi.base_ticks()
+    first_note_offset = min(note.ticks for note in notes)
+
+    def goodness_of_note(note, offset):
+        time = (note.ticks - offset) % tick
+        portion = int(time * 4.0 / tick + 0.5)
+        multiple = 1.0 if portion % 4 == 0 else (0.5 if portion % 2 == 0 else 0.25)
+        difference = (time - portion / 4.0 * tick) * 8.0 / tick
+        return math.exp(-difference * difference * 4 * 4) * multiple
+
+    played = [note for note in notes if note.volume > 0]
+    zero_offset_fit = linq_average(goodness_of_note(note, 0) for note in played)
+    first_note_offset_fit = linq_average(goodness_of_note(note, first_note_offset) for note in played)
+
+    if zero_offset_fit > first_note_offset_fit:
+        midi.goodness_of_metre_fit = float32(zero_offset_fit)
+        return 0
+    midi.goodness_of_metre_fit = float32(first_note_offset_fit)
+    return first_note_offset
+
+
+def calculate_beat_lengths(midi):
+    beats = sorted(midi.events_of_type(BeatEvent), key=lambda beat: beat.time)
+    if len(beats) < 2: raise ValueError('too few beats')
+    for i in range(len(beats) - 1):
+        beats[i].length = beats[i + 1].time - beats[i].time
+    beats[-1].length = beats[-2].length
+
+
+# beats given by the time signatures of the MIDI
+def calculate_implicit_metre(midi, offset):
+    base = midi.base_ticks()
+    end = max(event.ticks for event in midi.events_of_type(EndOfTrack))
+    signatures = deque(sorted(midi.events_of_type(TimeSignature), key=lambda signature: signature.ticks))
+    numerator, denominator = 4, 4
+    tick = base * 4 // denominator
+    bar = 0
+    beats = midi.tracks[0].meta_events
+
+    if offset > 0: beats.append(BeatEvent(level=2))
+
+    ticks = offset
+    while ticks <= end:
+        if len(signatures) > 0 and signatures[0].ticks <= ticks:
+            signature = signatures.popleft()
+            numerator, denominator = signature.numerator, signature.denominator
+            bar = 0
+            tick = base * 4 // denominator
+        if tick == 0: raise ValueError('zero length of a beat')
+
+        level = 2
+        if bar % numerator == 0: level = 0
+        elif (numerator == 4 and bar % numerator == 2) or (numerator == 6 and bar % numerator == 3): level = 1
+
+        beats.append(BeatEvent(ticks=ticks, level=level))
+        bar += 1
+        ticks += tick
+
+    compute_real_times(midi)
+    calculate_beat_lengths(midi)
+
+    # too slow beats are halved
+    average_length = linq_average(beat.length for beat in midi.events_of_type(BeatEvent))
+    while average_length > 1000:
+        for beat in midi.events_of_type(BeatEvent):
+            beats.append(BeatEvent(time=beat.time + timespan(beat.length / 2), level=2))
+        calculate_beat_lengths(midi)
+        average_length = average_length / 2
+
+
+def pad_notes_to_zero(midi):
+    first_note_time = min(note.time for note in midi.events_of_type(NoteOn) if note.volume > 0)
+    for event in midi.events():
+        event.time = 0 if event.time < first_note_time else event.time - first_note_time
+
+
+def calculate_metre(midi):
+    offset = meter_fitness_metric(midi)
+
+    # use the beats that are already in the MIDI, or detect them
+    if midi.goodness_of_metre_fit > 0.4:
+        calculate_implicit_metre(midi, offset)
+    else:
+        pad_notes_to_zero(midi)
+
+        metre = [timespan(length) for length in Tactus(midi).compute()]
+        if len(metre) == 0 or metre[-1] <= 0: raise ValueError('no metre detected')
+        total = float(sum(metre))
+        while total <= midi.length:
+            metre.append(metre[-1])
+            total += metre[-1]
+
+        time = 0
+        for length in metre:
+            midi.tracks[0].meta_events.append(BeatEvent(time=time, length=length, level=0))
+            time += length
+
+        BeatStrengthAnalyzer(midi).analyze()
+
+    first_beat_time = min(beat.time for beat in midi.events_of_type(BeatEvent))
+    if first_beat_time != 0:
+        midi.tracks[0].meta_events.append(BeatEvent(time=0, length=first_beat_time, level=2))
+
+
+# beats stretched to 600 ms each
+def normalize(midi, prolong_sustained=False):
+    events = sorted(midi.events(), key=lambda event: event.time)
+    if len(events) == 0: raise ValueError('no events')
+    beats = sorted(midi.events_of_type(BeatEvent), key=lambda beat: beat.time)
+
+    position = 0
+    event = events[0]
+    normalized_time = 0
+
+    for beat in beats:
+        beat_time, beat_length = beat.time, beat.length
+        # the last event stays current after all are mapped, and is mapped again by the following beats
+        while event.time < beat_time + beat_length:
+            delta = (event.time - beat_time) * BEAT / beat_length
+            event.time = normalized_time + timespan(delta)
+
+            if position + 1 == len(events): break
+            position += 1
+            event = events[position]
+
+        normalized_time += BEAT
+
+    for beat in midi.events_of_type(BeatEvent):
+        beat.length = BEAT
+
+    create_note_lengths(midi)
+    determine_volumes(midi)
+    if prolong_sustained: prolong_sustained_notes(midi)
+
+
+class Tactus:
+
+    def __init__(self, midi):
+        notes = sorted([note for note in midi.events_of_type(NoteOn) if note.volume > 0 and note.note < 128], key=lambda note: note.time)
+        average_volume = np.float32(linq_average(note.real_volume for note in notes))
+
+        # (start, effective length, volume, is percussion) of the notes
+        wrappers = []
+        for note in notes:
+            volume = float(np.float32(note.real_volume) / average_volume)
+            wrappers.append((note.time, min(max(note.length, 0), MAX_EFFECTIVE_LENGTH), volume, note.is_percussion))
+
+        last_time = max(note.time + note.length for note in notes)
+        self.pip_notes = [[] for _ in range(quantize(last_time) + 1)]
+        for wrapper in wrappers:
+            self.pip_notes[quantize(wrapper[0])].append(wrapper)
+
+        self.base_scores = np.array([self.base_score(pip) for pip in self.pip_notes])
+        self.is_beat = [False] * len(self.pip_notes)
+
+        # best scores, previous beat lengths and tempo states of every pip and beat length (indexed from MIN_PIPS)
+        self.scores = np.zeros((len(self.pip_notes), MAX_PIPS - MIN_PIPS + 1))
+        self.previous = np.zeros((len(self.pip_notes), MAX_PIPS - MIN_PIPS + 1), dtype=np.int64)
+        self.raising = np.zeros((len(self.pip_notes), MAX_PIPS - MIN_PIPS + 1), dtype=bool)
+
+    @staticmethod
+    def base_score(notes):
+        if len(notes) == 0: return 0.0
+
+        average_length = linq_sum(note[1] for note in notes) / len(notes) / 1000.0
+        average_volume = linq_average(math.sqrt(note[2]) for note in notes)
+        percussion_count = sum(1 for note in notes if note[3]) * PERCUSSION_MULTIPLE
+
+        return 1.0 * (((math.sqrt(len(notes)) + percussion_count) * average_length * average_volume) + NOTE_BONUS)
+
+    # lengths between beats, in milliseconds
+    def compute(self):
+        tmin = TACTUS_MIN
+        best = (MIN_DOUBLE, 0, 0)
+
+        tmax = TACTUS_MIN * TACTUS_WIDTH
+        while tmax <= TACTUS_MAX:
+            min_pip, max_pip = quantize(tmin), quantize(tmax)
+            self.compute_tactus_scores(min_pip, max_pip)
+            score = self.evaluate_solution(min_pip, max_pip, False)
+            if score > best[0]: best = (score, min_pip, max_pip)
+            tmax *= TACTUS_STEP
+            tmin *= TACTUS_STEP
+
+        _, min_pip, max_pip = best
+        self.compute_tactus_scores(min_pip, max_pip)
+        self.evaluate_solution(min_pip, max_pip, True)
+
+        lengths = []
+        last_time = 0.0
+        for index in range(1, len(self.pip_notes)):
+            if not self.is_beat[index]: continue
+            notes = self.pip_notes[index]
+            pip_time = linq_sum(float(note[0]) for note in notes) / len(notes) if len(notes) > 0 else float(index * PIP_TIME)
+            lengths.append(pip_time - last_time)
+            last_time = pip_time
+        return lengths
+
+    def evaluate_solution(self, min_pip, max_pip, compute_beats):
+        best = (MIN_DOUBLE, -1, -1)
+        n = len(self.pip_notes)
+
+        i = n - 1
+        while i >= n - max_pip and i >= 0:
+            for length in range(min_pip, max_pip + 1):
+                score = self.scores[i, length - MIN_PIPS]
+                if score > best[0]: best = (score, int(self.previous[i, length - MIN_PIPS]), i)
+            i -= 1
+
+        if best[2] == -1: raise ValueError('no scores to look at')
+        if compute_beats: self.label_beats(best[2], best[1])
+        return best[0]
+
+    def label_beats(self, index, length):
+        while index >= 0:
+            if length < MIN_PIPS or length > MAX_PIPS: raise ValueError('beat length out of range')
+            self.is_beat[index] = True
+            previous = int(self.previous[index, length - MIN_PIPS])
+            index -= length
+            length = previous
+
+    # the dynamic programming over all pips, a block of min_pip pips depends only on the pips before it, so the
+    # block is computed at once for all its pips, beat lengths and lengths of the previous beat
+    def compute_tactus_scores(self, min_pip, max_pip):
+        lengths = np.arange(min_pip, max_pip + 1)
+        columns = lengths - MIN_PIPS
+        n = len(self.pip_notes)
+        base_scores = self.base_scores
+
+        # length multiples, penalties and tempo states by (length, previous length)
+        first_multiple = np.array([math.log(((length + length) * PIP_TIME) / 2.0 + 1, 2.0) for length in lengths])
+        multiple = np.array([[math.log((length + previous) * PIP_TIME / 2.0 + 1, 2.0) for previous in lengths] for length in lengths])
+        difference = np.abs(lengths[:, None] - lengths[None, :]) * PIP_TIME
+        penalty = BEAT_INTERVAL_FACTOR * np.sqrt(difference / 1000.0)
+
+        for start in range(0, n, min_pip):
+            rows = np.arange(start, min(start + min_pip, n))
+            index = rows[:, None]
+            early = index - lengths[None, :] < 0
+
+            def pips(offset):
+                return base_scores[np.maximum(index - offset, 0)]
+
+            syncopation = pips(lengths // 2) / 4 + pips(lengths // 3) / 12 + pips(lengths * 2 // 3) / 12 + pips(lengths // 4) / 16 + pips(lengths * 3 // 4) / 16
+            weight = (syncopation + base_scores[index])[:, :, None]
+
+            previous_rows = np.maximum(index - lengths[None, :], 0)
+            previous_scores = self.scores[previous_rows][:, :, columns]
+            previous_raising = self.raising[previous_rows][:, :, columns]
+
+            # the state automaton of small tempo changes, the differences are never negative
+            punished = np.where(previous_raising, difference > 0, difference > PIP_TIME)
+            raising = np.where(previous_raising, difference == 0, (difference > 0) & (difference <= PIP_TIME))
+            first_beat = (index - lengths[None, :])[:, :, None] - lengths[None, None, :] < 0
+
+            scores = np.where(first_beat,
+                              previous_scores + weight * first_multiple[None, :, None],
+                              previous_scores + (weight * multiple[None] - np.where(punished, penalty[None], 0.0)))
+
+            best = np.argmax(scores, axis=2)
+            best_scores = np.take_along_axis(scores, best[:, :, None], axis=2)[:, :, 0]
+            last_raising = np.where(first_beat[:, :, -1], False, raising[:, :, -1])
+
+            self.scores[rows[:, None], columns[None, :]] = np.where(early, base_scores[index] * DEFAULT_SCORE, best_scores)
+            self.previous[rows[:, None], columns[None, :]] = np.where(early, -1, lengths[best])
+            self.raising[rows[:, None], columns[None, :]] = np.where(early, self.raising[rows[:, None], columns[None, :]], last_raising)
+
+
+BEAT_INTERVALS = [2, 3, 4, 5, 6, 7]
+INTERVAL_BONUS = [1.7, 3, 4, 4.7, 5.9, 6]
+DIFFERENT_INTERVAL_PENALTY = -1.0
+
+
+class BeatSegment:
+
+    def __init__(self, beat, index):
+        self.beat = beat
+        self.index = index
+        self.notes = []
+        self.scores = [0.0] * len(BEAT_INTERVALS)
+        self.previous = [None] * len(BEAT_INTERVALS)
+        self.best = (None, MIN_DOUBLE)
+        self.base_score = 0.0
+
+
+# strong beats, selected by the intervals between them
+class BeatStrengthAnalyzer:
+
+    def __init__(self, midi):
+        self.midi = midi
+        self.beats = sorted(midi.events_of_type(BeatEvent), key=lambda beat: beat.time)
+        self.segments = [BeatSegment(beat, i) for i, beat in enumerate(self.beats)]
+
+    def analyze(self):
+        self.add_notes_to_segments()
+        self.connect_segments()
+        self.choose_strong_beats()
+
+    def add_notes_to_segments(self):
+        current = 0
+        segments = self.segments
+        for note in sorted([note for note in self.midi.events_of_type(NoteOn) if note.volume > 0], key=lambda note: note.time):
+            # the notes may come 50 ms early
+            while current < len(segments) - 1 and segments[current].beat.time + segments[current].beat.length <= note.time + 50:
+                current += 1
+            if abs(segments[current].beat.time - note.time) <= 50:
+                segments[current].notes.append(note)
+
+    def connect_segments(self):
+        for segment in self.segments:
+            segment.base_score = linq_sum(note.real_volume * total_seconds(note.length) for note in segment.notes)
+
+            segment.best = (None, MIN_DOUBLE)
+            for i, interval in enumerate(BEAT_INTERVALS):
+                if interval > segment.index:
+                    segment.scores[i] = segment.base_score
+                    segment.previous[i] = None
+                    continue
+
+                best = (None, MIN_DOUBLE)
+                previous = self.segments[segment.index - interval]
+                for j in range(len(BEAT_INTERVALS)):
+                    score = previous.scores[j] + (segment.base_score + 0.1) * INTERVAL_BONUS[i] * (DIFFERENT_INTERVAL_PENALTY if i != j else 1)
+                    if score > best[1]: best = (j, score)
+
+                segment.scores[i] = best[1]
+                segment.previous[i] = best[0]
+                if segment.scores[i] > segment.best[1]: segment.best = (i, segment.scores[i])
+
+    def choose_strong_beats(self):
+        for beat in self.beats:
+            beat.level = 1
+
+        last, _ = max_with_index([segment.best[1] for segment in self.segments])
+        segment = self.segments[last]
+        interval = BEAT_INTERVALS[segment.best[0]] if segment.best[0] is not None else None
+        previous = segment.previous[segment.best[0]] if segment.best[0] is not None else None
+
+        while interval is not None and segment.index - interval > 0:
+            segment.beat.level = 0
+            weak = {3: (1, 2), 4: (1, 3), 6: (1, 2, 4, 5)}.get(interval, ())
+            for distance in weak:
+                self.segments[segment.index - distance].beat.level = 2
+
+            segment = self.segments[segment.index - interval]
+            interval = BEAT_INTERVALS[previous] if previous is not None else None
+            previous = segment.previous[previous] if previous is not None else None
+        segment.beat.level = 0
+
+
+# ----------------------------------------------------------------------------------------------------------------
+# key and chords (MidiParser/KeyDetector and ChordDetector)
+
+MAJOR_KEY_PROFILE = [0.08874125044, 0.007118282121, 0.05789536125, 0.009728318899, 0.07948748369, 0.05457349626,
+                     0.01138925139, 0.08482619528, 0.01233835568, 0.04342152094, 0.006762368015, 0.04745521414]
+MINOR_KEY_PROFILE = [0.08447028117, 0.00996559497, 0.05623442876, 0.07331830585, 0.005813263732, 0.05457349626,
+                     0.01245699371, 0.08862261241, 0.04792976628, 0.007948748369, 0.0157788587, 0.03915055167]
+
+
+def correlation(a, b):
+    average_a, average_b = linq_average(a), linq_average(b)
+    variance_a = linq_sum((x - average_a) * (x - average_a) for x in a)
+    variance_b = linq_sum((y - average_b) * (y - average_b) for y in b)
+    return divide(linq_sum((x - average_a) * (y - average_b) for x, y in zip(a, b)), math.sqrt(variance_a * variance_b))
+
+
+# pitch classes played in every 1200 ms, the features of the Analyzer's key detector
+def pitch_profile(midi):
+    notes = sorted([note for note in midi.events_of_type(NoteOn) if note.real_volume > 0 and not note.is_percussion], key=lambda note: note.time)
+
+    occurrences = [0.0] * 12
+    next_beat = 1200
+    occurred = [False] * 12
+    for note in notes:
+        if note.time >= next_beat:
+            for i in range(12):
+                if not occurred[i]: continue
+                occurrences[i] += 1
+                occurred[i] = False
+            next_beat += 1200
+        occurred[note.note % 12] = True
+
+    total = linq_sum(occurrences)
+    return [divide(occurrence, total) for occurrence in occurrences]
+
+
+# correlation of the pitch profile with the key profiles of all tones
+def find_key(midi):
+    occurrences = deque(pitch_profile(midi))
+    major, minor = [], []
+    for _ in range(12):
+        major.append(correlation(list(occurrences), MAJOR_KEY_PROFILE))
+        minor.append(correlation(list(occurrences), MINOR_KEY_PROFILE))
+        occurrences.rotate(-1)
+
+    major_tone, major_value = max_with_index(major)
+    minor_tone, minor_value = max_with_index(minor)
+    return major_tone if major_value > minor_value else minor_tone + 12
+
+
+def analyze_key(midi):
+    signatures = midi.events_of_type(KeySignature)
+    if any(signature.key != 0 for signature in signatures):
+        midi.key = signatures[0].key
+        midi.is_key_found_by_midi_itself = True
+    else:
+        midi.key = find_key(midi)
+        midi.is_key_found_by_midi_itself = False
+
+
+MAJOR_INTERVAL_SCORES = [1.0, -0.4, 0.1, -1.4, 0.7, 0.1, 0.2, 0.8, -0.3, 0.0, 0.4, 0.2]
+MINOR_INTERVAL_SCORES = [1.0, -0.2, 0.0, 0.7, -1.2, 0.1, 0.2, 0.6, 0.0, -0.2, 0.4, -0.2]
+START_ON_BEAT_MULTIPLE = 2
+BASE_NOTE_SUM = 0.2
+
+
+class NotesInSegment:
+
+    def __init__(self, start, length, lowest_pitch):
+        self.start = start
+        self.length = length
+        self.lowest_pitch = lowest_pitch
+        self.notes = []
+        self.weights = []
+        self.scores = [0.0] * 24
+        self.total_note_weight = 0.0
+
+    def join(self, other):
+        if other.start < self.start: self.start = other.start
+        self.length = self.length + other.length
+
+        ids = set(id(note) for note in self.notes)
+        self.notes = self.notes + [note for note in other.notes if id(note) not in ids and not ids.add(id(note))]
+        self.weights = [0.0] * len(self.notes)
+
+    def add_note(self, note):
+        self.notes.append(note)
+        self.weights.append(0.0)
+
+    def compute_scores(self, start_on_beat_bonus):
+        self.compute_weights()
+
+        for chord in range(24):
+            tone, intervals = chord % 12, MAJOR_INTERVAL_SCORES if chord < 12 else MINOR_INTERVAL_SCORES
+            score = 0.0
+            for note, weight in zip(self.notes, self.weights):
+                interval_score = intervals[(note.note - tone + 12) % 12]
+                if start_on_beat_bonus and abs(note.time - self.start) < 20:
+                    interval_score *= START_ON_BEAT_MULTIPLE
+                score += interval_score * weight
+            self.scores[chord] = score
+
+    def compute_weights(self):
+        self.total_note_weight = BASE_NOTE_SUM
+        for i, note in enumerate(self.notes):
+            length = min(float(self.start + self.length), float(note.end)) - max(float(note.time), float(self.start))
+            weight = note.real_volume * divide(length, float(self.length)) * 1.0 / ((note.note - self.lowest_pitch) // 12 + 1)
+            self.weights[i] = weight
+            self.total_note_weight += weight
+
+
+MAJOR_SCALE = [True, False, True, False, True, True, False, True, False, True, False, True]
+MINOR_SCALE = [True, False, True, True, False, True, False, True, True, False, True, False]
+DIFFERENCE_PENALTY = [0, 1, 1.5, 3, 4, 6, 8]
+NOTES_IN_LEVEL_0 = 1.5
+NOTES_IN_LEVEL_1 = 1.5
+NOTES_IN_LEVEL_2 = 1.8
+DIFF_FROM_KEY_MULTIPLE = 0.1 / 4
+CHORD_IN_SCALE_MULTIPLE = 0.15 / 4
+DIFF_FROM_PREVIOUS_CHORD = 0.175 / 1
+DIFF_ON_WEAK_BEAT = 0.7
+
+
+def difference_on_line_of_fifths(a, b):
+    a_position = a % 12 + (3 if a >= 12 else 0)
+    b_position = b % 12 + (3 if b >= 12 else 0)
+    fifths = (7 * abs(a_position - b_position)) % 12
+    return min(fifths, 12 - fifths)
+
+
+# penalties for changing the chord, by (chord, previous chord)
+CHORD_CHANGE_PENALTY = [[DIFFERENCE_PENALTY[2 if difference_on_line_of_fifths(chord, previous) == 0 and (chord >= 12) != (previous >= 12)
+                                            else difference_on_line_of_fifths(chord, previous)] for previous in range(24)] for chord in range(24)]
+
+
+class ChordSegment:
+
+    def __init__(self, key, previous, beat, lowest_pitch):
+        self.key = key
+        self.previous = previous
+        self.beat = beat
+        self.notes_in_level_2 = NotesInSegment(beat.time, beat.length, lowest_pitch)
+        self.notes_in_level_1 = None
+        self.notes_in_level_0 = None
+        self.best_previous = [0] * 24
+        self.scores = [0.0] * 24
+        self.base_scores = [0.0] * 24
+        self.note_sum = 0.0
+
+    def connect_to_previous_segment(self):
+        level = self.beat.level
+        for chord in range(24):
+            best = (0, MIN_DOUBLE)
+            for previous in range(24):
+                difference_score = -DIFF_FROM_PREVIOUS_CHORD * CHORD_CHANGE_PENALTY[chord][previous] * self.note_sum
+                difference_score += DIFF_ON_WEAK_BEAT * difference_score * level * level
+
+                score = self.previous.scores[previous] + self.base_scores[chord] + difference_score
+                if best[1] < score: best = (previous, score)
+
+            self.scores[chord] = best[1]
+            self.best_previous[chord] = best[0]
+
+    def calculate_base_scores(self):
+        self.notes_in_level_2.compute_scores(True)
+
+        self.note_sum = (NOTES_IN_LEVEL_2 * self.notes_in_level_2.total_note_weight +
+                         NOTES_IN_LEVEL_1 * self.notes_in_level_1.total_note_weight +
+                         NOTES_IN_LEVEL_0 * self.notes_in_level_0.total_note_weight)
+
+        for chord in range(24):
+            self.base_scores[chord] = self.base_score(chord)
+
+    def base_score(self, chord):
+        score = 0.0
+        score += NOTES_IN_LEVEL_0 * self.notes_in_level_0.scores[chord]
+        score += NOTES_IN_LEVEL_1 * self.notes_in_level_1.scores[chord]
+        score += NOTES_IN_LEVEL_2 * self.notes_in_level_2.scores[chord]
+
+        score += -DIFF_FROM_KEY_MULTIPLE * DIFFERENCE_PENALTY[difference_on_line_of_fifths(chord, self.key)] * self.note_sum
+
+        scale = MAJOR_SCALE if self.key < 12 else MINOR_SCALE
+        tone, key_tone = chord % 12, self.key % 12
+        notes_in_scale = 0
+        if scale[(tone - key_tone + 12) % 12]: notes_in_scale += 1
+        if scale[(tone - key_tone + 7 + 12) % 12]: notes_in_scale += 1
+        if chord < 12 and scale[(tone - key_tone + 4 + 12) % 12]: notes_in_scale += 1
+        if chord >= 12 and scale[(tone - key_tone + 3 + 12) % 12]: notes_in_scale += 1
+
+        score += -CHORD_IN_SCALE_MULTIPLE * math.pow(2, 3 - notes_in_scale) * self.note_sum
+        return score
+
+
+# a chord of every beat by dynamic programming over the beats
+class ChordAnalyzer:
+
+    def __init__(self, midi):
+        self.midi = midi
+        self.beats = sorted(midi.events_of_type(BeatEvent), key=lambda beat: beat.time)
+        self.lowest_pitch = min(note.note for note in midi.events_of_type(NoteOn) if not note.is_percussion and note.volume > 0)
+
+        key_changes = deque(sorted(midi.events_of_type(KeySignature), key=lambda signature: signature.time)) if midi.is_key_found_by_midi_itself else deque()
+        key = key_changes.popleft().key if midi.is_key_found_by_midi_itself else midi.key
+
+        self.segments = [ChordSegment(key, None, self.beats[0], self.lowest_pitch)]
+        for beat in self.beats[1:]:
+            while len(key_changes) > 0 and key_changes[0].time <= beat.time:
+                key = key_changes.popleft().key
+            self.segments.append(ChordSegment(key, self.segments[-1], beat, self.lowest_pitch))
+
+    def analyze(self):
+        self.add_notes_to_segments()
+        self.connect_segments()
+        self.choose_best_chords()
+
+    def add_notes_to_segments(self):
+        segments = self.segments
+        current = 0
+        for note in sorted([note for note in self.midi.events_of_type(NoteOn) if not note.is_percussion and note.volume > 0], key=lambda note: note.time):
+            while segments[current].beat.time + segments[current].beat.length <= note.time:
+                current += 1
+
+            span = current
+            while span < len(segments) and segments[span].beat.time < note.end:
+                segments[span].notes_in_level_2.add_note(note)
+                span += 1
+
+        # notes of the medium and strong beats, from one such beat to the next one
+        notes_in_level_0 = NotesInSegment(0, 0, self.lowest_pitch)
+        notes_in_level_1 = NotesInSegment(0, 0, self.lowest_pitch)
+
+        for segment in segments:
+            if segment.beat.level == 1 or segment.beat.level == 0:
+                notes_in_level_1.compute_scores(True)
+                notes_in_level_1 = NotesInSegment(segment.beat.time, 0, self.lowest_pitch)
+            if segment.beat.level == 0:
+                notes_in_level_0.compute_scores(False)
+                notes_in_level_0 = NotesInSegment(segment.beat.time, 0, self.lowest_pitch)
+
+            segment.notes_in_level_0 = notes_in_level_0
+            segment.notes_in_level_1 = notes_in_level_1
+
+            notes_in_level_0.join(segment.notes_in_level_2)
+            notes_in_level_1.join(segment.notes_in_level_2)
+
+        notes_in_level_0.compute_scores(False)
+        notes_in_level_1.compute_scores(True)
+
+    def connect_segments(self):
+        self.segments[0].calculate_base_scores()
+        self.segments[0].scores = self.segments[0].base_scores
+
+        for segment in self.segments[1:]:
+            segment.calculate_base_scores()
+            segment.connect_to_previous_segment()
+
+    def choose_best_chords(self):
+        index, _ = max_with_index(self.segments[-1].scores)
+        self.segments[-1].beat.chord = index
+
+        for i in range(len(self.segments) - 2, -1, -1):
+            index = self.segments[i + 1].best_previous[index]
+            self.segments[i].beat.chord = index
+
+
+# ----------------------------------------------------------------------------------------------------------------
+# .mus writer (MusParser/ModelToMusicEvents.cs)
+
+class NoteCluster:
+
+    def __init__(self, chord, order_in_beat):
+        self.note_starts = []  # (pitch, volume, instrument, cluster)
+        self.note_ends = []  # (pitch, cluster)
+        self.percussion_starts = []  # (type, volume)
+        self.percussion_ends = []  # type
+        self.chord = chord
+        self.order_in_beat = order_in_beat
+
+
+def volume_byte(volume):
+    sign = (volume > 0) - (volume < 0)
+    return min(max(int((sign * math.pow(abs(volume), 1.0 / 2.0) + 1) * 128 + 0.5), 0), 255)
+
+
+# end the notes held for their last frame, shorten the others; returns True when any note was held
+def release_notes(cluster, note_hold, percussion_hold):
+    any_held = False
+    for key in list(note_hold):
+        hold = note_hold[key]
+        if hold[0] == 1: cluster.note_ends.append((key[1], key[0]))
+        hold[0] -= 1
+        any_held = True
+        if hold[0] == 0: del note_hold[key]
+    for typ in list(percussion_hold):
+        if percussion_hold[typ] == 1: cluster.percussion_ends.append(typ)
+        percussion_hold[typ] -= 1
+        any_held = True
+        if percussion_hold[typ] == 0: del percussion_hold[typ]
+    return any_held
+
+
+def hold_length(note):
+    length = int(note.length / FRAME + 0.5)
+    if length > MAX_NOTE_LENGTH: length = MAX_NOTE_LENGTH
+    if length <= 0: length = 1
+    return length
+
+
+def music_events(midi):
+    metre = sorted(midi.events_of_type(BeatEvent), key=lambda beat: beat.time)
+    if len(metre) == 0: raise ValueError('the MIDI has no beats, it has to be analyzed before converting')
+
+    notes = sorted([note for note in midi.events_of_type(NoteOn) if note.volume > 0 and instrument_cluster(note.instrument) != NONMUSICAL], key=lambda note: note.time)
+    if len(notes) == 0: return b''
+
+    average_volume = np.float32(linq_average(note.real_volume for note in notes))
+    offset = (notes[0].time // BEAT) * BEAT
+
+    # (cluster, pitch) -> [remaining frames, index of the starting cluster, volume], type -> remaining frames
+    note_hold = {}
+    percussion_hold = {}
+
+    clusters = [NoteCluster(metre[0].chord, 0)]
+    frames = offset // FRAME
+    quantized_time = 0.0
+
+    for note in notes:
+        # frames between the previous note and this one
+        difference = (float(note.time) - offset - quantized_time) / FRAME + 0.5
+        delta = int(difference)
+        quantized_time += delta * FRAME
+
+        for _ in range(delta):
+            frames += 1
+            clusters.append(NoteCluster(metre[min(frames // TICKS_PER_BEAT, len(metre) - 1)].chord, frames % TICKS_PER_BEAT))
+            release_notes(clusters[-1], note_hold, percussion_hold)
+
+        volume = float(np.float32(note.real_volume) - average_volume)
+
+        if note.is_percussion:
+            typ = note.note
+            if typ < PERCUSSION_MIN or typ > PERCUSSION_MAX: continue
+            if any(start[0] == typ for start in clusters[-1].percussion_starts): continue
+
+            if percussion_hold.get(typ, 0) > 0: clusters[-1].percussion_ends.append(typ)
+            percussion_hold[typ] = hold_length(note)
+            clusters[-1].percussion_starts.append((typ, volume))
+
+        else:
+            cluster = instrument_cluster(note.instrument)
+            low, high = CLUSTER_RANGES[cluster]
+            pitch = note.note
+            while pitch > high: pitch -= 12
+            while pitch < low: pitch += 12
+
+            previous = note_hold.get((cluster, pitch))
+            if previous is not None:
+                # a long held note is ended, a recent one is replaced by a louder one
+                if len(clusters) - 1 - previous[1] >= RETRIGGER_FRAMES:
+                    clusters[-1].note_ends.append((pitch, cluster))
+                elif note.real_volume <= previous[2]:
+                    continue
+                else:
+                    starts = clusters[previous[1]].note_starts
+                    for i, start in enumerate(starts):
+                        if start[3] == cluster and start[0] == pitch:
+                            del starts[i]
+                            break
+
+            note_hold[(cluster, pitch)] = [hold_length(note), len(clusters) - 1, note.real_volume]
+            clusters[-1].note_starts.append((pitch, volume, note.instrument, cluster))
+
+    # wait for the end of all held notes
+    while True:
+        frames += 1
+        clusters.append(NoteCluster(metre[min(frames // TICKS_PER_BEAT, len(metre) - 1)].chord, frames % 12))
+        if not release_notes(clusters[-1], note_hold, percussion_hold): break
+
+    return write_clusters(clusters)
+
+
+def write_clusters(clusters):
+    output = bytearray()
+    pause = 0
+
+    for i, cluster in enumerate(clusters):
+        note_starts = sorted(cluster.note_starts, key=lambda start: (start[3], start[0]))
+        note_ends = sorted(cluster.note_ends, key=lambda end: (end[1], end[0]))
+        percussion_starts = sorted(cluster.percussion_starts, key=lambda start: start[0])
+        percussion_ends = sorted(cluster.percussion_ends)
+
+        if note_starts or note_ends or percussion_starts or percussion_ends:
+            # time shifts with the chord of the next beat, by half beats where possible
+            while pause > 0:
+                chord = STOP_CHORD if i - pause + 12 >= len(clusters) else clusters[i - pause + 12].chord
+                if pause >= 6 and clusters[i - pause].order_in_beat % 6 == 0:
+                    output += bytes((5, 1, 0, chord))
+                    pause -= 6
+                else:
+                    output += bytes((4, 1, 0, chord))
+                    pause -= 1
+
+        for typ in percussion_ends:
+            output += bytes((3, typ - PERCUSSION_MIN, 0, 0))
+        for pitch, cluster_index in note_ends:
+            output += bytes((1, pitch - CLUSTER_RANGES[cluster_index][0], cluster_index, 0))
+        for typ, volume in percussion_starts:
+            output += bytes((2, typ - PERCUSSION_MIN, volume_byte(volume), 0))
+        for pitch, volume, instrument, cluster_index in note_starts:
+            output += bytes(((cluster_index << 4) & 0xFF, pitch - CLUSTER_RANGES[cluster_index][0], volume_byte(volume), instrument & 0xFF))
+
+        pause += 1
+
+    output += bytes((6, 0, 0, 0))
+    return bytes(output)
+
+
+# ----------------------------------------------------------------------------------------------------------------
+# conversion of files
+
+# the analysis of MidiToModelParser.Parse with the settings of the batch conversion (note lengths, pitch bends,
+# real volumes and instruments, normalized tempo, keys and chords); the options are the other settings of the Analyzer
+def analyze(midi, prolong_sustained=False, discretize=False, transpose_to_c=False):
+    compute_real_times(midi)
+    create_note_lengths(midi)
+    midi.length = max(event.time for event in midi.events_of_type(EndOfTrack))
+
+    determine_volumes(midi)
+    prolong_sustained_notes(midi)
+
+    calculate_metre(midi)
+    normalize(midi, prolong_sustained)
+
+    if discretize:
+        join_pitch_bends(midi)
+        determine_pitch_ranges(midi)
+        discretize_bends(midi)
+
+    determine_instruments(midi)
+    analyze_key(midi)
+    ChordAnalyzer(midi).analyze()
+
+    if transpose_to_c: transpose(midi, 0)
+    return midi
+
+
+# .mus bytes of one MIDI file
+def convert(filename, prolong_sustained=False, discretize=False, transpose_to_c=False):
+    with open(filename, 'rb') as f:
+        midi = parse_midi(f.read())
+    with np.errstate(all='ignore'):
+        return music_events(analyze(midi, prolong_sustained, discretize, transpose_to_c))
+
+
+def convert_in_worker(job):
+    filename, options = job
+    try:
+        return filename, convert(filename, **options), None
+    except Exception as e:
+        return filename, None, '{}: {}'.format(type(e).__name__, e)
+
+
+# (filename, .mus bytes, error) of every file in the given order, files that fail (like in the Analyzer, mostly
+# broken MIDI files) have no bytes but the error; converted in `workers` processes or in this one when workers is 0
+def convert_files(filenames, workers=0, **options):
+    jobs = [(filename, options) for filename in filenames]
+    if workers == 0:
+        yield from map(convert_in_worker, jobs)
+        return
+
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        yield from pool.imap(convert_in_worker, jobs)
+
+
+# differences between two .mus songs, the chords of time shifts are compared separately
+def compare_songs(ours, theirs):
+    ours = [ours[i:i + 4] for i in range(0, len(ours), 4)]
+    theirs = [theirs[i:i + 4] for i in range(0, len(theirs), 4)]
+
+    def without_chord(event):
+        return event[:3] if event[0] & 0x0F in (4, 5) else event
+
+    first_difference = next((i for i, (a, b) in enumerate(zip(ours, theirs)) if without_chord(a) != without_chord(b)), None)
+    if first_difference is None and len(ours) != len(theirs): first_difference = min(len(ours), len(theirs))
+
+    return {'events': len(ours), 'reference_events': len(theirs), 'identical': ours == theirs,
+            'first_difference': first_difference,
+            'chord_differences': sum(1 for a, b in zip(ours, theirs) if without_chord(a) == without_chord(b) and a != b)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generative Model -- MIDI to .mus Conversion')
+    parser.add_argument('files', type=str, nargs='+', help='MIDI files or folders with them (searched with subfolders)')
+    parser.add_argument('--output', type=str, default='', help='write all songs into this one .mus file, like "Convert Batch" of the Analyzer')
+    parser.add_argument('--output_folder', type=str, default='', help='write every song into its own .mus file in this folder')
+    parser.add_argument('--compare', type=str, default='', help='folder with .mus files of the Analyzer (named like the MIDI files), report the differences from them')
+    parser.add_argument('--workers', type=int, default=0, help='number of worker processes, 0 converts in this process (default: 0)')
+    parser.add_argument('--shuffle', type=bool, default=False, help='write the songs into --output in a random order, like the Analyzer (default: False)')
+    parser.add_argument('--seed', type=int, default=42, help='random seed of --shuffle (default: 42)')
+    parser.add_argument('--prolong_sustained_notes', type=bool, default=False, help='prolong the notes held by the sustain pedal also after the tempo normalization (default: False)')
+    parser.add_argument('--discretize_bends', type=bool, default=False, help='split the notes bent by pitch bends into notes of the nearest pitches (default: False)')
+    parser.add_argument('--transpose_to_c', type=bool, default=False, help='transpose the songs into C major or A minor (default: False)')
+    args = parser.parse_args()
+
+    filenames = find_files(args.files, ('.mid', '.midi'), recursive=True)
+    if args.shuffle: random.Random(args.seed).shuffle(filenames)
+    if args.output_folder != '': os.makedirs(args.output_folder, exist_ok=True)
+
+    options = {'prolong_sustained': args.prolong_sustained_notes, 'discretize': args.discretize_bends, 'transpose_to_c': args.transpose_to_c}
+    output = open(args.output, 'wb') if args.output != '' else None
+    start_time = time.time()
+    converted, events, failed, different = 0, 0, [], []
+
+    print('-' * 89)
+    for filename, data, error in convert_files(filenames, args.workers, **options):
+        name = os.path.splitext(os.path.basename(filename))[0]
+        if error is not None:
+            failed.append(filename)
+            print('| {:60s} | failed: {}'.format(name[-60:], error))
+            continue
+
+        converted += 1
+        events += len(data) // 4
+        if output is not None: output.write(data)
+        if args.output_folder != '':
+            with open(os.path.join(args.output_folder, name + '.mus'), 'wb') as f:
+                f.write(data)
+
+        if args.compare != '':
+            reference = os.path.join(args.compare, name + '.mus')
+            if not os.path.isfile(reference):
+                print('| {:60s} | no reference {}'.format(name[-60:], reference))
+                continue
+            with open(reference, 'rb') as f:
+                result = compare_songs(data, f.read())
+            if not result['identical']: different.append(filename)
+            print('| {:60s} | {} | {:6d} events, first difference {}, chord differences {}'.format(
+                name[-60:], 'same' if result['identical'] else 'diff', result['events'], result['first_difference'], result['chord_differences']))
+
+    if output is not None: output.close()
+    elapsed = time.time() - start_time
+
+    print('-' * 89)
+    print('| converted {} of {} files ({} events) in {:.2f}s, {} failed'.format(converted, len(filenames), events, elapsed, len(failed)))
+    if args.output != '': print('| songs saved as ' + args.output)
+    if args.compare != '': print('| {} songs differ from the Analyzer'.format(len(different)))
+    print('-' * 89)
+
+    if len(different) > 0: sys.exit(1)
@@ -0,0 +1,236 @@
+"""Export of .mus songs (or of generated event ids) as standard MIDI files, without the Analyzer."""
+
+# The events are read as the event ids of Loader, so a song can come from a .mus file as well as straight from a
+# generating loop. Every instrument cluster plays on its own channel with the typical instrument of the cluster and
+# the channel volume 64 (like MusicEventsToModel of the Analyzer), which puts the drums on channel 10. A note-on of
+# a sounding pitch ends the previous note first, note-offs of silent pitches are ignored and notes are cut after 5 s
+# (4.8 s for drums), the same rules as the Analyzer uses. The volume byte is the square root of the difference from
+# the average volume, so the velocity is 64 + 64 * (volume byte / 128 - 1)^2 (with its sign). A time shift moves by
+# one frame (50 ms) or a half beat, with 40 ticks per frame and 600 ms beats (100 BPM). The MIDI is written while
+# the events are read: only the sounding notes are kept and the track is written in small blocks, its length is
+# filled in at the end, so a song of any length is exported in constant memory.
+
+import argparse
+import heapq
+import multiprocessing
+import os
+import time
+
+from midi_to_mus import CLUSTER_RANGES, PERCUSSION_CHANNEL
+from utils import Loader, find_files
+
+
+TICKS_PER_FRAME = 40
+TICKS_PER_BEAT = 12 * TICKS_PER_FRAME
+TEMPO = 600000  # microseconds per beat
+BIG_SPACE_FRAMES = 6
+END_PAUSE_FRAMES = 200  # pause after the end of a song, when more songs follow
+MAX_NOTE_FRAMES = 100
+MAX_PERCUSSION_FRAMES = 96
+BUFFER_SIZE = 65536
+CHANNEL_VOLUME = 64  # controller 7 of every channel, as MusicEventsToModel of the Analyzer writes it
+
+# General MIDI programs of the typical instruments of the clusters (Instrument.TypicalInstrument of the Analyzer):
+# piano, steel acoustic guitar, string ensemble, finger bass, flute, warm pad, distortion guitar, rock organ,
+# vibraphone, (drums), cello
+CLUSTER_PROGRAMS = [0, 25, 48, 33, 73, 89, 30, 18, 11, None, 42]
+
+NOTE_ON, NOTE_OFF, SMALL_SPACE, BIG_SPACE, END = range(5)
+
+
+# (kind, cluster, pitch) of every event id
+def event_table():
+    if len(Loader.base_index) == 0: Loader.compute_base_indices()
+
+    table = []
+    for kind, base_index in ((NOTE_ON, Loader.base_index_on), (NOTE_OFF, Loader.base_index_off)):
+        for cluster in range(Loader.num_clusters):
+            for offset in range(Loader.cluster_range[cluster]):
+                table.append((kind, cluster, CLUSTER_RANGES[cluster][0] + offset))
+    assert len(table) == Loader.base_index_space()
+
+    return table + [(SMALL_SPACE, None, None), (BIG_SPACE, None, None), (END, None, None)]
+
+
+EVENTS = event_table()
+
+
+# velocity of a volume from the Volume Predictor (a volume byte / 255), -1 (no volume) is the average volume
+def velocity(volume):
+    if volume < 0: return 64
+    volume = int(volume * 255.99999999) / 128.0 - 1
+    volume = volume * volume * (1 if volume > 0 else -1)
+    return min(max(int(64.0 + 64.0 * volume + 0.5), 0), 127)
+
+
+def variable_length(value):
+    output = [value & 0x7F]
+    value >>= 7
+    while value > 0:
+        output.append(0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(reversed(output))
+
+
+# format 0 MIDI with one track, written through a small buffer into a seekable file
+class MidiWriter:
+
+    def __init__(self, f):
+        self.f = f
+        self.f.write(b'MThd' + (6).to_bytes(4, 'big') + (0).to_bytes(2, 'big') + (1).to_bytes(2, 'big') + TICKS_PER_BEAT.to_bytes(2, 'big'))
+        self.f.write(b'MTrk')
+        self.length_position = self.f.tell()
+        self.f.write(bytes(4))
+
+        self.buffer = bytearray()
+        self.track_length = 0
+        self.last_ticks = 0
+
+    def event(self, ticks, data):
+        self.buffer += variable_length(ticks - self.last_ticks)
+        self.buffer += data
+        self.last_ticks = ticks
+        if len(self.buffer) >= BUFFER_SIZE: self.flush()
+
+    def flush(self):
+        self.f.write(self.buffer)
+        self.track_length += len(self.buffer)
+        self.buffer = bytearray()
+
+    # end of the track, and its length in the chunk header
+    def close(self, ticks):
+        self.event(max(ticks, self.last_ticks), b'\xFF\x2F\x00')
+        self.flush()
+        end = self.f.tell()
+        self.f.seek(self.length_position)
+        self.f.write(self.track_length.to_bytes(4, 'big'))
+        self.f.seek(end)
+
+
+class SongRenderer:
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.frame = 0
+        self.sounding = {}  # (channel, pitch) -> frame of the note-on
+        self.deadlines = []  # heap of (frame of the cut, channel, pitch, frame of the note-on)
+        self.notes = 0
+
+        # the tempo, and the instrument and the volume of every channel (the drums keep the default instrument)
+        self.writer.event(0, b'\xFF\x51\x03' + TEMPO.to_bytes(3, 'big'))
+        for channel, program in enumerate(CLUSTER_PROGRAMS):
+            if program is not None: self.writer.event(0, bytes((0xC0 | channel, program)))
+            self.writer.event(0, bytes((0xB0 | channel, 7, CHANNEL_VOLUME)))
+
+    def note_off(self, frame, channel, pitch):
+        self.writer.event(frame * TICKS_PER_FRAME, bytes((0x80 | channel, pitch, 64)))
+        del self.sounding[(channel, pitch)]
+
+    # move by some frames, the notes longer than their maximum length are cut on the way
+    def advance(self, frames):
+        self.frame += frames
+        while len(self.deadlines) > 0 and self.deadlines[0][0] <= self.frame:
+            deadline, channel, pitch, start = heapq.heappop(self.deadlines)
+            if self.sounding.get((channel, pitch)) == start: self.note_off(deadline, channel, pitch)
+
+    def note_on(self, channel, pitch, volume):
+        if (channel, pitch) in self.sounding: self.note_off(self.frame, channel, pitch)
+
+        self.writer.event(self.frame * TICKS_PER_FRAME, bytes((0x90 | channel, pitch, velocity(volume))))
+        self.sounding[(channel, pitch)] = self.frame
+        heapq.heappush(self.deadlines, (self.frame + (MAX_PERCUSSION_FRAMES if channel == PERCUSSION_CHANNEL else MAX_NOTE_FRAMES), channel, pitch, self.frame))
+        self.notes += 1
+
+    def add(self, event, volume=-1):
+        kind, cluster, pitch = EVENTS[event]
+
+        if kind == NOTE_ON: self.note_on(cluster, pitch, volume)
+        elif kind == NOTE_OFF:
+            if (cluster, pitch) in self.sounding: self.note_off(self.frame, cluster, pitch)
+        elif kind == SMALL_SPACE: self.advance(1)
+        elif kind == BIG_SPACE: self.advance(BIG_SPACE_FRAMES)
+
+    # the notes still sounding end at their maximum lengths, the deadlines of the ended notes don't prolong the song
+    def close(self):
+        while len(self.deadlines) > 0:
+            deadline, channel, pitch, start = self.deadlines[0]
+            if self.sounding.get((channel, pitch)) != start: heapq.heappop(self.deadlines)
+            else: self.advance(deadline - self.frame)
+        self.writer.close(self.frame * TICKS_PER_FRAME)
+
+
+# write the events (event ids of Loader, or (event id, volume) pairs) as a MIDI file, returns the number of notes;
+# a song ends at its end event, the songs of a corpus follow each other with a pause like in the Analyzer
+def render(events, filename):
+    with open(filename, 'wb') as f:
+        renderer = SongRenderer(MidiWriter(f))
+        ended = False
+
+        for event in events:
+            event, volume = event if isinstance(event, tuple) else (event, -1)
+            if ended: renderer.advance(END_PAUSE_FRAMES)
+
+            renderer.add(int(event), volume)
+            ended = EVENTS[int(event)][0] == END
+
+        renderer.close()
+    return renderer.notes
+
+
+# (event id, volume) of every event of a .mus file, read in chunks
+def mus_events(filename):
+    loader = Loader(filename)
+    for quadruple in loader.iterate_quadruples():
+        event, _ = loader.get_input(quadruple, 0)
+        yield event, loader.get_volume(quadruple)
+
+
+def export(filename, output):
+    return render(mus_events(filename), output)
+
+
+def export_in_worker(job):
+    filename, output = job
+    try:
+        return filename, output, export(filename, output), None
+    except Exception as e:
+        return filename, output, 0, '{}: {}'.format(type(e).__name__, e)
+
+
+# export every .mus file into a MIDI file with the same name in the output folder (next to it when the folder is
+# empty), in `workers` processes or in this one when workers is 0; yields (file, MIDI file, notes, error)
+def export_files(filenames, output_folder='', workers=0):
+    jobs = [(filename, os.path.join(output_folder or os.path.dirname(filename), os.path.splitext(os.path.basename(filename))[0] + '.mid')) for filename in filenames]
+    if workers == 0:
+        yield from map(export_in_worker, jobs)
+        return
+
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        yield from pool.imap_unordered(export_in_worker, jobs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generative Model -- .mus to MIDI Export')
+    parser.add_argument('files', type=str, nargs='+', help='.mus files or folders with them')
+    parser.add_argument('--output_folder', type=str, default='', help='folder for the MIDI files, they are written next to the .mus files by default')
+    parser.add_argument('--workers', type=int, default=0, help='number of worker processes, 0 exports in this process (default: 0)')
+    args = parser.parse_args()
+
+    filenames = find_files(args.files)
+    if args.output_folder != '': os.makedirs(args.output_folder, exist_ok=True)
+
+    start_time = time.time()
+    exported, notes, failed = 0, 0, 0
+
+    print('-' * 89)
+    for filename, output, n_notes, error in export_files(filenames, args.output_folder, args.workers):
+        if error is not None:
+            failed += 1
+            print('| {:60s} | failed: {}'.format(os.path.basename(filename)[-60:], error))
+            continue
+        exported += 1
+        notes += n_notes
+
+    elapsed = time.time() - start_time
+    print('| exported {} of {} songs ({} notes) in {:.2f}s, {} failed'.format(exported, len(filenames), notes, elapsed, failed))
+    print('-' * 89)
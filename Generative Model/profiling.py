@@ -0,0 +1,236 @@
+"""Low-overhead timing of the phases of the training and generating loops, with a Chrome trace export."""
+
+# The loops mark their phases by `with profiling.phase('forward'):` blocks and their iterations by
+# profiling.step('batch'). Profiling is off by default, then phase returns a shared no-op context manager, so the
+# instrumentation stays in the loops. When it's on, every phase costs two reads of the clock and one append into
+# a bounded buffer of events. Phases nest, the statistics hold their total time and their self time (without the
+# nested phases), so the self time of an iteration is the Python overhead that isn't covered by any phase. The
+# recurrent layers are timed by forward hooks, without touching the networks. export writes the aggregated
+# statistics as JSON and the events as a Chrome trace (open it in chrome://tracing or https://ui.perfetto.dev).
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+import weakref
+
+import torch.nn as nn
+
+
+class Profiler:
+
+    def __init__(self, max_events=1000000):
+        self.enabled = False
+        # (name, thread, start, end) in nanoseconds of time.perf_counter_ns, the oldest events are dropped first
+        self.events = collections.deque(maxlen=max_events)
+        # statistics of every thread, name -> [count, total, self, min, max] in nanoseconds, merged by statistics()
+        self.thread_stats = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start_time = time.perf_counter_ns()
+
+    # stack of the open phases of the current thread
+    def stack(self):
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            self.local.steps = {}
+            self.local.modules = {}
+            self.local.stats = {}
+            with self.lock:
+                self.thread_stats.append(self.local.stats)
+            return self.local.stack
+
+    # called by the thread of the phase, so no locking is needed
+    def record(self, name, start, end, children):
+        duration = end - start
+        self.events.append((name, threading.get_ident(), start, end))
+        stats = self.local.stats.get(name)
+        if stats is None:
+            self.local.stats[name] = [1, duration, duration - children, duration, duration]
+        else:
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] += duration - children
+            if duration < stats[3]: stats[3] = duration
+            if duration > stats[4]: stats[4] = duration
+
+
+PROFILER = Profiler()
+
+
+class Phase:
+
+    __slots__ = ('name', 'start', 'children')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        PROFILER.stack().append(self)
+        self.children = 0
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        stack = PROFILER.stack()
+        # the phases nested in this one that were never ended (an exception skipped their ends) are dropped
+        if self in stack:
+            while stack.pop() is not self: pass
+        if len(stack) > 0: stack[-1].children += end - self.start
+        PROFILER.record(self.name, self.start, end, self.children)
+        return False
+
+
+NO_PHASE = contextlib.nullcontext()
+
+
+# context manager timing a phase, it does nothing when profiling is off
+def phase(name):
+    return Phase(name) if PROFILER.enabled else NO_PHASE
+
+
+# end the previous iteration named `name` (of this thread) and start the next one, end_step only ends it
+def step(name, next=True):
+    if not PROFILER.enabled: return
+    PROFILER.stack()
+    steps = PROFILER.local.steps
+
+    current = steps.pop(name, None)
+    if current is not None: current.__exit__(None, None, None)
+    if next:
+        steps[name] = Phase(name)
+        steps[name].__enter__()
+
+
+def end_step(name):
+    step(name, next=False)
+
+
+# decorator timing every call of a function as a phase
+def timed(name):
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return function(*args, **kwargs)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return decorator
+
+
+# modules timed by time_module with the names of their phases; the hooks are global, because hooks registered on
+# the modules would be pickled together with the saved models
+TIMED_MODULES = weakref.WeakKeyDictionary()
+HOOKS = []
+
+
+# the phase of a module is kept by the module (per thread), so its end closes exactly that phase; a forward pass
+# that raised leaves its phase open, it is dropped by the end of the enclosing phase
+def start_module(module, input):
+    name = TIMED_MODULES.get(module)
+    if name is not None:
+        PROFILER.stack()
+        PROFILER.local.modules[module] = Phase(name).__enter__()
+
+
+def finish_module(module, input, output):
+    if module not in TIMED_MODULES: return
+    PROFILER.stack()
+    current = PROFILER.local.modules.pop(module, None)
+    if current is not None: current.__exit__(None, None, None)
+
+
+# time every forward pass of the module as a phase (the hooks are installed only when profiling is on)
+def time_module(module, name):
+    if not PROFILER.enabled: return
+
+    if len(HOOKS) == 0:
+        HOOKS.append(nn.modules.module.register_module_forward_pre_hook(start_module))
+        HOOKS.append(nn.modules.module.register_module_forward_hook(finish_module))
+    TIMED_MODULES[module] = name
+
+
+# time the recurrent layers of a predictor (LSTM or BN-LSTM, including their tabulated and quantized versions)
+def time_recurrence(model):
+    for attribute in ('lstm', 'forward_lstm'):
+        module = getattr(model, attribute, None)
+        if isinstance(module, nn.Module): time_module(module, 'recurrence')
+
+
+def enable(max_events=1000000):
+    global PROFILER
+    PROFILER = Profiler(max_events)
+    PROFILER.enabled = True
+
+
+def enabled():
+    return PROFILER.enabled
+
+
+# aggregated statistics of all phases in milliseconds
+def statistics():
+    stats = {}
+    with PROFILER.lock:
+        for thread_stats in PROFILER.thread_stats:
+            for name, (count, total, self_time, minimum, maximum) in list(thread_stats.items()):
+                merged = stats.setdefault(name, [0, 0, 0, minimum, maximum])
+                merged[0] += count
+                merged[1] += total
+                merged[2] += self_time
+                merged[3] = min(merged[3], minimum)
+                merged[4] = max(merged[4], maximum)
+    n_events = sum(values[0] for values in stats.values())
+
+    phases = {}
+    for name, (count, total, self_time, minimum, maximum) in sorted(stats.items(), key=lambda item: -item[1][1]):
+        phases[name] = {'count': count, 'total_ms': total / 1e6, 'self_ms': self_time / 1e6, 'mean_ms': total / count / 1e6,
+                        'min_ms': minimum / 1e6, 'max_ms': maximum / 1e6}
+
+    return {'wall_time_ms': (time.perf_counter_ns() - PROFILER.start_time) / 1e6, 'events': n_events,
+            'dropped_events': n_events - len(PROFILER.events), 'phases': phases}
+
+
+def report(stats=None):
+    stats = stats or statistics()
+    lines = ['-' * 89, '| {:20s} | {:>9s} | {:>12s} | {:>12s} | {:>10s} | {:>9s}'.format('phase', 'count', 'total ms', 'self ms', 'mean ms', 'max ms'), '-' * 89]
+    for name, phase_stats in stats['phases'].items():
+        lines.append('| {:20s} | {:9d} | {:12.2f} | {:12.2f} | {:10.4f} | {:9.3f}'.format(
+            name[:20], phase_stats['count'], phase_stats['total_ms'], phase_stats['self_ms'], phase_stats['mean_ms'], phase_stats['max_ms']))
+    lines.append('-' * 89)
+    lines.append('| wall time {:10.2f} ms | {} events, {} dropped from the trace'.format(stats['wall_time_ms'], stats['events'], stats['dropped_events']))
+    lines.append('-' * 89)
+    return '\n'.join(lines)
+
+
+# events in the Chrome trace event format (complete events, timestamps in microseconds)
+def trace():
+    pid = os.getpid()
+    threads = {}
+    events = []
+    for name, thread, start, end in list(PROFILER.events):
+        tid = threads.setdefault(thread, len(threads))
+        events.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                       'ts': (start - PROFILER.start_time) / 1e3, 'dur': (end - start) / 1e3})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+# write the trace into `path` and the statistics next to it (<path without extension>.stats.json)
+def export(path):
+    stats = statistics()
+    with open(path, 'w') as f:
+        json.dump(trace(), f)
+    with open(os.path.splitext(path)[0] + '.stats.json', 'w') as f:
+        json.dump(stats, f, indent=1)
+    return stats
+
+
+# print the report and export everything, called at the end of the scripts with the value of --trace
+def finish(path):
+    if not PROFILER.enabled or path == '': return
+    print(report(export(path)))
+    print('trace saved as ' + path)
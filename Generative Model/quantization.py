@@ -0,0 +1,140 @@
+"""Dynamic int8 quantization of the predictors for CPU inference."""
+
+# The weights of the recurrent layers and of the output layer are converted to int8, activations are quantized
+# on the fly at every step. nn.LSTM and nn.Linear are handled by torch directly; the BN-LSTM cells multiply their
+# raw weight matrices, so they are first rewritten into cells using nn.Linear layers.
+
+import argparse
+import copy
+import time
+
+import torch
+from torch import nn
+from torch.ao.quantization import quantize_dynamic
+
+import bnlstm as bn
+from utils import Loader, load_model
+
+
+# BN-LSTM cell computing its gates by (quantizable) linear layers, otherwise identical to bnlstm.BNLSTMCell
+class LinearBNLSTMCell(nn.Module):
+
+    def __init__(self, cell):
+        super(LinearBNLSTMCell, self).__init__()
+        self.input_size = cell.input_size
+        self.hidden_size = cell.hidden_size
+        self.max_length = cell.max_length
+
+        self.linear_ih = nn.Linear(cell.input_size, 4 * cell.hidden_size, bias=False)
+        self.linear_hh = nn.Linear(cell.hidden_size, 4 * cell.hidden_size, bias=False)
+        self.linear_ih.weight = nn.Parameter(cell.weight_ih.data.t().contiguous())
+        self.linear_hh.weight = nn.Parameter(cell.weight_hh.data.t().contiguous())
+
+        self.bias = cell.bias
+        self.bn_ih = cell.bn_ih
+        self.bn_hh = cell.bn_hh
+        self.bn_c = cell.bn_c
+
+    def forward(self, input_, hx, time):
+        h_0, c_0 = hx
+        return bn.BNLSTMCell.recurrence(self, self.linear_ih(input_), self.linear_hh(h_0), c_0, time)
+
+
+# convert the network (of any predictor, with either cell type) for quantized CPU inference, the conversion is done in place
+def quantize_model(model):
+    model = model.cpu()
+    model.eval()
+
+    for module in list(model.modules()):
+        if isinstance(module, bn.LSTM):
+            for layer in range(module.num_layers):
+                # cells with precomputed input tables (see lookup_tables.py) keep their own input path
+                if isinstance(module.get_cell(layer), bn.BNLSTMCell):
+                    setattr(module, 'cell_{}'.format(layer), LinearBNLSTMCell(module.get_cell(layer)))
+
+    return quantize_dynamic(model, {nn.Linear, nn.LSTM}, dtype=torch.qint8, inplace=True)
+
+
+# inputs of a predictor created from the primer: a list of tuples, each tuple is passed to the network
+def primer_inputs(model, primer, length):
+    loader = Loader(primer)
+
+    if hasattr(model, 'chord_encoder'):
+        inputs = [(torch.LongTensor([[event]]), torch.LongTensor([[chord]])) for event, chord in loader.iterate_events()]
+    elif hasattr(model, 'forward_encoder'):
+        inputs = [(torch.LongTensor([[event]]),) for event, _ in loader.iterate_volumes()]
+    else:
+        inputs = [(torch.LongTensor([[chord]]),) for chord in loader.iterate_chords()]
+
+    return inputs[:length]
+
+
+# feed the same inputs into the network step by step, collect the outputs and the time per step
+def run_steps(model, inputs, seed):
+    torch.manual_seed(seed)
+    model.init_hidden(1)
+
+    outputs = []
+    start_time = time.time()
+    with torch.no_grad():
+        for input in inputs:
+            outputs.append(model(*input)[0, 0])
+    elapsed = time.time() - start_time
+
+    return torch.stack(outputs), elapsed / len(inputs)
+
+
+# feed the same primer into a network and its transformed version, compare their outputs and speed
+def compare_models(reference_model, model, primer, length, temperature=1.0, names=('reference', 'transformed'), seed=42):
+    inputs = primer_inputs(reference_model, primer, length)
+
+    # warm up both networks, the first steps are always slower
+    run_steps(reference_model, inputs[:10], seed)
+    run_steps(model, inputs[:10], seed)
+
+    reference, reference_time = run_steps(reference_model, inputs, seed)
+    output, output_time = run_steps(model, inputs, seed)
+
+    report = {'steps': len(inputs), '{}_ms_per_step'.format(names[0]): 1000 * reference_time,
+              '{}_ms_per_step'.format(names[1]): 1000 * output_time, 'speedup': reference_time / output_time}
+
+    # the volume predictor is a regression, otherwise compare the sampling distributions
+    if reference.size(1) == 1:
+        difference = (reference - output).abs()
+        report.update({'mean_abs_error': difference.mean().item(), 'max_abs_error': difference.max().item()})
+    else:
+        log_p = torch.log_softmax(reference.double() / temperature, 1)
+        log_q = torch.log_softmax(output.double() / temperature, 1)
+        kl = (log_p.exp() * (log_p - log_q)).sum(1)
+        report.update({'mean_kl': kl.mean().item(), 'max_kl': kl.max().item(),
+                       'top1_agreement': (reference.argmax(1) == output.argmax(1)).double().mean().item()})
+
+    return report
+
+
+# compare the quantized and the original network on the same primer
+def compare(model, primer, length, temperature):
+    return compare_models(model, quantize_model(copy.deepcopy(model)), primer, length, temperature, ('fp32', 'int8'))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generative Model -- Quantization Report')
+    parser.add_argument('models', type=str, nargs='+', help='paths to trained models of any predictor')
+    parser.add_argument('--primer', type=str, default='Primers/piano.mus', help='path to the song fed into both networks')
+    parser.add_argument('--length', type=int, default=2000, help='maximal number of primer steps compared (default: 2000)')
+    parser.add_argument('--temperature', type=float, default=1.0, help='temperature of the compared distributions (default: 1.0)')
+    parser.add_argument('--threads', type=int, default=0, help='number of torch threads, 0 keeps the default (default: 0)')
+    args = parser.parse_args()
+
+    if args.threads > 0: torch.set_num_threads(args.threads)
+
+    for filename in args.models:
+        model = load_model(filename)
+        model.eval()
+        report = compare(model, args.primer, args.length, args.temperature)
+
+        print('-' * 89)
+        print('| {} ({} cell)'.format(filename, model.cell))
+        for key, value in report.items():
+            print('| {:24s} {:12.6f}'.format(key, value))
+    print('-' * 89)
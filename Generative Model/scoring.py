@@ -0,0 +1,209 @@
+"""Per-song and per-event scores of .mus files under a trained predictor, batched and spread over worker processes."""
+
+# Any checkpoint can be scored (Note, Chord or Volume Predictor, the joint model). Every file is one song: the
+# network reads it the same way as evaluate() of its training script reads the validation set, in chunks of
+# seq_len steps with the hidden states carried between them, and every step is scored by the next input. The
+# Note and Chord Predictors are scored by the negative log-likelihood (in nats) of the next event or chord, the
+# Volume Predictor by the squared error of the next volume (only events with a volume count, like in
+# volume_train.py), the joint model by both. Songs of similar lengths (the file size is the number of events)
+# are batched together, the shorter ones are padded at the end and their padding is masked out. The recurrent
+# layers are causal and batch norm uses its running statistics, so a song gets the same score in any batch; the
+# hidden states start at zeros (not the random ones of the training), so the scores are deterministic. Batches are
+# spread over forked worker processes, each with its own copy of the network.
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+
+import torch
+import torch.nn.functional as F
+
+from utils import Loader, find_files, load_model
+
+
+# 'note', 'joint', 'chord' or 'volume'
+def predictor_type(model):
+    if hasattr(model, 'chord_encoder'): return 'joint' if hasattr(model, 'volume_decoder') else 'note'
+    if hasattr(model, 'forward_encoder'): return 'volume'
+    return 'chord'
+
+
+# input streams and targets of a song, the targets are the inputs shifted by one step
+def song_tensors(typ, filename):
+    loader = Loader(filename)
+    if typ == 'note':
+        events, chords = loader.create_event_tensor()
+        return (events[:-1].long(), chords[:-1].long()), {'event': events[1:].long()}
+    if typ == 'joint':
+        events, chords, volumes = loader.create_joint_tensor()
+        return (events[:-1].long(), chords[:-1].long()), {'event': events[1:].long(), 'volume': volumes[1:]}
+    if typ == 'volume':
+        events, volumes = loader.create_volume_tensor()
+        return (events[:-1].long(),), {'volume': volumes[1:]}
+
+    chords = loader.create_chord_tensor()
+    return (chords[:-1].long(),), {'chord': chords[1:].long()}
+
+
+# (length, batch) tensors of songs padded by zeros, the mask marks the real steps
+def pad(sequences):
+    length = max(len(sequence) for sequence in sequences)
+    padded = sequences[0].new_zeros(length, len(sequences))
+    mask = torch.zeros(length, len(sequences), dtype=torch.bool)
+    for column, sequence in enumerate(sequences):
+        padded[:len(sequence), column] = sequence
+        mask[:len(sequence), column] = True
+    return padded, mask
+
+
+class Scorer:
+
+    def __init__(self, model, seq_len=0, cuda=False, per_event=False):
+        self.model = model.cuda() if cuda else model.cpu()
+        self.model.eval()
+        self.typ = predictor_type(model)
+        self.seq_len = seq_len or getattr(model, 'seq_len', 100)
+        self.cuda = cuda
+        self.per_event = per_event
+
+    # outputs of the network for one chunk, as a dict with the same keys as the targets
+    def forward(self, inputs):
+        if self.typ == 'joint':
+            events, volumes = self.model.forward_with_volume(*inputs)
+            return {'event': events, 'volume': volumes}
+        output = self.model(*inputs)
+        if self.typ == 'volume': return {'volume': output.squeeze(2)}
+        return {self.typ if self.typ == 'chord' else 'event': output}
+
+    # loss of every step of the chunk, (length, batch) tensors
+    def step_losses(self, outputs, targets):
+        losses = {}
+        for key, output in outputs.items():
+            if key == 'volume':
+                losses[key] = (output.float() - targets[key]) ** 2
+            else:
+                losses[key] = F.cross_entropy(output.float().view(-1, output.size(2)), targets[key].view(-1), reduction='none').view(targets[key].size())
+        return losses
+
+    # scores of the songs (read from the files) computed as one batch
+    def score_batch(self, filenames):
+        songs = [song_tensors(self.typ, filename) for filename in filenames]
+        inputs = [pad([song[0][i] for song in songs])[0] for i in range(len(songs[0][0]))]
+        targets = {key: pad([song[1][key] for song in songs]) for key in songs[0][1]}
+        if self.cuda:
+            inputs = [input.cuda() for input in inputs]
+
+        # masks of the steps that count: the real steps, only the ones with a volume for the volume loss
+        masks = {key: mask & (target != -1) if key == 'volume' else mask for key, (target, mask) in targets.items()}
+        targets = {key: target.cuda() if self.cuda else target for key, (target, _) in targets.items()}
+
+        # the hidden states start at zeros, so the scores don't depend on the random generator
+        self.model.init_hidden(len(filenames))
+        self.model.hidden = tuple(hidden.zero_() for hidden in self.model.hidden)
+
+        losses = {key: [] for key in targets}
+        with torch.no_grad():
+            for i in range(0, inputs[0].size(0), self.seq_len):
+                chunk_losses = self.step_losses(self.forward([input[i:i + self.seq_len] for input in inputs]), {key: target[i:i + self.seq_len] for key, target in targets.items()})
+                for key, loss in chunk_losses.items():
+                    losses[key].append(loss.cpu())
+        losses = {key: torch.cat(loss) for key, loss in losses.items()}
+
+        return [self.song_result(filename, column, losses, masks) for column, filename in enumerate(filenames)]
+
+    def song_result(self, filename, column, losses, masks):
+        result = {'file': filename}
+        for key, loss in losses.items():
+            values = loss[:, column][masks[key][:, column]].double()
+            name = 'nll' if key != 'volume' else 'volume_se'
+            result[key + '_steps'] = len(values)
+            result[name] = values.sum().item()
+            result['mean_' + name] = values.mean().item() if len(values) > 0 else float('nan')
+            if self.per_event: result[key + '_' + name + '_per_step'] = values.tolist()
+        return result
+
+
+# songs grouped into batches of similar lengths (the number of events is a quarter of the file size)
+def length_batches(filenames, batch_size):
+    ordered = sorted(filenames, key=os.path.getsize)
+    return [ordered[i:i + batch_size] for i in range(0, len(ordered), batch_size)]
+
+
+# every worker loads its own copy of the network
+worker_scorer = None
+
+
+def init_worker(model_filename, seq_len, per_event, threads):
+    global worker_scorer
+    if threads > 0: torch.set_num_threads(threads)
+    worker_scorer = Scorer(load_model(model_filename), seq_len, per_event=per_event)
+
+
+def score_in_worker(filenames):
+    return worker_scorer.score_batch(filenames)
+
+
+# scores of all files (in their order), computed in `workers` processes or in this one when workers is 0
+def score_files(model_filename, filenames, batch_size=32, workers=0, seq_len=0, per_event=False, cuda=False, threads=0):
+    batches = length_batches(filenames, batch_size)
+
+    if workers == 0:
+        if threads > 0: torch.set_num_threads(threads)
+        scorer = Scorer(load_model(model_filename, cuda), seq_len, cuda, per_event)
+        results = [result for batch in batches for result in scorer.score_batch(batch)]
+    else:
+        if cuda: raise ValueError('the worker processes score only on CPU, please use --workers 0 together with --cuda')
+        # the cores are split between the workers unless the threads are given
+        threads = threads or max(1, torch.get_num_threads() // workers)
+        with multiprocessing.get_context('fork').Pool(workers, init_worker, (model_filename, seq_len, per_event, threads)) as pool:
+            results = [result for batch_results in pool.imap_unordered(score_in_worker, batches) for result in batch_results]
+
+    by_file = {result['file']: result for result in results}
+    return [by_file[filename] for filename in filenames]
+
+
+# number of scored steps of a song, the events (or chords) for the Note and Chord Predictors
+def scored_steps(result):
+    return next(result[key] for key in ('event_steps', 'chord_steps', 'volume_steps') if key in result)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generative Model -- Scoring')
+    parser.add_argument('model', type=str, help='path to a trained model of any predictor (or a checkpoint converted by checkpoint.py)')
+    parser.add_argument('files', type=str, nargs='+', help='.mus files or folders with them, every file is scored as one song')
+    parser.add_argument('--batch_size', type=int, default=32, help='number of songs scored together (default: 32)')
+    parser.add_argument('--workers', type=int, default=0, help='number of worker processes, 0 scores in this process (default: 0)')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads of every worker, 0 splits the cores between the workers (default: 0)')
+    parser.add_argument('--seq_len', type=int, default=0, help='length of the chunks fed into the network, 0 uses the seq_len the network was trained with (default: 0)')
+    parser.add_argument('--cuda', type=bool, default=False, help='use CUDA, only without workers (default: False)')
+    parser.add_argument('--per_event', type=bool, default=False, help='also output the loss of every step of every song (default: False)')
+    parser.add_argument('--output', type=str, default='', help='write the results as JSON lines into this file, ranked from the most likely song')
+    parser.add_argument('--top', type=int, default=20, help='number of the best songs printed (default: 20)')
+    args = parser.parse_args()
+
+    filenames = find_files(args.files)
+    start_time = time.time()
+    results = score_files(args.model, filenames, args.batch_size, args.workers, args.seq_len, args.per_event, args.cuda, args.threads)
+    elapsed = time.time() - start_time
+
+    # ranked by the mean loss of the events (or chords), the volume loss only for the Volume Predictor
+    key = next(name for name in ('mean_nll', 'mean_volume_se') if name in results[0])
+    results.sort(key=lambda result: result[key])
+
+    if args.output != '':
+        with open(args.output, 'w') as f:
+            for result in results:
+                print(json.dumps(result), file=f)
+
+    print('-' * 89)
+    print('| {:60s} | {:>9s} | {:>12s}'.format('file', 'steps', key))
+    print('-' * 89)
+    for result in results[:args.top]:
+        print('| {:60s} | {:9d} | {:12.5f}'.format(os.path.basename(result['file'])[-60:], scored_steps(result), result[key]))
+    print('-' * 89)
+    n_steps = sum(scored_steps(result) for result in results)
+    print('| scored {} songs ({} steps) in {:.2f}s, {:.0f} steps/s'.format(len(results), n_steps, elapsed, n_steps / elapsed))
+    if args.output != '': print('| results saved as ' + args.output)
+    print('-' * 89)
@@ -0,0 +1,180 @@
+"""Hyperparameter sweeps of the Chord and Volume Predictors, concurrent trainings sharing one decoded corpus."""
+
+# The small predictors use only a few cores each, so the sweep trains many of them at once. The runner decodes
+# the training and validation files once (the decoding in Loader is the slow part of starting a training), moves
+# the tensors into shared memory and registers them in Loader.shared_tensors. Every trial is a forked process that
+# runs the unchanged chord_train.py or volume_train.py (by runpy, with its own command line), so its Loader returns
+# the shared tensors instead of decoding the files again. A trial gets a fixed number of torch threads and, with
+# --pin_cores, its own set of cores; it runs in its own folder (sweep folder/trial_<n>), where the script writes
+# its logs, models and checkpoints, and its output goes into output.log there. The grid is the product of the
+# comma-separated values of --lr, --nhid, --emsize, --seq_len, --cell and --seed. When the trials finish, their
+# validation curves (the test logs) are collected into one table, saved as JSON lines and printed from the best.
+
+import argparse
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import runpy
+import sys
+import time
+
+import torch
+
+from utils import Loader
+
+
+SCRIPTS = {'chord': 'Chord_Predictor/chord_train.py', 'volume': 'Volume_Predictor/volume_train.py'}
+
+# swept arguments of the training scripts and their types
+GRID = [('lr', float), ('nhid', int), ('emsize', int), ('seq_len', int), ('cell', str), ('seed', int)]
+
+
+def parse_values(values, typ):
+    return [typ(value) for value in values.split(',')]
+
+
+# every combination of the values, as dicts of the swept arguments
+def grid(values):
+    names = [name for name, _ in GRID if values.get(name)]
+    return [dict(zip(names, combination)) for combination in itertools.product(*[values[name] for name in names])]
+
+
+# decode the files once into shared memory, the paths are the ones the training scripts give to Loader
+def share_corpus(predictor, data_folder, filenames):
+    for filename in filenames:
+        path = '../data/' + filename
+        loader = Loader(os.path.join(data_folder, filename))
+        tensors = loader.create_chord_tensor() if predictor == 'chord' else loader.create_volume_tensor()
+        tensors = tuple(tensor.share_memory_() for tensor in tensors) if isinstance(tensors, tuple) else tensors.share_memory_()
+        Loader.shared_tensors[path] = {predictor: tensors}
+
+
+# the command line of a trial
+def trial_arguments(trial, train_file, val_file, extra):
+    arguments = ['--train_file', train_file, '--val_file', val_file, '--cuda', '']
+    for name, value in trial.items():
+        arguments += ['--' + name, str(value)]
+    return arguments + extra
+
+
+# body of a trial process: a training script run in the trial folder
+def run_trial(script, arguments, folder, threads, cores):
+    if cores is not None: os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+
+    os.chdir(folder)
+    output = os.open('output.log', os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    os.dup2(output, 1)
+    os.dup2(output, 2)
+
+    sys.argv = [script] + arguments
+    runpy.run_path(script, run_name='__main__')
+    sys.stdout.flush()
+
+
+# losses of the log files of a script, the train and test logs have one loss per line (volume_train.py names them
+# like chord_train.py does)
+def read_curve(folder, log):
+    names = sorted(name for name in os.listdir(folder) if log in name)
+    if len(names) == 0: return []
+    with open(os.path.join(folder, names[-1])) as f:
+        return [float(line) for line in f if line.strip() != '']
+
+
+def trial_result(index, trial, folder, exitcode, elapsed):
+    validation = read_curve(folder, 'test_log_')
+    result = {'trial': index, 'folder': folder, 'status': 'ok' if exitcode == 0 else 'failed ({})'.format(exitcode), 'time': elapsed}
+    result.update(trial)
+    result['best_val_loss'] = min(validation) if len(validation) > 0 else float('nan')
+    result['final_val_loss'] = validation[-1] if len(validation) > 0 else float('nan')
+    result['val_curve'] = validation
+    result['train_curve'] = read_curve(folder, 'train_log_')
+    return result
+
+
+# run the trials, at most `parallel` at once, returns their results in the order of the trials
+def run_sweep(predictor, trials, train_file, val_file, folder, parallel, threads, pin_cores=False, extra=()):
+    script = os.path.abspath(SCRIPTS[predictor])
+    context = multiprocessing.get_context('fork')
+    cores = sorted(os.sched_getaffinity(0))
+
+    pending = list(enumerate(trials))
+    running = {}  # slot -> (index, trial, process, folder, start time)
+    results = []
+
+    while len(pending) > 0 or len(running) > 0:
+        # start trials in the free slots
+        for slot in range(parallel):
+            if slot in running or len(pending) == 0: continue
+            index, trial = pending.pop(0)
+            trial_folder = os.path.abspath(os.path.join(folder, 'trial_{:03d}'.format(index)))
+            os.makedirs(trial_folder, exist_ok=True)
+            trial_cores = set(cores[(slot * threads) % len(cores):(slot * threads) % len(cores) + threads]) if pin_cores else None
+
+            process = context.Process(target=run_trial, args=(script, trial_arguments(trial, train_file, val_file, list(extra)), trial_folder, threads, trial_cores))
+            process.start()
+            running[slot] = (index, trial, process, trial_folder, time.time())
+            print('| started trial {:3d} {}'.format(index, trial), flush=True)
+
+        time.sleep(0.2)
+
+        for slot, (index, trial, process, trial_folder, start_time) in list(running.items()):
+            if process.is_alive(): continue
+            process.join()
+            del running[slot]
+            result = trial_result(index, trial, trial_folder, process.exitcode, time.time() - start_time)
+            results.append(result)
+            print('| finished trial {:3d} | {} | best valid loss {:8.5f} | {:6.1f}s'.format(index, result['status'], result['best_val_loss'], result['time']), flush=True)
+
+    return sorted(results, key=lambda result: result['trial'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generative Model -- Hyperparameter Sweep')
+    parser.add_argument('predictor', type=str, choices=sorted(SCRIPTS), help='predictor to train, "chord" or "volume"')
+    parser.add_argument('--train_file', type=str, default='', help='name of the file with training data in data folder')
+    parser.add_argument('--val_file', type=str, default='', help='name of the file with validation data in data folder')
+    parser.add_argument('--data', type=str, default='data', help='the data folder of the training scripts (default: data)')
+    parser.add_argument('--lr', type=str, default='', help='comma-separated learning rates')
+    parser.add_argument('--nhid', type=str, default='', help='comma-separated numbers of hidden units per layer')
+    parser.add_argument('--emsize', type=str, default='', help='comma-separated sizes of the embeddings')
+    parser.add_argument('--seq_len', type=str, default='', help='comma-separated sequence lengths')
+    parser.add_argument('--cell', type=str, default='', help='comma-separated cell types ("bnlstm", "lstm")')
+    parser.add_argument('--seed', type=str, default='', help='comma-separated random seeds')
+    parser.add_argument('--parallel', type=int, default=4, help='number of trials trained at once (default: 4)')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads of every trial, 0 splits the cores between the parallel trials (default: 0)')
+    parser.add_argument('--pin_cores', type=bool, default=False, help='pin every trial to its own cores (default: False)')
+    parser.add_argument('--folder', type=str, default='', help='folder of the trials (default: sweep_<predictor>_<date>)')
+    parser.add_argument('--output', type=str, default='', help='write the results as JSON lines into this file (default: results.jsonl in the folder)')
+    args, extra = parser.parse_known_args()
+
+    # the other arguments are given to every trial, e.g. --epochs 5 --batch_size 64
+    values = {name: parse_values(getattr(args, name), typ) for name, typ in GRID if getattr(args, name) != ''}
+    trials = grid(values)
+    folder = args.folder or 'sweep_{}_{}'.format(args.predictor, datetime.datetime.now().strftime("%Y-%m-%d_%H.%M.%S"))
+    os.makedirs(folder, exist_ok=True)
+    threads = args.threads or max(1, len(os.sched_getaffinity(0)) // args.parallel)
+
+    start_time = time.time()
+    share_corpus(args.predictor, args.data, sorted(set([args.train_file, args.val_file])))
+    print('| decoded the corpus in {:.2f}s, {} trials, {} at once with {} threads each'.format(time.time() - start_time, len(trials), args.parallel, threads))
+
+    results = run_sweep(args.predictor, trials, args.train_file, args.val_file, folder, args.parallel, threads, args.pin_cores, extra)
+
+    output = args.output or os.path.join(folder, 'results.jsonl')
+    with open(output, 'w') as f:
+        for result in results:
+            print(json.dumps(result), file=f)
+
+    names = [name for name, _ in GRID if name in values]
+    print('-' * 89)
+    print('| {:5s} | {} | {:>10s} | {:>10s} | {:>6s} | status'.format('trial', ' | '.join('{:>8s}'.format(name) for name in names), 'best val', 'final val', 'vals'))
+    print('-' * 89)
+    for result in sorted(results, key=lambda result: (result['best_val_loss'] != result['best_val_loss'], result['best_val_loss'])):
+        print('| {:5d} | {} | {:10.5f} | {:10.5f} | {:6d} | {}'.format(result['trial'], ' | '.join('{:>8s}'.format(str(result[name])) for name in names),
+                                                               result['best_val_loss'], result['final_val_loss'], len(result['val_curve']), result['status']))
+    print('-' * 89)
+    print('| {} trials in {:.2f}s, results saved as {}'.format(len(results), time.time() - start_time, output))
+    print('-' * 89)
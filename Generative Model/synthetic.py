@@ -0,0 +1,97 @@
+"""Synthetic .mus songs and corpora of any size, for benchmarks and tests of the data pipeline."""
+
+# The songs are random, but valid for the Loader: they use only its event types and the pitch ranges of its
+# instrument clusters. Every song has a few instruments (sometimes drums), a chord per bar (written into the
+# time shifts, 12 ticks per beat), note-ons with volumes and a note-off for every note-on, and it ends like the
+# songs of the Analyzer: a few beats with the "stop" chord 24 and the end event. A corpus is a concatenation of
+# songs, written in chunks, so its size isn't limited by memory.
+
+import argparse
+import random
+
+from utils import Loader
+
+
+TICKS_PER_BEAT = 12
+BEATS_PER_BAR = 4
+STOP_CHORD = 24
+DRUMS = 9
+
+
+# Loader event ids of a song with about n_events events, as (event, chord, volume) triples
+def synthesize_song(n_events, rng):
+    if len(Loader.base_index) == 0: Loader.compute_base_indices()
+
+    instruments = rng.sample([cluster for cluster in range(Loader.num_clusters) if cluster != DRUMS], rng.randint(1, 3))
+    if rng.random() < 0.5: instruments.append(DRUMS)
+
+    events = []
+    held = []
+    tick = 0
+    chord = rng.randrange(STOP_CHORD)
+
+    while len(events) < n_events:
+        # a new chord at every bar
+        if tick % (TICKS_PER_BEAT * BEATS_PER_BAR) == 0 and rng.random() < 0.7:
+            chord = rng.randrange(STOP_CHORD)
+
+        # release some of the held notes and start new ones
+        if tick % 3 == 0:
+            for note in [note for note in held if rng.random() < 0.4]:
+                held.remove(note)
+                events.append((Loader.base_index_off(note[0]) + note[1], chord, 0.5))
+
+            for _ in range(rng.choice([0, 0, 1, 1, 2, 3])):
+                cluster = rng.choice(instruments)
+                pitch = rng.randrange(Loader.cluster_range[cluster])
+                if (cluster, pitch) in held: continue
+                held.append((cluster, pitch))
+                events.append((Loader.base_index_on(cluster) + pitch, chord, rng.randint(40, 220) / 255.0))
+
+        # time shift by one tick or half a beat
+        if tick % 6 == 0 and rng.random() < 0.3:
+            events.append((Loader.base_index_space() + 1, chord, 0.5))
+            tick += 6
+        else:
+            events.append((Loader.base_index_space(), chord, 0.5))
+            tick += 1
+
+    # end with the stop chord, release everything and mark the end of the song
+    for _ in range(TICKS_PER_BEAT):
+        events.append((Loader.base_index_space(), STOP_CHORD, 0.5))
+    for cluster, pitch in held:
+        events.append((Loader.base_index_off(cluster) + pitch, STOP_CHORD, 0.5))
+    events.append((Loader.base_index_space() + 2, 0, 0.5))
+
+    return events
+
+
+def song_to_bytes(events):
+    return b''.join(bytes(Loader.output_to_bytes(event, chord, volume)) for event, chord, volume in events)
+
+
+# write a corpus of at least n_events events, songs have song_length events on average; returns the number of events
+def synthesize_corpus(filename, n_events, song_length=5000, seed=42):
+    rng = random.Random(seed)
+    written = 0
+
+    with open(filename, 'wb') as f:
+        while written < n_events:
+            length = max(1, min(n_events - written, int(rng.uniform(0.5, 1.5) * song_length)))
+            events = synthesize_song(length, rng)
+            f.write(song_to_bytes(events))
+            written += len(events)
+
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generative Model -- Synthetic Corpus')
+    parser.add_argument('output', type=str, help='path of the generated .mus file')
+    parser.add_argument('--events', type=int, default=100000, help='number of events of the whole corpus (default: 100000)')
+    parser.add_argument('--song_length', type=int, default=5000, help='average number of events of a song (default: 5000)')
+    parser.add_argument('--seed', type=int, default=42, help='random seed (default: 42)')
+    args = parser.parse_args()
+
+    n_events = synthesize_corpus(args.output, args.events, args.song_length, args.seed)
+    print('saved {} events as {}'.format(n_events, args.output))
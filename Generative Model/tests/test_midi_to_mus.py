@@ -0,0 +1,103 @@
+import os
+import sys
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from midi_to_mus import analyze, music_events, parse_midi
+from mus_to_midi import mus_events, render
+from utils import Loader
+
+
+PRIMER = os.path.join(ROOT, 'Primers', 'piano.mus')
+TICKS = 480  # MIDI ticks per beat of the test songs
+
+if len(Loader.base_index) == 0: Loader.compute_base_indices()
+
+
+def variable_length(value):
+    output = [value & 0x7F]
+    value >>= 7
+    while value > 0:
+        output.append(0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(reversed(output))
+
+
+# format 0 MIDI at 120 BPM in 4/4 and C major with the given (ticks, event bytes)
+def midi_file(events):
+    events = [(0, b'\xFF\x51\x03' + (500000).to_bytes(3, 'big')), (0, b'\xFF\x58\x04\x04\x02\x18\x08'), (0, b'\xFF\x59\x02\x00\x00')] + events
+
+    track = bytearray()
+    last_ticks = 0
+    for ticks, data in sorted(events, key=lambda event: event[0]):
+        track += variable_length(ticks - last_ticks) + data
+        last_ticks = ticks
+    track += b'\x00\xFF\x2F\x00'
+
+    header = b'MThd' + (6).to_bytes(4, 'big') + (0).to_bytes(2, 'big') + (1).to_bytes(2, 'big') + TICKS.to_bytes(2, 'big')
+    return header + b'MTrk' + len(track).to_bytes(4, 'big') + bytes(track)
+
+
+def note(channel, pitch, start, end, velocity=100):
+    return [(start, bytes((0x90 | channel, pitch, velocity))), (end, bytes((0x80 | channel, pitch, 64)))]
+
+
+def convert(events):
+    with np.errstate(all='ignore'):
+        output = music_events(analyze(parse_midi(midi_file(events))))
+    return [tuple(output[i:i + 4]) for i in range(0, len(output), 4)]
+
+
+def test_notes_and_time_shifts():
+    events = [(0, bytes((0xC1, 33)))]
+    events += note(0, 60, 0, TICKS) + note(0, 64, 0, TICKS) + note(0, 67, 0, TICKS)
+    events += note(9, 36, TICKS, TICKS + TICKS // 2)
+    events += note(1, 57, 2 * TICKS, 4 * TICKS)
+    events += note(0, 69, 2 * TICKS + TICKS // 12, 3 * TICKS) + note(0, 72, 2 * TICKS + TICKS // 12, 3 * TICKS) + note(0, 76, 2 * TICKS + TICKS // 12, 3 * TICKS)
+    events += note(0, 96, 4 * TICKS, 5 * TICKS)
+
+    # the beats of 500 ms are normalized to 600 ms, so a beat is 12 ticks (two half-beat shifts) and 1/12 of a
+    # beat is one tick; the pitches are folded into the ranges of the clusters: the finger bass (cluster 3,
+    # 24-50) plays A3 as A2 and the piano (cluster 0, 36-84) plays C7 as C6; all notes have the average volume
+    big, small = (5, 1, 0, 21), (4, 1, 0, 21)
+    assert convert(events) == [
+        (0, 24, 128, 0), (0, 28, 128, 0), (0, 31, 128, 0), big, big,
+        (1, 24, 0, 0), (1, 28, 0, 0), (1, 31, 0, 0), (2, 36 - 35, 128, 0), big,
+        (3, 36 - 35, 0, 0), big,
+        (3 << 4, 45 - 24, 128, 33), small,
+        (0, 69 - 36, 128, 0), (0, 72 - 36, 128, 0), (0, 76 - 36, 128, 0), small, small, small, small, small, big,
+        (1, 69 - 36, 0, 0), (1, 72 - 36, 0, 0), (1, 76 - 36, 0, 0), big, big,
+        (1, 45 - 24, 3, 0), (0, 84 - 36, 128, 0), big,
+        (5, 1, 0, 24), (1, 84 - 36, 0, 0), (6, 0, 0, 0)]
+
+
+def test_time_shifts_have_chord_of_next_beat():
+    events = []
+    for bar, chord in enumerate([(48, 60, 64, 67), (43, 55, 59, 62), (48, 60, 64, 67)]):
+        for beat in range(4):
+            for pitch in chord:
+                events += note(0, pitch, (4 * bar + beat) * TICKS, (4 * bar + beat + 1) * TICKS)
+    shifts = [record for record in convert(events) if record[0] in (4, 5)]
+
+    # C major, G major and C major bars: a half-beat shift starting at tick 6 * i has the chord of the beat
+    # (6 * i + 12) // 12, the shifts past the last beat have the stop chord
+    assert [chord for _, _, _, chord in shifts] == [0] * 6 + [7] * 8 + [0] * 9 + [24]
+    assert all(record[:3] == (5, 1, 0) for record in shifts)
+
+
+def test_round_trip_through_midi(tmp_path):
+    filename = str(tmp_path / 'piano.mid')
+    render(mus_events(PRIMER), filename)
+    with open(filename, 'rb') as f:
+        data = f.read()
+    with np.errstate(all='ignore'):
+        output = music_events(analyze(parse_midi(data)))
+
+    # the same note-ons, note-offs and time shifts (the chords are analyzed again)
+    loader = Loader(PRIMER)
+    events = [Loader.get_input(quadruple, 0)[0] for quadruple in loader.iterate_quadruples()]
+    converted = [Loader.get_input(output[i:i + 4], 0)[0] for i in range(0, len(output), 4)]
+    assert converted == events
@@ -0,0 +1,105 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from mus_to_midi import CLUSTER_PROGRAMS, render, velocity
+from utils import Loader
+
+
+if len(Loader.base_index) == 0: Loader.compute_base_indices()
+
+PIANO, BASS, DRUMS = 0, 3, 9
+SMALL_SPACE, BIG_SPACE, END = Loader.base_index_space(), Loader.base_index_space() + 1, Loader.base_index_space() + 2
+
+
+def note_on(cluster, offset):
+    return Loader.base_index_on(cluster) + offset
+
+
+def note_off(cluster, offset):
+    return Loader.base_index_off(cluster) + offset
+
+
+# (delta time, event bytes) of the only track of the rendered MIDI, the renderer doesn't use running status
+def render_track(events, tmp_path):
+    filename = str(tmp_path / 'song.mid')
+    render(events, filename)
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    assert data[:14] == b'MThd' + (6).to_bytes(4, 'big') + (0).to_bytes(2, 'big') + (1).to_bytes(2, 'big') + (480).to_bytes(2, 'big')
+    assert data[14:18] == b'MTrk' and int.from_bytes(data[18:22], 'big') == len(data) - 22
+
+    track = []
+    position = 22
+    while position < len(data):
+        delta = 0
+        while True:
+            delta = (delta << 7) | (data[position] & 0x7F)
+            position += 1
+            if data[position - 1] & 0x80 == 0: break
+
+        if data[position] == 0xFF: length = 3 + data[position + 2]
+        elif data[position] >> 4 == 0xC: length = 2
+        else: length = 3
+        track.append((delta, data[position:position + length]))
+        position += length
+    return track
+
+
+# the events after the tempo, the instruments and the channel volumes at the start
+def song_events(track):
+    return track[1 + sum(program is not None for program in CLUSTER_PROGRAMS) + len(CLUSTER_PROGRAMS):]
+
+
+def test_channels_and_programs(tmp_path):
+    track = render_track([note_on(DRUMS, 36 - 35), note_on(BASS, 40 - 24), SMALL_SPACE, END], tmp_path)
+
+    # 600 ms beats, the typical instrument and the volume 64 of every cluster on its channel, no instrument
+    # change on the drum channel (channel 10)
+    assert track[0] == (0, b'\xFF\x51\x03' + (600000).to_bytes(3, 'big'))
+    setup = [data for _, data in track[1:len(track) - len(song_events(track))]]
+    assert setup == [data for channel, program in enumerate(CLUSTER_PROGRAMS)
+                     for data in ([bytes((0xC0 | channel, program))] if program is not None else []) + [bytes((0xB0 | channel, 7, 64))]]
+    assert CLUSTER_PROGRAMS[DRUMS] is None and CLUSTER_PROGRAMS[BASS] == 33
+
+    # pitches of the clusters start at the bottoms of their ranges, the drums play on channel 10; the notes
+    # still sounding at the end are cut at their maximum lengths
+    assert song_events(track) == [
+        (0, bytes((0x99, 36, 64))), (0, bytes((0x93, 40, 64))),
+        (96 * 40, bytes((0x89, 36, 64))), (4 * 40, bytes((0x83, 40, 64))), (0, b'\xFF\x2F\x00')]
+
+
+def test_velocity():
+    # no volume is the average velocity, the volume byte is the square root of the difference from the average
+    assert velocity(-1) == 64
+    assert velocity(128 / 255.0) == 64
+    assert velocity(192 / 255.0) == 64 + 16
+    assert velocity(64 / 255.0) == 64 - 16
+    assert velocity(0.0) == 0
+    assert velocity(1.0) == 127
+
+
+def test_delta_times_and_note_rules(tmp_path):
+    c4, e4 = 60 - 36, 64 - 36
+    events = [(note_on(PIANO, c4), 192 / 255.0), SMALL_SPACE, note_off(PIANO, e4), note_off(PIANO, c4), BIG_SPACE,
+              (note_on(PIANO, e4), -1), SMALL_SPACE, (note_on(PIANO, e4), 64 / 255.0)] + [BIG_SPACE] * 20 + [note_off(PIANO, e4), END]
+    track = render_track(events, tmp_path)
+
+    # a frame is 40 ticks and a half beat 240 ticks; the note-off of a silent pitch is ignored, a note-on of a
+    # sounding pitch ends it first and a note is cut after 100 frames (5 s), its own note-off is then ignored
+    assert song_events(track) == [
+        (0, bytes((0x90, 60, 80))), (40, bytes((0x80, 60, 64))),
+        (240, bytes((0x90, 64, 64))), (40, bytes((0x80, 64, 64))), (0, bytes((0x90, 64, 48))),
+        (100 * 40, bytes((0x80, 64, 64))), (20 * 240 - 100 * 40, b'\xFF\x2F\x00')]
+
+
+def test_pause_between_songs(tmp_path):
+    track = render_track([note_on(PIANO, 0), SMALL_SPACE, note_off(PIANO, 0), END, note_on(PIANO, 0), SMALL_SPACE, note_off(PIANO, 0), END], tmp_path)
+
+    # the next song starts 200 frames (10 s) after the end of the previous one
+    assert song_events(track) == [
+        (0, bytes((0x90, 36, 64))), (40, bytes((0x80, 36, 64))),
+        (200 * 40, bytes((0x90, 36, 64))), (40, bytes((0x80, 36, 64))), (0, b'\xFF\x2F\x00')]
@@ -0,0 +1,124 @@
+import argparse
+import contextlib
+import io
+import os
+import sys
+
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from Note_Predictor.lstm_model import joint_model, lstm_model
+from Note_Predictor.music_generate import SongBuffer, create_stream, event_ticks, generate_music, replay_primer_volumes
+from Note_Predictor.music_realtime import RealtimeSession
+from utils import Loader
+
+
+PRIMER = os.path.join(ROOT, 'Primers', 'piano.mus')
+
+if len(Loader.base_index) == 0: Loader.compute_base_indices()
+
+
+def generation_args(**kwargs):
+    args = argparse.Namespace(cuda=False, priming_length=50, chord_priming_length=20, n_primes=1, max_length=10000, temperature=1.0,
+                              chord_temperature=1.0, single_instrument=False, chord_model='', volume_model='', length_beats=0, length_bars=0, beats_per_bar=4)
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+
+# a small untrained Note Predictor that generates time shifts often, so the songs reach their lengths quickly
+def shifting_model(model_class=lstm_model):
+    torch.manual_seed(42)
+    model = model_class(16, 8, Loader.number_of_events(), 32, 1, Loader.number_of_chords(), 0.0, False, 'lstm', 20)
+    model.decoder.bias.data[Loader.base_index_space()] = 5
+    model.decoder.bias.data[Loader.base_index_space() + 1] = 5
+    return model
+
+
+def generate(args, model_class=lstm_model):
+    torch.manual_seed(1)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return generate_music(args, PRIMER, shifting_model(model_class), '', '')
+
+
+def test_length_target_counts_only_generated_music():
+    args = generation_args(length_beats=4)
+    song = generate(args)
+
+    # the first event and the replayed primer events come before the generated ones
+    assert len(song) > args.priming_length + 1
+    generated = torch.LongTensor([event for event, _, _ in song[args.priming_length + 1:]])
+    ticks = event_ticks(generated)
+
+    # the song ends by the time shift that reaches the target, which moves by at most 6 ticks
+    assert 4 * 12 <= ticks < 4 * 12 + 6
+    assert int(generated[-1]) in (Loader.base_index_space(), Loader.base_index_space() + 1)
+
+
+def test_length_in_bars():
+    assert [event for event, _, _ in generate(generation_args(length_bars=2, beats_per_bar=3))] == \
+           [event for event, _, _ in generate(generation_args(length_beats=6))]
+
+
+def test_joint_model_replays_primer_volumes():
+    args = generation_args(length_beats=4)
+    song = generate(args, joint_model)
+    _, primer_volumes = Loader(PRIMER).create_volume_tensor()
+
+    # the replayed primer events keep their volumes, the generated ones get the predicted volumes
+    replayed = torch.FloatTensor([volume for _, _, volume in song[:args.priming_length + 1]])
+    assert torch.equal(replayed, primer_volumes[:args.priming_length + 1])
+    assert all(0.0 <= volume <= 1.0 for _, _, volume in song[args.priming_length + 1:])
+
+
+
+def test_replayed_primer_volumes_wrap_around_short_primer(tmp_path):
+    primer = str(tmp_path / 'short.mus')
+    with open(PRIMER, 'rb') as f:
+        data = f.read(4 * 30)
+    with open(primer, 'wb') as f:
+        f.write(data)
+    _, primer_volumes = Loader(primer).create_volume_tensor()
+
+    song = SongBuffer(60)
+    for i in range(60):
+        song.append((0, 0, 0.25))
+    replay_primer_volumes(generation_args(priming_length=50), primer, song)
+
+    # the stream replays the primer from its start again after its end, so do the volumes
+    assert torch.equal(song.volumes[:51], primer_volumes[torch.arange(51) % 30])
+    assert torch.equal(song.volumes[51:60], torch.full((9,), 0.25))
+
+# collects the played events instead of writing them
+class ListSink:
+
+    def __init__(self):
+        self.items = []
+
+    def write(self, item, playback_time):
+        self.items.append(item)
+
+    def close(self):
+        pass
+
+
+def test_realtime_joint_model_plays_primer_volumes():
+    args = generation_args(length_beats=4)
+    song = generate(args, joint_model)
+
+    torch.manual_seed(1)
+    with contextlib.redirect_stdout(io.StringIO()):
+        stream = create_stream(args, PRIMER, '')
+    _, primer_volumes = Loader(PRIMER).create_volume_tensor()
+    session = RealtimeSession(shifting_model(joint_model), stream, None, ListSink(), 100000, 1, primer_volumes=primer_volumes)
+    session.prime()
+    session.play()
+
+    # the same song played in real time (at a tempo that never waits) has the same events and volumes, the
+    # replayed primer events exactly the volumes of the primer
+    played = session.sink.items
+    assert [int(item.event) for item in played] == [event for event, _, _ in song]
+    assert torch.equal(torch.FloatTensor([item.volume for item in played[:args.priming_length + 1]]), primer_volumes[:args.priming_length + 1])
+    assert torch.allclose(torch.FloatTensor([item.volume for item in played]), torch.FloatTensor([volume for _, _, volume in song]))
@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+
+import torch
+from torch import nn
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import profiling
+
+
+# a timed module whose forward pass fails when asked to
+class Failing(nn.Module):
+
+    def forward(self, input, fail=False):
+        if fail: raise RuntimeError('failed forward pass')
+        return input
+
+
+def test_failed_timed_forward_keeps_phases_consistent():
+    profiling.enable()
+    try:
+        module = Failing()
+        profiling.time_module(module, 'recurrence')
+
+        with profiling.phase('outer'):
+            try:
+                with profiling.phase('forward'):
+                    module(torch.zeros(1), fail=True)
+            except RuntimeError:
+                pass
+            with profiling.phase('sampling'):
+                time.sleep(0.05)
+            with profiling.phase('forward'):
+                module(torch.zeros(1))
+
+        stats = profiling.statistics()['phases']
+        assert len(profiling.PROFILER.stack()) == 0
+
+        # the open phase of the failed forward pass is dropped, the sampling is a child of the outer phase
+        assert stats['recurrence']['count'] == 1
+        assert stats['forward']['count'] == 2
+        assert stats['sampling']['count'] == 1
+        assert stats['outer']['self_ms'] < stats['sampling']['total_ms'] / 2
+    finally:
+        profiling.PROFILER = profiling.Profiler()
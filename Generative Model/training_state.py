@@ -0,0 +1,137 @@
+"""Full training state checkpoints written in the background, for resuming interrupted training."""
+
+# A checkpoint holds everything needed to continue exactly where the training stopped: the weights, the state of
+# the optimizer, learning rate, best validation loss, position (epoch and the next batch), hidden states carried
+# between the batches and the random generators. The training loop only copies the state, pickling and writing
+# happens in a background thread. The file is replaced atomically, so training killed in the middle of writing
+# keeps the previous checkpoint. In distributed training every process keeps its own file (with its own hidden
+# states and random generator).
+
+import copy
+import os
+import queue
+import threading
+
+import torch
+
+import data_parallel as dp
+from utils import save
+
+
+# copy of all tensors in a (nested) state, detached from the training graph
+def clone_state(state):
+    if torch.is_tensor(state): return state.detach().clone()
+    if isinstance(state, dict): return {key: clone_state(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)): return type(state)(clone_state(value) for value in state)
+    return copy.deepcopy(state)
+
+
+# runs the submitted functions one by one in a background thread
+class CheckpointWriter(threading.Thread):
+
+    def __init__(self):
+        super(CheckpointWriter, self).__init__(daemon=True)
+        self.jobs = queue.Queue()
+        self.error = None
+        self.start()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None: break
+
+            function, args = job
+            try:
+                function(*args)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.jobs.task_done()
+
+    # failures of the writer are raised in the training loop at the next submit
+    def submit(self, function, *args):
+        if self.error is not None: raise self.error
+        self.jobs.put((function, args))
+
+    def wait(self):
+        self.jobs.join()
+        if self.error is not None: raise self.error
+
+    def close(self):
+        self.wait()
+        self.jobs.put(None)
+        self.join()
+
+
+def write_atomically(state, filename):
+    temporary = filename + '.tmp'
+    torch.save(state, temporary)
+    os.replace(temporary, filename)
+
+
+# in distributed training, each process has its own file
+def rank_filename(filename):
+    if dp.world_size() == 1: return filename
+    stem, extension = os.path.splitext(filename)
+    return '{}.rank{}{}'.format(stem, dp.rank(), extension)
+
+
+def resume_filename(typ):
+    return rank_filename('{}-resume.pt'.format(typ))
+
+
+# copy of everything needed to continue the training with batch number `batch` of the epoch
+def snapshot(model, optimizer, lr, epoch, batch, best_val_loss=None):
+    return clone_state({
+        'model': model.state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'lr': lr,
+        'epoch': epoch,
+        'batch': batch,
+        'best_val_loss': best_val_loss,
+        'hidden': model.hidden,
+        'rng': torch.get_rng_state(),
+        'cuda_rng': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+    })
+
+
+def save_training_state(writer, state, filename):
+    writer.submit(write_atomically, state, filename)
+
+
+# utils.save of a copy of the model, done by the writer
+def save_model(writer, model, typ, loss, args):
+    # the hidden states may be a part of the training graph, which can't be copied
+    hidden, model.hidden = model.hidden, None
+    try:
+        model_copy = copy.deepcopy(model)
+    finally:
+        model.hidden = hidden
+    model_copy.hidden = clone_state(hidden)
+
+    writer.submit(save, model_copy, typ, loss, args)
+
+
+def restore_rng(state):
+    torch.set_rng_state(state['rng'])
+    if state['cuda_rng'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda_rng'])
+
+
+# load the weights, optimizer and random generators, returns the state with the position and the hidden states
+def load_training_state(filename, model, optimizer):
+    state = torch.load(rank_filename(filename), map_location=lambda storage, location: storage, weights_only=False)
+
+    model.load_state_dict(state['model'])
+    optimizer.load_state_dict(state['optimizer'])
+    restore_rng(state)
+
+    print('resuming from {} at epoch {}, batch {}'.format(rank_filename(filename), state['epoch'], state['batch']))
+    return state
+
+
+# continue in the middle of an epoch: set the hidden states carried from the previous batch, call it after
+# init_hidden, which consumed random numbers that the interrupted training had consumed before the checkpoint
+def restore_position(model, state, cuda):
+    model.hidden = tuple(h.cuda() if cuda else h for h in state['hidden'])
+    restore_rng(state)
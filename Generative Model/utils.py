@@ -41,6 +41,12 @@ def get_target_float_batch(source, i, args):
     return target
 
 
+# mixed precision of the training forward passes, with args.bf16 the matrix products run in bfloat16 while the
+# weights, the batch norm statistics, the losses and the optimizer state stay in float32
+def autocast(args):
+    return torch.autocast('cuda' if args.cuda else 'cpu', dtype=torch.bfloat16, enabled=args.bf16)
+
+
 # get the ith batch (only input) and transform it into backpropagatable Variable
 def get_batch_without_target(source, i, args, evaluation=False):
     seq_len = min(args.seq_len, len(source) - 1 - i)
@@ -56,17 +62,46 @@ def save(model, typ, loss, args):
     print('Saved as %s' % save_filename)
 
 
+# load a serialized model, its weights are mapped to CPU when CUDA is not used; the half precision weights of a
+# checkpoint.py checkpoint are converted to dtype, None keeps them stored (and shared) as they are
+def load_model(filename, cuda=False, dtype=torch.float32):
+    # config and memory-mapped tensors written by checkpoint.py
+    if filename.endswith('.json'):
+        from checkpoint import load_checkpoint
+        return load_checkpoint(filename, cuda, dtype)
+
+    if cuda:
+        return torch.load(filename, weights_only=False)
+    return torch.load(filename, map_location=lambda storage, location: storage, weights_only=False)
+
+
+# the files given directly or the files with one of the extensions found in the given folders (with their
+# subfolders when recursive)
+def find_files(paths, extensions=('.mus',), recursive=False):
+    filenames = []
+    for path in paths:
+        if not os.path.isdir(path):
+            filenames.append(path)
+        elif recursive:
+            for folder, _, names in sorted(os.walk(path)):
+                filenames += sorted(os.path.join(folder, name) for name in names if name.lower().endswith(extensions))
+        else:
+            filenames += sorted(os.path.join(path, name) for name in os.listdir(path) if name.lower().endswith(extensions))
+    return filenames
+
+
 # class used for loading the dataset and transforming it into tensors
 class Loader:
     num_clusters = 11 # num of intrument clusters
     cluster_range = [49, 34, 42, 27, 42, 27, 41, 37, 42, 48, 42] # pitch ranges of each cluster
     base_index = [] # base index of each event group (aka "piano note-ons" or "guitar note-offs")
+    shared_tensors = {} # tensors decoded once for several trainings (see sweep.py), filename -> {tensor type: tensors}
 
     def __init__(self, filename):
         self.filename = filename
 
         file = Path(self.filename)
-        if not file.is_file(): raise FileExistsError(self.filename + " does not exist or is not a file, please add a valid training and validation file, or priming song to the parameters")
+        if self.filename not in Loader.shared_tensors and not file.is_file(): raise FileExistsError(self.filename + " does not exist or is not a file, please add a valid training and validation file, or priming song to the parameters")
 
         if len(Loader.base_index) == 0: Loader.compute_base_indices()
 
@@ -81,7 +116,24 @@ class Loader:
 
         return event_tensor, chord_tensor
 
+    # events, chords and volumes in one pass over the file (for the joint note and volume training)
+    def create_joint_tensor(self):
+        size = self.total_event_inputs()
+        event_tensor = torch.ShortTensor(size)
+        chord_tensor = torch.ByteTensor(size)
+        volume_tensor = torch.FloatTensor(size)
+
+        chord = 0
+        for i, bytes in enumerate(self.iterate_quadruples()):
+            event_tensor[i], chord = self.get_input(bytes, chord)
+            chord_tensor[i] = chord
+            volume_tensor[i] = self.get_volume(bytes)
+
+        return event_tensor, chord_tensor, volume_tensor
+
     def create_chord_tensor(self):
+        if 'chord' in Loader.shared_tensors.get(self.filename, {}): return Loader.shared_tensors[self.filename]['chord']
+
         size = self.total_chord_inputs()
         tensor = torch.ByteTensor(size)
 
@@ -91,6 +143,8 @@ class Loader:
         return tensor
 
     def create_volume_tensor(self):
+        if 'volume' in Loader.shared_tensors.get(self.filename, {}): return Loader.shared_tensors[self.filename]['volume']
+
         size = self.total_event_inputs()
         event_tensor = torch.ShortTensor(size)
         volume_tensor = torch.FloatTensor(size)
@@ -0,0 +1,149 @@
+"""Validation in a separate worker process, running on snapshots of the weights while the training continues."""
+
+# The worker is forked from the training script, so it has its own copy of the network, the evaluate function
+# and the validation data, which it batchifies with its own (usually larger) batch size. A validation copies
+# the weights into a free slot of shared memory and the worker evaluates them from there; when both slots are
+# still waiting for the worker, the training waits for the older one. Validations in the middle of an epoch
+# don't block the training at all, their losses are written into the test log when they are finished and the
+# validated snapshot is saved by the worker itself. The validation at the end of an epoch waits for the result,
+# as the learning rate of the next epoch depends on it. In distributed training, only the first rank runs a
+# worker (on the whole validation set). The worker is forked, so it's available only for training on CPU.
+
+import multiprocessing
+import queue
+
+import torch
+
+import data_parallel as dp
+from utils import batchify, save
+
+
+# state dict of the network in flat shared memory buffers (one per dtype)
+class SharedState:
+
+    def __init__(self, model):
+        state = model.state_dict()
+        sizes = {}
+        for tensor in state.values():
+            sizes[tensor.dtype] = sizes.get(tensor.dtype, 0) + tensor.numel()
+        self.buffers = {dtype: torch.empty(size, dtype=dtype).share_memory_() for dtype, size in sizes.items()}
+
+        offsets = {dtype: 0 for dtype in sizes}
+        self.views = {}
+        for key, tensor in state.items():
+            offset = offsets[tensor.dtype]
+            self.views[key] = self.buffers[tensor.dtype][offset:offset + tensor.numel()].view(tensor.size())
+            offsets[tensor.dtype] += tensor.numel()
+
+    def write(self, model):
+        with torch.no_grad():
+            for key, tensor in model.state_dict().items():
+                self.views[key].copy_(tensor)
+
+    def read(self, model):
+        model.load_state_dict(self.views)
+
+
+def validation_loop(model, evaluate, sources, batch_size, threads, args, slots, jobs, results):
+    dp.forked = True
+    if threads > 0: torch.set_num_threads(threads)
+
+    # the forked copy of args is used by evaluate
+    args.batch_size = batch_size
+    sources = [batchify(source, batch_size) for source in sources]
+
+    while True:
+        job = jobs.get()
+        if job is None: break
+
+        job_id, slot, typ = job
+        try:
+            slots[slot].read(model)
+            with torch.no_grad():
+                loss = float(evaluate(*sources))
+            if typ is not None: save(model, typ, loss, args)
+            results.put((job_id, slot, loss, None))
+        except Exception as e:
+            results.put((job_id, slot, None, '{}: {}'.format(type(e).__name__, e)))
+
+
+class ValidationWorker:
+
+    # sources are the validation tensors before batchify, evaluate is the evaluate function of the training script
+    # (called with the batchified sources), it uses args.batch_size as the batch size
+    def __init__(self, model, evaluate, sources, batch_size, args, threads=0, n_slots=2):
+        if args.cuda: raise ValueError('the validation worker supports only training on CPU')
+
+        self.slots = [SharedState(model) for _ in range(n_slots)]
+        self.free_slots = list(range(n_slots))
+        self.pending = []
+        self.finished = {}
+        self.next_id = 0
+
+        context = multiprocessing.get_context('fork')
+        self.jobs = context.Queue()
+        self.results = context.Queue()
+        self.process = context.Process(target=validation_loop, args=(model, evaluate, sources, batch_size, threads, args, self.slots, self.jobs, self.results), daemon=True)
+        self.process.start()
+
+    def receive(self, block):
+        job_id, slot, loss, error = self.results.get(block=block)
+        if error is not None: raise RuntimeError('validation failed in the worker: ' + error)
+
+        self.free_slots.append(slot)
+        self.pending.remove(job_id)
+        self.finished[job_id] = loss
+
+    # validate a snapshot of the weights, when typ is given, the worker saves the snapshot by utils.save
+    def submit(self, model, typ=None):
+        if not self.process.is_alive(): raise RuntimeError('the validation worker died (exit code {})'.format(self.process.exitcode))
+        while len(self.free_slots) == 0:
+            self.receive(block=True)
+
+        slot = self.free_slots.pop(0)
+        self.slots[slot].write(model)
+
+        job_id = self.next_id
+        self.next_id += 1
+        self.pending.append(job_id)
+        self.jobs.put((job_id, slot, typ))
+        return job_id
+
+    # write the losses of the finished validations (in the order of submission) into the log
+    def log_results(self, test_log, block=False):
+        while len(self.pending) > 0:
+            try:
+                self.receive(block=block)
+            except queue.Empty:
+                break
+
+        for job_id in sorted(self.finished):
+            print(self.finished.pop(job_id), file=test_log, flush=True)
+
+    # validate the current weights and wait for the result, the losses finished before are logged
+    def validate(self, model, test_log):
+        job_id = self.submit(model)
+        while job_id in self.pending:
+            self.receive(block=True)
+
+        loss = self.finished.pop(job_id)
+        self.log_results(test_log)
+        return loss
+
+    def close(self, test_log):
+        self.log_results(test_log, block=True)
+        self.jobs.put(None)
+        self.process.join()
+
+
+# validation in the middle of an epoch, called by all ranks (which synchronize their batch norm statistics)
+def validate_in_background(validator, model, typ=None):
+    dp.synchronize_buffers(model)
+    if validator is not None: validator.submit(model, typ)
+
+
+# validation at the end of an epoch, called by all ranks, returns the loss from the worker of the first rank
+def validate_and_wait(validator, model, test_log):
+    dp.synchronize_buffers(model)
+    loss = validator.validate(model, test_log) if validator is not None else 0.0
+    return dp.broadcast_value(loss)